@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/9 10:40
+@File    : expiry_sweeper.py
+@Desc    : remove the members older than SAVE_DAYS from every sorted set in the background
+"""
+
+import logging
+import threading
+import time
+
+from setting import SAVE_DAYS, SWEEP_BATCH_SIZE, SWEEP_KEYS_PER_SECOND, SWEEP_INTERVAL
+
+
+class ExpirySweeper(object):
+
+    def __init__(self, redis, save_days=SAVE_DAYS, pattern='*', batch_size=SWEEP_BATCH_SIZE,
+                 keys_per_second=SWEEP_KEYS_PER_SECOND, interval=SWEEP_INTERVAL, obj_id_tables=(), logger=None):
+        """Walk the keys with SCAN, batch_size of them at a time, and trim each
+        batch in one pipeline, at most keys_per_second keys
+        A pass visits every key, also the ones no query probes any more, then
+        the sweeper waits interval seconds for the next one. Reads skip the
+        expired members themselves, they only wait here to be removed.
+        Args:
+            redis: an instance of SimhashRedis
+            save_days: members older than this are removed
+            pattern: the keys to sweep
+            batch_size: COUNT of a SCAN, the keys of a pipeline
+            keys_per_second: the rate limit, None for none
+            interval: seconds between the end of a pass and the next
+            obj_id_tables: instances of RedisObjIdTable, the obj_ids last
+                written before the members expire are removed after every pass
+            logger: an instance of Logger
+        """
+        if logger is None:
+            self.log = logging.getLogger("simhash")
+        else:
+            self.log = logger
+        self.redis = redis
+        self.save_days = save_days
+        self.pattern = pattern
+        self.batch_size = batch_size
+        self.keys_per_second = keys_per_second
+        self.interval = interval
+        self.obj_id_tables = list(obj_id_tables)
+        # the times of the obj_ids are sorted sets too, expire removes them with the obj_ids
+        self._skipped = set()
+        for table in self.obj_id_tables:
+            self._skipped.update((table.seen, table.seen.encode()))
+        # the metrics
+        self.passes = 0
+        self.batches = 0
+        self.keys_scanned = 0
+        self.keys_trimmed = 0
+        self.members_removed = 0
+        self.obj_ids_removed = 0
+        self.errors = 0
+        self.pass_keys = 0
+        self.pass_started = None
+        self.last_pass_seconds = None
+        self._cursor = 0
+        self._total = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep_batch(self):
+        """SCAN one batch from where the last one stopped and trim it
+        Returns:
+            True when the batch ended a pass
+        """
+        if self.pass_started is None:
+            self.pass_started = time.time()
+            self.pass_keys = 0
+            # SCAN does not tell how many keys are left, DBSIZE is close enough
+            self._total = self.redis.status
+        self._cursor, names = self.redis.redis.scan(self._cursor, match=self.pattern, count=self.batch_size)
+        if self._skipped:
+            names = [name for name in names if name not in self._skipped]
+        if names:
+            removed = self.redis.trim_many(names, self.redis.timeline(self.save_days))
+            self.batches += 1
+            self.keys_scanned += len(names)
+            self.pass_keys += len(names)
+            # the obj_id tables and the digests are not sorted sets
+            removed = [n for n in removed if n is not None]
+            self.keys_trimmed += sum(1 for n in removed if n)
+            self.members_removed += sum(removed)
+        if int(self._cursor):
+            return False
+        self._cursor = 0
+        # the members of the obj_ids are gone now, the obj_ids go after them
+        for table in self.obj_id_tables:
+            self.obj_ids_removed += table.expire(self.redis.timeline(self.save_days))
+        self.passes += 1
+        self.last_pass_seconds = time.time() - self.pass_started
+        self.pass_started = None
+        self.log.info('Expiry sweep pass {} done, {} keys...{:.1f}s, {} members and {} obj_ids removed in all'.format(
+            self.passes, self.pass_keys, self.last_pass_seconds, self.members_removed, self.obj_ids_removed))
+        return True
+
+    def sweep(self):
+        """One whole pass, at the rate limit"""
+        while not self._stop.is_set():
+            s1 = time.time()
+            scanned = self.keys_scanned
+            done = self.sweep_batch()
+            if done:
+                return
+            if self.keys_per_second:
+                self._stop.wait((self.keys_scanned - scanned) / self.keys_per_second - (time.time() - s1))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                # redis restarting, the next pass starts over
+                self.errors += 1
+                self._cursor = 0
+                self.pass_started = None
+                self.log.warning('Expiry sweep failed {}'.format(e))
+            self._stop.wait(self.interval)
+
+    @property
+    def progress(self):
+        """Share of the keys visited in the current pass, None between passes"""
+        if self.pass_started is None:
+            return None
+        return min(1.0, self.pass_keys / self._total) if self._total else 1.0
+
+    def stats(self):
+        return dict(passes=self.passes, batches=self.batches, keys_scanned=self.keys_scanned,
+                    keys_trimmed=self.keys_trimmed, members_removed=self.members_removed,
+                    obj_ids_removed=self.obj_ids_removed, errors=self.errors,
+                    progress=self.progress, last_pass_seconds=self.last_pass_seconds)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='expiry-sweeper', daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the background thread, the batch running is finished first"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    from db.simhash_redis import SimhashRedis
+    from fingerprints_storage.obj_id_table import RedisObjIdTable
+
+    redis = SimhashRedis()
+    sweeper = ExpirySweeper(redis, keys_per_second=None, obj_id_tables=[RedisObjIdTable(redis)])
+    s1 = time.time()
+    sweeper.sweep()
+    stats = sweeper.stats()
+    print('扫描{keys_scanned}个key 清理{keys_trimmed}个key 删除{members_removed}条过期数据 {obj_ids_removed}个过期obj_id'.format(
+        **stats))
+    print('耗时{:.1f}s'.format(time.time() - s1))
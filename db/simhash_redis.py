@@ -8,10 +8,119 @@
 """
 
 import time
+from collections import OrderedDict
 
 from redis import StrictRedis, ConnectionPool
 from setting import SAVE_DAYS, REDIS_HOST, REDIS_PORT
 
+# KEYS: sorted sets of '{:x},obj_id' members or compact ones, see member_codec
+# ARGV: high and low 32 bits of the fingerprint, the largest distance, and the
+# timeline under which members are skipped, '' for keys which expire as a whole
+# Returns the members of every key within the distance, the split marker kept,
+# so that only the matches cross the network. Redis Lua numbers are doubles,
+# the 64 bits fingerprints are compared in two halves with the bit library.
+HAMMING_FILTER_SCRIPT = """
+local hi = tonumber(ARGV[1])
+local lo = tonumber(ARGV[2])
+local max = tonumber(ARGV[3])
+local timeline = ARGV[4]
+
+local function popcount(x)
+    local c = 0
+    while x ~= 0 do
+        x = bit.band(x, x - 1)
+        c = c + 1
+    end
+    return c
+end
+
+local result = {}
+for i, key in ipairs(KEYS) do
+    local members
+    if timeline ~= '' then
+        members = redis.call('ZRANGEBYSCORE', key, '(' .. timeline, '+inf')
+    else
+        members = redis.call('ZRANGE', key, 0, -1)
+    end
+    local found = {}
+    for _, member in ipairs(members) do
+        local comma = string.find(member, ',', 1, true)
+        if string.byte(member, 1) == 0 and string.len(member) >= 10 then
+            -- the tag, then the fingerprint in 8 bytes big endian
+            local b1, b2, b3, b4, b5, b6, b7, b8 = string.byte(member, 2, 9)
+            local h = ((b1 * 256 + b2) * 256 + b3) * 256 + b4
+            local l = ((b5 * 256 + b6) * 256 + b7) * 256 + b8
+            if popcount(bit.bxor(h, hi)) + popcount(bit.bxor(l, lo)) <= max then
+                found[#found + 1] = member
+            end
+        elseif comma then
+            local hex = string.sub(member, 1, comma - 1)
+            local n = string.len(hex)
+            local h = 0
+            if n > 8 then
+                h = tonumber(string.sub(hex, 1, n - 8), 16)
+            end
+            local l = tonumber(string.sub(hex, math.max(n - 7, 1)), 16)
+            if h and l and popcount(bit.bxor(h, hi)) + popcount(bit.bxor(l, lo)) <= max then
+                found[#found + 1] = member
+            end
+        else
+            -- the split marker
+            found[#found + 1] = member
+        end
+    end
+    result[i] = found
+end
+return result
+"""
+
+# KEYS: the obj_id -> int hash, the int -> obj_id hash, the counter of the ints
+# and the sorted set of the ints scored by the last time they were written
+# ARGV: obj_id, time, obj_id, time, ...
+# Returns the int of every obj_id, a new one drawn from the counter for the
+# obj_ids without one. Both hashes are written in the same call, another
+# process never sees one without the other, and the reverse entry is written
+# again in case expire removed it meanwhile.
+INTERN_SCRIPT = """
+local result = {}
+for i = 1, #ARGV, 2 do
+    local obj_id = ARGV[i]
+    local t = tonumber(ARGV[i + 1])
+    local n = redis.call('HGET', KEYS[1], obj_id)
+    if not n then
+        n = redis.call('INCR', KEYS[3])
+        redis.call('HSET', KEYS[1], obj_id, n)
+    end
+    redis.call('HSET', KEYS[2], n, obj_id)
+    local seen = redis.call('ZSCORE', KEYS[4], n)
+    if not seen or tonumber(seen) < t then
+        redis.call('ZADD', KEYS[4], t, n)
+    end
+    result[#result + 1] = tonumber(n)
+end
+return result
+"""
+
+# KEYS: the same as INTERN_SCRIPT
+# ARGV: the timeline and the most ints to remove
+# Removes the ints last written at or before the timeline from both hashes,
+# the obj_id is kept if it has been interned again as another int meanwhile.
+# Returns the number of ints removed.
+EXPIRE_IDS_SCRIPT = """
+local ns = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, n in ipairs(ns) do
+    local obj_id = redis.call('HGET', KEYS[2], n)
+    if obj_id then
+        redis.call('HDEL', KEYS[2], n)
+        if redis.call('HGET', KEYS[1], obj_id) == n then
+            redis.call('HDEL', KEYS[1], obj_id)
+        end
+    end
+    redis.call('ZREM', KEYS[4], n)
+end
+return #ns
+"""
+
 class SimhashRedis(object):
 
     def __init__(self, redis_host=REDIS_HOST, redis_port=REDIS_PORT, redis_db=0, redis_pw=''):
@@ -20,6 +129,10 @@ class SimhashRedis(object):
         self._db = redis_db
         self._password = redis_pw
         self.redis = self._redis_conn()
+        # loaded on the first call, EVALSHA afterwards
+        self._hamming_filter = self.redis.register_script(HAMMING_FILTER_SCRIPT)
+        self._intern = self.redis.register_script(INTERN_SCRIPT)
+        self._expire_ids = self.redis.register_script(EXPIRE_IDS_SCRIPT)
 
     def _redis_conn(self):
         try:
@@ -34,14 +147,172 @@ class SimhashRedis(object):
 
         return self.redis.zadd(name, timenode, value)
 
-    def get_values(self, name):
+    def add_many(self, items, expire_at=None, nx_items=()):
+        """ZADD many (name, timenode, value) in one round trip
+        Args:
+            expire_at: unix time when the keys expire, None for never
+            nx_items: (name, timenode, value) added only if the member is
+                not there, the score of one there is kept
+        Returns:
+            name -> number of members after the adds
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        names = []
+        for name, timenode, value in items:
+            # ZADD name score member, the same with every redis-py
+            pipe.execute_command('ZADD', name, timenode, value)
+            names.append(name)
+        for name, timenode, value in nx_items:
+            pipe.execute_command('ZADD', name, 'NX', timenode, value)
+            names.append(name)
+        names = list(OrderedDict.fromkeys(names))
+        if expire_at is not None:
+            for name in names:
+                pipe.expireat(name, expire_at)
+        for name in names:
+            pipe.zcard(name)
+        if not names:
+            return {}
+        return dict(zip(names, pipe.execute()[-len(names):]))
+
+    def add_and_remove(self, items, name, values, expire_at=None):
+        """ZADD the (name, timenode, value) items, then remove values from
+        name with one ZREM, in one round trip
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for item_name, timenode, value in items:
+            pipe.execute_command('ZADD', item_name, timenode, value)
+            if expire_at is not None:
+                pipe.expireat(item_name, expire_at)
+        if values:
+            pipe.zrem(name, *values)
+        return pipe.execute()
+
+    def get_values(self, name, withscores=False, trim=True):
+        """Members of the sorted set `name`
+        Args:
+            trim: skip the members older than SAVE_DAYS, keys which expire as
+                a whole (time segments) need not. Reads never remove them,
+                the ExpirySweeper does.
+        """
+        if not trim:
+            return self.redis.zrange(name, 0, -1, withscores=withscores)
+        # members scored in the future, e.g. the split marker, are returned too
+        return self.redis.zrangebyscore(name, '({}'.format(self.timeline()), '+inf', withscores=withscores)
+
+    def get_values_many(self, names, withscores=False, trim=True):
+        """Members of many sorted sets in a single round trip, see get_values
+        Returns:
+            a list with the members of every name, in the order of names, an
+            empty list for a name whose commands failed
+        """
+        low = '({}'.format(self.timeline())
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            if trim:
+                pipe.zrangebyscore(name, low, '+inf', withscores=withscores)
+            else:
+                pipe.zrange(name, 0, -1, withscores=withscores)
+        results = pipe.execute(raise_on_error=False)
+        return [[] if isinstance(r, Exception) else r for r in results]
+
+    def filter_values_many(self, names, fingerprint, max_distance, trim=True):
+        """Members of many sorted sets within max_distance of the fingerprint,
+        filtered inside redis by a Lua script, in a single round trip
+        Returns:
+            the same as get_values_many, only the members within max_distance
+            and the split marker
+        """
+        timeline = self.timeline() if trim else ''
+        if not names:
+            return []
+        return self._hamming_filter(keys=names, args=[fingerprint >> 32, fingerprint & 0xffffffff,
+                                                      max_distance, timeline])
+
+    @staticmethod
+    def timeline(save_days=SAVE_DAYS):
+        """Members scored at or before it are expired"""
+        return int(time.time()) - 3600 * 24 * save_days
+
+    def trim_many(self, names, timeline):
+        """Remove the members scored at or before timeline from many sorted
+        sets in one round trip
+        Returns:
+            the number of members removed from every name, None for a name
+            which is not a sorted set
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.zremrangebyscore(name, 0, timeline)
+        return [None if isinstance(r, Exception) else r for r in pipe.execute(raise_on_error=False)]
+
+    def expireat(self, name, when):
+        return self.redis.expireat(name, when)
+
+    def drop(self, pattern):
+        """Delete every key matching `pattern`, returns the number of keys"""
+        count = 0
+        pipe = self.redis.pipeline(transaction=False)
+        for name in self.redis.scan_iter(match=pattern, count=1000):
+            pipe.delete(name)
+            count += 1
+            if count % 1000 == 0:
+                pipe.execute()
+        pipe.execute()
+        return count
+
+    def memory_usage(self, names):
+        """MEMORY USAGE of every name in one round trip, None where the
+        server does not tell (redis < 4.0)
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.execute_command('MEMORY', 'USAGE', name)
+        return [None if isinstance(r, Exception) else r for r in pipe.execute(raise_on_error=False)]
+
+    def get_score(self, name, value):
+        return self.redis.zscore(name, value)
+
+
+    def get(self, name):
+        return self.redis.get(name)
+
+    def set(self, name, value, ex=None, nx=False):
+        return self.redis.set(name, value, ex=ex, nx=nx)
+
+    def incr(self, name):
+        return self.redis.incr(name)
+
+    def hget(self, name, key):
+        return self.redis.hget(name, key)
+
+    def hmget(self, name, keys):
+        return self.redis.hmget(name, keys)
+
+    def hset(self, name, key, value):
+        return self.redis.hset(name, key, value)
+
+    def hsetnx(self, name, key, value):
+        return self.redis.hsetnx(name, key, value)
+
+    def hlen(self, name):
+        return self.redis.hlen(name)
 
-        now = int(time.time())
-        timeline = now - 3600 * 24 * SAVE_DAYS
-        self.redis.zremrangebyscore(name, 0, timeline)
-        # print(self.redis.zrangebyscore(name, 0, timeline))
-        return self.redis.zrangebyscore(name, timeline, now)
+    def intern_many(self, names, obj_ids, add_times):
+        """The ints of the obj_ids in one atomic call, see INTERN_SCRIPT
+        Args:
+            names: the forward hash, the reverse hash, the counter and the
+                sorted set of the times of a RedisObjIdTable
+        """
+        args = []
+        for obj_id, add_time in zip(obj_ids, add_times):
+            args.append(obj_id)
+            args.append(add_time)
+        return self._intern(keys=names, args=args)
 
+    def expire_ids(self, names, timeline, count):
+        """Remove at most count ints last written at or before timeline, see EXPIRE_IDS_SCRIPT"""
+        return self._expire_ids(keys=names, args=[timeline, count])
 
     def get_num(self,name):
         return self.redis.zcard(name)
@@ -57,6 +328,9 @@ class SimhashRedis(object):
         names = self.redis.keys(pattern=pattern)
         all_count = {}
         for name in names:
+            # the obj_id tables and the digests are not sorted sets
+            if self.redis.type(name) not in (b'zset', 'zset'):
+                continue
             all_count[name] = self.get_num(name)
 
         return all_count
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/26 10:42
+@File    : clean_html.py
+@Desc    : html cleaning shared by all entry points
+"""
+
+import re
+
+try:
+    from html import unescape
+except ImportError:
+    # fallback for Python 2
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+# every pattern starts with `<` or `&`, the engine jumps from one to the next
+# instead of trying an alternation at every character of the text
+_TAG_RE = re.compile(r'<[a-zA-Z/!?][^>]*>')
+_SPACE_ENTITY_RE = re.compile(r'&(?:nbsp|#160|#13|#10|#9);')
+_ENTITY_RE = re.compile(r'&#?\w+;', re.UNICODE)
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def clean_html(html):
+    """Strip tags, decode entities and collapse whitespace
+    Args:
+        html: content of the article
+    Returns:
+        the cleaned string
+    """
+    if '<' in html:
+        html = _TAG_RE.sub(' ', html)
+    if '&' in html:
+        html = _SPACE_ENTITY_RE.sub(' ', html)
+        if '&' in html:
+            # the remaining entities are few, decode them with the stdlib
+            html = unescape(html)
+    return ' '.join(html.split())
+
+
+def normalize_text(html):
+    """The text Participle cuts into shingles, straight from the html
+    Tags and entities are dropped together with punctuation and whitespace,
+    then the text is lowercased. Tags and entities become a space first, so
+    that what is left around them cannot form a new entity.
+    """
+    if '<' in html:
+        html = _TAG_RE.sub(' ', html)
+    if '&' in html:
+        html = _ENTITY_RE.sub(' ', html)
+    return ''.join(_WORD_RE.findall(html)).lower()
+
+
+if __name__ == '__main__':
+    import time
+    html = '<div class="article"><p>Software&nbsp;major Adobe is the best&#13;\n technology company &amp; ' \
+           'to work for in India.</p>\r\n\t<p>The Indian Space Research Organization (ISRO)</p></div>' * 200
+
+    def old_clean_html(html):
+        return html.strip().replace("\n", "").replace("\t", "").replace("\r", "").replace("&amp;", "").replace("&#13;", "").replace("&nbsp;", "")
+
+    for func in (old_clean_html, clean_html, normalize_text):
+        s1 = time.time()
+        for _ in range(100):
+            func(html)
+        s2 = time.time()
+        print('{}: {:.6f}s/article'.format(func.__name__, (s2 - s1) / 100))
+    print(clean_html(html[:200]))
+    print(normalize_text(html[:200]))
@@ -9,34 +9,147 @@
 
 import string
 import re
+import heapq
+import zlib
+from collections import namedtuple, Counter
 from itertools import groupby
 
+from extract_features.clean_html import clean_html, normalize_text
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 try:
     maketrans = ''.maketrans
 except AttributeError:
     # fallback for Python 2
     from string import maketrans
 
+DEFAULT_REG = r'[\w]+'
+PUNCTUATION_CN = """！？｡＂＃＄％＆＇（）＊＋－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏"""
+REMOVE_PUNCTUATION_MAP = dict((ord(char), None) for char in string.punctuation + PUNCTUATION_CN)
+
+# hashes: the distinct shingle hashes of a text, counts: how many times each one occurs
+ShingleHashes = namedtuple('ShingleHashes', ['hashes', 'counts'])
+
+ROLLING_BASE = 0x100000001b3
+MASK_64 = (1 << 64) - 1
+
+
+def fmix64(h):
+    # murmur3 finalizer, spreads the weak low bits of the polynomial hash over all 64 bits
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & MASK_64
+    h ^= h >> 33
+    h = (h * 0xc4ceb9fe1a85ec53) & MASK_64
+    h ^= h >> 33
+    return h
+
+
+def rolling_hash(x):
+    """Hash of one utf-8 encoded shingle, the same value the rolling shingler gives it"""
+    h = 0
+    for c in x.decode('utf-8'):
+        h = (h * ROLLING_BASE + ord(c)) & MASK_64
+    return fmix64(h)
+
+
 class Participle(object):
 
-    def __init__(self, reg=r'[\w]+'):
+    def __init__(self, reg=DEFAULT_REG, width=5, max_features=None, strip_html=False):
+        """Cut the text into shingles of `width` characters
+        Args:
+            reg: what is kept of the text, None keeps everything but punctuation
+            width: the characters of every shingle
+            max_features: keep at most this many distinct shingles, the ones
+                with the smallest hash (bottom-k), so that hashing and
+                accumulating a very long page costs no more than a normal
+                article. The same shingles are kept for the same text, but
+                all fingerprints of one index must use the same value.
+            strip_html: drop html tags and entities before cutting, so the
+                raw article can be given as it is. The shingles of an html
+                article change, all fingerprints of one index must use the
+                same value, see SHINGLE_STRIP_HTML
+        """
         self.reg = reg
+        self.width = width
+        self.max_features = max_features
+        self.strip_html = strip_html
 
     def get_text_feature(self, text):
         new_text = self._text_no_punctuation(text)
-        _features = self._slice(new_text)
+        _features = self._slice(new_text, self.width)
         features = {k: sum(1 for _ in g) for k, g in groupby(_features)}
+        if self.max_features and len(features) > self.max_features:
+            features = self._bottom_k(features)
         return features
 
+    def _bottom_k(self, features):
+        """Keep the `max_features` shingles with the smallest crc32"""
+        selected = heapq.nsmallest(self.max_features, features, key=lambda k: zlib.crc32(k.encode('utf-8')))
+        return dict((k, features[k]) for k in selected)
+
+    def get_text_hashes(self, text):
+        """Rolling hash shingling
+        Every shingle is hashed with a Rabin-Karp polynomial over the code
+        points of the text, updated from the previous shingle, so no shingle
+        string is ever created and no md5 is run.
+        Returns:
+            an instance of ShingleHashes
+        """
+        new_text = self._text_no_punctuation(text)
+        if np is None:
+            counts = Counter(self.iter_text_hashes(new_text, cleaned=True))
+            if self.max_features and len(counts) > self.max_features:
+                counts = dict(heapq.nsmallest(self.max_features, counts.items()))
+            return ShingleHashes(list(counts.keys()), list(counts.values()))
+
+        width = min(self.width, len(new_text))
+        codes = np.frombuffer(new_text.encode('utf-32-le'), dtype='<u4').astype(np.uint64)
+        n = max(len(codes) - width + 1, 1)
+        h = np.zeros(n, dtype=np.uint64)
+        base = np.uint64(ROLLING_BASE)
+        for k in range(width):
+            # uint64 arithmetic wraps around, the same as `& MASK_64`
+            h = h * base + codes[k:k + n]
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xff51afd7ed558ccd)
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xc4ceb9fe1a85ec53)
+        h ^= h >> np.uint64(33)
+        hashes, counts = np.unique(h, return_counts=True)
+        if self.max_features:
+            # np.unique sorts the hashes, the bottom-k are the first ones
+            hashes, counts = hashes[:self.max_features], counts[:self.max_features]
+        return ShingleHashes(hashes, counts)
+
+    def iter_text_hashes(self, text, cleaned=False):
+        """Pure python rolling shingler, yields the hash of every shingle in order"""
+        new_text = text if cleaned else self._text_no_punctuation(text)
+        width = min(self.width, len(new_text))
+        h = 0
+        for c in new_text[:width]:
+            h = (h * ROLLING_BASE + ord(c)) & MASK_64
+        yield fmix64(h)
+        # the weight of the character leaving the window
+        out = pow(ROLLING_BASE, max(width - 1, 0), 1 << 64)
+        for i in range(width, len(new_text)):
+            h = ((h - ord(new_text[i - width]) * out) * ROLLING_BASE + ord(new_text[i])) & MASK_64
+            yield fmix64(h)
+
     def _text_no_punctuation(self, text):
+        if self.strip_html and self.reg == DEFAULT_REG:
+            # tags, entities and punctuation are dropped in a single pass
+            return normalize_text(text)
+        if self.strip_html:
+            text = clean_html(text)
         text = text.lower()
         if self.reg:
             _text = ''.join(re.findall(self.reg, text))
         else:
-            punctuation_cn = """！？｡＂＃＄％＆＇（）＊＋－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏"""
-            punctuation = string.punctuation + punctuation_cn
-            remove_punctuation_map = dict((ord(char), None) for char in punctuation)
-            _text = text.translate(remove_punctuation_map)
+            _text = text.translate(REMOVE_PUNCTUATION_MAP)
         return _text
 
     def _slice(self, content, width=5):
@@ -50,4 +163,14 @@ if __name__ == '__main__':
             "During the 1970s, many programmers began to write conceptual ontologies, which structured real-world information into computer-understandable data. Examples are MARGIE (Schank, 1975), SAM (Cullingford, 1978), PAM (Wilensky, 1978), TaleSpin (Meehan, 1976), QUALM (Lehnert, 1977), Politics (Carbonell, 1979), and Plot Units (Lehnert 1981). During this time, many chatterbots were written including PARRY, Racter, and Jabberwacky。"
     keywords = Participle().get_text_feature(text1)
     print(keywords)
-    print(len(keywords))
\ No newline at end of file
+    print(len(keywords))
+
+    import time
+    s1 = time.time()
+    for _ in range(100):
+        Participle().get_text_feature(text1)
+    s2 = time.time()
+    for _ in range(100):
+        Participle().get_text_hashes(text1)
+    s3 = time.time()
+    print('string shingles {:.6f}s/article, rolling hash shingles {:.6f}s/article'.format((s2 - s1) / 100, (s3 - s2) / 100))
\ No newline at end of file
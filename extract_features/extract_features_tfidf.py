@@ -11,11 +11,18 @@ import nltk
 import math
 import string
 import os
+import json
+import atexit
+import fcntl
+import numpy as np
 
 from nltk.corpus import stopwords
 from collections import Counter
+from functools import lru_cache
 from nltk.stem.porter import*
 
+STOPWORD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stopwords_en.txt')
+
 # nltk.download('punkt')
 # nltk.download('stopwords')
 
@@ -120,6 +127,184 @@ def get_stopwords(stopword_file=None):
     return set(stopwords.words('english')).union(my_stopword)
 
 
+class DocumentFrequency(object):
+
+    VERSION = 1
+
+    def __init__(self, vocab=None, counts=None, n_docs=0):
+        """Document frequency table
+        The saved table is a vocabulary file plus a .npy array of counts which
+        is memory-mapped when loaded, new documents are counted in `delta`
+        and `new_docs` until the next `save`.
+        Args:
+            vocab: a dict of word -> row of `counts`
+            counts: int array of document frequency
+            n_docs: the number of documents counted
+        """
+        self.vocab = vocab if vocab is not None else dict()
+        self.counts = counts if counts is not None else np.zeros(0, dtype=np.int64)
+        self.delta = Counter()
+        self.n_docs = n_docs
+        self.new_docs = 0
+
+    def add_document(self, words):
+        """Count the distinct words of one document"""
+        self.n_docs += 1
+        self.new_docs += 1
+        self.delta.update(set(words))
+
+    def __getitem__(self, word):
+        i = self.vocab.get(word)
+        base = int(self.counts[i]) if i is not None else 0
+        return base + self.delta.get(word, 0)
+
+    def __len__(self):
+        return len(self.vocab) + sum(1 for w in self.delta if w not in self.vocab)
+
+    def save(self, path):
+        """Write the table into directory `path`, `delta` is merged into the counts
+        The processes counting documents share the directory: under a lock the
+        table saved there is read again and only the documents this one has
+        counted since are added, so no process overwrites the counts of
+        another. Without a saved table the whole of this one is written.
+        Every file is written aside and renamed over the old one, so that the
+        processes which memory-mapped the old counts keep reading them.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(os.path.join(path, 'meta.json')):
+                saved = self.load(path, mmap=False)
+            else:
+                saved = DocumentFrequency(self.vocab, self.counts, self.n_docs - self.new_docs)
+            words = [None] * len(saved.vocab)
+            for word, i in saved.vocab.items():
+                words[i] = word
+            new_words = [w for w in self.delta if w not in saved.vocab]
+            counts = np.zeros(len(words) + len(new_words), dtype=np.int64)
+            counts[:len(saved.counts)] = saved.counts
+            words.extend(new_words)
+            for i, word in enumerate(words):
+                counts[i] += self.delta.get(word, 0)
+            n_docs = saved.n_docs + self.new_docs
+            suffix = '.tmp{}'.format(os.getpid())
+            # the counts first, load() reads as many words as there are counts
+            # and new words are only ever appended
+            with open(os.path.join(path, 'counts.npy') + suffix, 'wb') as f:
+                np.save(f, counts)
+            with open(os.path.join(path, 'vocab.txt') + suffix, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(words))
+            with open(os.path.join(path, 'meta.json') + suffix, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.VERSION, 'n_docs': n_docs}, f)
+            for name in ('counts.npy', 'vocab.txt', 'meta.json'):
+                os.replace(os.path.join(path, name) + suffix, os.path.join(path, name))
+        # saved, with the counts of the other processes, a second save must not count the delta again
+        self.vocab = dict((w, i) for i, w in enumerate(words))
+        self.counts = counts
+        self.n_docs = n_docs
+        self.delta = Counter()
+        self.new_docs = 0
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read the table saved in directory `path`, the counts are memory-mapped unless `mmap` is False"""
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['version'] != cls.VERSION:
+            raise ValueError('Unknown document frequency version {}'.format(meta['version']))
+        with open(os.path.join(path, 'vocab.txt'), encoding='utf-8') as f:
+            words = f.read().split('\n')
+        counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r' if mmap else None)
+        vocab = dict((w, i) for i, w in enumerate(words[:len(counts)]))
+        return cls(vocab=vocab, counts=counts, n_docs=meta['n_docs'])
+
+
+class TfidfExtractor(object):
+
+    def __init__(self, stopword_file=STOPWORD_FILE, df=None, stem_cache_size=2 ** 16):
+        """Long-lived TF-IDF keyword extractor
+        Stopwords, the stemmer and the document frequency table are built
+        once and kept for all the texts.
+        Args:
+            stopword_file: path of stopword_file
+            df: an instance of DocumentFrequency, e.g. DocumentFrequency.load(path)
+            stem_cache_size: the stems of the most recent words are memoized
+        """
+        self.stopwords = get_stopwords(stopword_file=stopword_file)
+        self.df = df if df is not None else DocumentFrequency()
+        self._stem = lru_cache(maxsize=stem_cache_size)(PorterStemmer().stem)
+        self._remove_punctuation_map = dict((ord(char), None) for char in string.punctuation)
+
+    def count_term(self, text):
+        """Word frequency after cleaning, the same as PreProcessing.count_term"""
+        count = Counter()
+        for sen in nltk.sent_tokenize(text.lower()):
+            for w in nltk.word_tokenize(sen.translate(self._remove_punctuation_map)):
+                if w not in self.stopwords:
+                    count[self._stem(w)] += 1
+        return count
+
+    def add_document(self, text):
+        """Update the document frequency with `text`"""
+        count = self.count_term(text)
+        self.df.add_document(count)
+        return count
+
+    def get_keywords(self, text, topk=10, update=True):
+        """Get tfidf of text's top k keywords
+        Args:
+            text: string of text
+            topk: k words after sorting
+            update: count `text` into the document frequency first
+        Returns:
+            a dict (keyword, TFIDF) of text's topk keywords
+        """
+        if update:
+            count = self.add_document(text)
+        else:
+            count = self.count_term(text)
+        total = sum(count.values())
+        # the same idf as CalculateTFIDF
+        log_n = math.log(self.df.n_docs) if self.df.n_docs else 0.0
+        scores = dict((word, c / total * log_n / (1 + self.df[word])) for word, c in count.items())
+        sorted_words = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        return dict(sorted_words[:topk])
+
+    def save(self, path):
+        self.df.save(path)
+
+
+_default_extractor = None
+
+
+def get_default_extractor(df_path=None):
+    """The TfidfExtractor shared by the process, with the document frequency of `df_path` if it exists
+    The document frequency is saved back to `df_path` at exit, see save_default_extractor,
+    the documents of every worker process are added up in the saved table.
+    """
+    global _default_extractor
+    if _default_extractor is None:
+        df = None
+        if df_path and os.path.exists(os.path.join(df_path, 'meta.json')):
+            df = DocumentFrequency.load(df_path)
+        _default_extractor = TfidfExtractor(df=df)
+        if df_path:
+            atexit.register(save_default_extractor, df_path)
+    return _default_extractor
+
+
+def save_default_extractor(df_path):
+    """Save the document frequency of the shared TfidfExtractor, if the process made one
+    Returns:
+        True if it was saved
+    """
+    if _default_extractor is None or not df_path:
+        return False
+    _default_extractor.save(df_path)
+    return True
+
+
 def get_keywords_tfidf(text, stopword_file=None, corpus=None, topk=10):
     """Get tfidf of text's top k keywords
     Args:
@@ -131,7 +316,7 @@ def get_keywords_tfidf(text, stopword_file=None, corpus=None, topk=10):
         a dict (keyword, TFIDF) of text's topk keywords
     """
     if not stopword_file:
-        stopword_file = os.path.join(os.path.abspath(__file__), 'stopwords_en.txt')
+        stopword_file = STOPWORD_FILE
     stopwords = get_stopwords(stopword_file=stopword_file)
     count = PreProcessing(text, stopwords).count_term()
     if corpus:
@@ -149,10 +334,18 @@ if __name__ == "__main__":
             "The Georgetown experiment in 1954 involved fully automatic translation of more than sixty Russian sentences into English. The authors claimed that within three or five years, machine translation would be a solved problem.[2] However, real progress was much slower, and after the ALPAC report in 1966, which found that ten-year-long research had failed to fulfill the expectations, funding for machine translation was dramatically reduced. Little further research in machine translation was conducted until the late 1980s, when the first statistical machine translation systems were developed." \
             "During the 1970s, many programmers began to write conceptual ontologies, which structured real-world information into computer-understandable data. Examples are MARGIE (Schank, 1975), SAM (Cullingford, 1978), PAM (Wilensky, 1978), TaleSpin (Meehan, 1976), QUALM (Lehnert, 1977), Politics (Carbonell, 1979), and Plot Units (Lehnert 1981). During this time, many chatterbots were written including PARRY, Racter, and Jabberwacky。"
     import time
-    stopword_file = os.path.join(os.path.abspath(__file__), 'stopwords_en.txt')
-    s = time.clock()
+    stopword_file = STOPWORD_FILE
+    s = time.perf_counter()
     keywords = get_keywords_tfidf(text1, stopword_file)
     # keywords = get_keywords_tfidf(text1, stopword_file, corpus=text1)
-    e = time.clock()
+    e = time.perf_counter()
     print('抽取关键词耗时{}'.format(e - s))
+    print(keywords)
+
+    extractor = TfidfExtractor()
+    s = time.time()
+    for i in range(100):
+        keywords = extractor.get_keywords(text1)
+    e = time.time()
+    print('TfidfExtractor 抽取关键词耗时{}'.format((e - s) / 100))
     print(keywords)
\ No newline at end of file
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/24 15:10
+@File    : hashfunc.py
+@Desc    : token hash functions used by simhash
+"""
+
+import hashlib
+from collections import namedtuple
+from functools import lru_cache
+
+from setting import SHINGLE_HASH_CACHE_SIZE
+from extract_features.extract_features_participle import rolling_hash
+
+# version: stored with every fingerprint, fingerprints of different versions are never compared
+# hashbits: how many bits of the hash value are meaningful
+HashScheme = namedtuple('HashScheme', ['name', 'version', 'hashbits', 'func'])
+
+HASH_SCHEMES = {}
+
+FNV_OFFSET_BASIS_64 = 0xcbf29ce484222325
+FNV_PRIME_64 = 0x100000001b3
+MASK_64 = (1 << 64) - 1
+
+# scheme name -> lru_cache wrapped hash function, shared by every Simhash of the process
+_cached_hashfuncs = {}
+_cache_size = SHINGLE_HASH_CACHE_SIZE
+
+
+def register_hash_scheme(name, version, hashbits, func):
+    """Register a token hash function
+    Args:
+        name: name of the scheme
+        version: an unique int, 0 is kept for md5 which all the old fingerprints use
+        hashbits: the bits of the hash value
+        func: accepts a utf-8 encoded string and returns an unsigned integer,
+            must be a module level function so that it can be pickled
+    Returns:
+        an instance of HashScheme
+    """
+    for scheme in HASH_SCHEMES.values():
+        if scheme.version == version and scheme.name != name:
+            raise ValueError('Hash scheme version {} is used by {}'.format(version, scheme.name))
+    scheme = HashScheme(name, version, hashbits, func)
+    HASH_SCHEMES[name] = scheme
+    return scheme
+
+
+def get_hash_scheme(name):
+    try:
+        return HASH_SCHEMES[name]
+    except KeyError:
+        raise ValueError('Unknown hash scheme {}, choose from {}'.format(name, sorted(HASH_SCHEMES)))
+
+
+def get_cached_hashfunc(name):
+    """The hash function of scheme `name` behind a bounded LRU cache
+    News repeat the same shingles all the time, the cache keeps the hash of
+    the most recent `SHINGLE_HASH_CACHE_SIZE` of them, so the memory stays
+    flat however long the process runs.
+    """
+    try:
+        return _cached_hashfuncs[name]
+    except KeyError:
+        func = lru_cache(maxsize=_cache_size)(get_hash_scheme(name).func)
+        _cached_hashfuncs[name] = func
+        return func
+
+
+def set_cache_size(maxsize):
+    """Change the size of the shingle hash caches, the cached values are dropped"""
+    global _cache_size
+    _cache_size = maxsize
+    _cached_hashfuncs.clear()
+
+
+def cache_info(name='md5'):
+    """hits, misses, maxsize and currsize of the shingle hash cache of scheme `name`"""
+    return get_cached_hashfunc(name).cache_info()
+
+
+def md5_hash(x):
+    # the same value as int(hashlib.md5(x).hexdigest(), 16) without the hex string
+    return int.from_bytes(hashlib.md5(x).digest(), 'big')
+
+
+def blake2b_hash(x):
+    return int.from_bytes(hashlib.blake2b(x, digest_size=8).digest(), 'little')
+
+
+def fnv1a_hash(x):
+    h = FNV_OFFSET_BASIS_64
+    for byte in bytearray(x):
+        h = ((h ^ byte) * FNV_PRIME_64) & MASK_64
+    return h
+
+
+register_hash_scheme('md5', 0, 128, md5_hash)
+register_hash_scheme('blake2b', 1, 64, blake2b_hash)
+register_hash_scheme('fnv1a', 2, 64, fnv1a_hash)
+# texts are shingled by Participle.get_text_hashes without creating the shingle strings
+register_hash_scheme('rolling', 3, 64, rolling_hash)
+
+
+def benchmark(text, repeat=20):
+    """Compare the hash schemes on the shingles of `text`
+    Returns:
+        a dict of scheme name -> (seconds per article of hashing, seconds per article of Simhash)
+    """
+    import time
+    from extract_features.extract_features_participle import Participle
+    from fingerprints_calculation.simhash import Simhash
+
+    shingles = [f.encode('utf-8') for f in Participle().get_text_feature(text)]
+    result = {}
+    for name in sorted(HASH_SCHEMES, key=lambda n: HASH_SCHEMES[n].version):
+        func = HASH_SCHEMES[name].func
+        s1 = time.time()
+        for _ in range(repeat):
+            for shingle in shingles:
+                func(shingle)
+        s2 = time.time()
+        for _ in range(repeat):
+            Simhash(text, hash_scheme=name)
+        s3 = time.time()
+        result[name] = ((s2 - s1) / repeat, (s3 - s2) / repeat)
+    return result
+
+
+if __name__ == '__main__':
+    text1 = "Natural language processing (NLP) is a field of computer science, artificial intelligence and computational linguistics concerned with the interactions between computers and human (natural) languages, and, in particular, concerned with programming computers to fruitfully process large natural language corpora. Challenges in natural language processing frequently involve natural language understanding, natural language generation (frequently from formal, machine-readable logical forms), connecting language and machine perception, managing human-computer dialog systems, or some combination thereof." \
+            "The Georgetown experiment in 1954 involved fully automatic translation of more than sixty Russian sentences into English. The authors claimed that within three or five years, machine translation would be a solved problem.[2] However, real progress was much slower, and after the ALPAC report in 1966, which found that ten-year-long research had failed to fulfill the expectations, funding for machine translation was dramatically reduced. Little further research in machine translation was conducted until the late 1980s, when the first statistical machine translation systems were developed."
+    for name, (hash_time, simhash_time) in benchmark(text1 * 5).items():
+        print('{:8} hash {:.6f}s/article  simhash {:.6f}s/article'.format(name, hash_time, simhash_time))
@@ -11,11 +11,23 @@ from __future__ import division, unicode_literals
 
 import re
 import sys
-import hashlib
 import logging
 import numbers
-import collections
-from extract_features.extract_features_participle import Participle
+from itertools import islice
+from multiprocessing import Pool
+from extract_features.extract_features_participle import Participle, ShingleHashes
+from fingerprints_calculation.hashfunc import get_hash_scheme, get_cached_hashfunc, md5_hash
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from collections.abc import Iterable
+except ImportError:
+    # fallback for Python 2
+    from collections import Iterable
 
 if sys.version_info[0] >= 3:  # python3
     basestring = str
@@ -29,7 +41,8 @@ else:  # python2
 class Simhash(object):
 
     def __init__(
-            self, value, hashbits=64, reg=r'[\w]+', hashfunc=None, log=None):
+            self, value, hashbits=64, reg=r'[\w]+', hashfunc=None, log=None, backend='auto',
+            hash_scheme='md5', cache=True, max_features=None, strip_html=False):
         """Generate fingerprint of the content
         Args:
             value: content of text
@@ -40,16 +53,45 @@ class Simhash(object):
                 is to specify reg=re.compile(r'\w', re.UNICODE))
             hashfunc: accepts a utf-8 encoded string and returns a unsigned
                 integer in at least `hashbits` bits.
+            backend: how the weighted bit columns are accumulated, 'python'
+                loops over every bit of every token, 'numpy' builds a token x
+                bit matrix and sums the columns at once, 'auto' picks numpy
+                when it is installed and `hashbits` fits into uint64.
+                Both backends give the same fingerprint.
+            hash_scheme: name of a registered token hash function, see
+                fingerprints_calculation.hashfunc. Its version is kept in
+                `hash_version` so that fingerprints of different schemes are
+                never compared. If `hashfunc` is given too, it is used with
+                the version of `hash_scheme`.
+            cache: look the shingle hashes up in the LRU cache shared by all
+                Simhash of the process, see hashfunc.get_cached_hashfunc
+            max_features: is meaningful only when `value` is basestring, keep
+                at most this many shingles, see Participle
+            strip_html: is meaningful only when `value` is basestring, drop
+                the html tags and entities first, see Participle
         Returns:
             the fingerprint of value
         """
 
         self.hashbits = hashbits
         self.reg = reg
+        self.max_features = max_features
+        self.strip_html = strip_html
         self.fingerprint = None
 
+        scheme = get_hash_scheme(hash_scheme)
+        assert hashbits <= scheme.hashbits
+        self.hash_scheme = scheme.name
+        self.hash_version = scheme.version
+
+        if backend == 'auto':
+            backend = 'numpy' if np is not None and hashbits <= 64 else 'python'
+        elif backend == 'numpy' and (np is None or hashbits > 64):
+            raise ValueError('numpy backend needs numpy installed and hashbits <= 64')
+        self.backend = backend
+
         if hashfunc is None:
-            self.hashfunc = self._hashfunc
+            self.hashfunc = get_cached_hashfunc(scheme.name) if cache else scheme.func
         else:
             self.hashfunc = hashfunc
 
@@ -60,12 +102,16 @@ class Simhash(object):
 
         if isinstance(value, Simhash):
             self.fingerprint = value.fingerprint
+            self.hash_scheme = value.hash_scheme
+            self.hash_version = value.hash_version
         elif isinstance(value, basestring):
             self.build_by_text(unicode(value))
-        elif isinstance(value, collections.Iterable):
+        elif isinstance(value, ShingleHashes):
+            self.build_by_hashes(*value)
+        elif isinstance(value, Iterable):
             self.build_by_features(value)
         elif isinstance(value, numbers.Integral):
-            self.fingerprint = value
+            self.fingerprint = int(value)
         else:
             self.log.warning('Bad parameter with type {}'.format(type(value)))
 
@@ -76,16 +122,19 @@ class Simhash(object):
                        will be assumed), a list of (token, weight) tuples or
                        a token -> weight dict.
         """
-        v = [0] * self.hashbits
-        masks = [1 << i for i in range(self.hashbits)]
         if isinstance(features, dict):
             features = features.items()
+        if self.backend == 'numpy':
+            return self._build_by_features_numpy(features)
+
+        v = [0] * self.hashbits
+        masks = [1 << i for i in range(self.hashbits)]
         for f in features:
             if isinstance(f, basestring):
                 h = self.hashfunc(f.encode('utf-8'))
                 w = 1
             else:
-                assert isinstance(f, collections.Iterable)
+                assert isinstance(f, Iterable)
                 h = self.hashfunc(f[0].encode('utf-8'))
                 w = f[1]
             for i in range(self.hashbits):
@@ -97,14 +146,110 @@ class Simhash(object):
         #         _fingerprint += 1 << i
         self.fingerprint = _fingerprint
 
+    def _build_by_features_numpy(self, features):
+        """Vectorized version of `build_by_features`
+        The low `hashbits` bits of every token hash are unpacked into a
+        (tokens x hashbits) 0/1 matrix, the weights of the tokens having the
+        bit set are summed per column, and bit i of the fingerprint is set
+        when that sum is more than half of the total weight, which is the same
+        as `sum(w if bit else -w) > 0` in the pure python loop.
+        """
+        hashes = []
+        weights = []
+        mask = (1 << self.hashbits) - 1
+        for f in features:
+            if isinstance(f, basestring):
+                hashes.append(self.hashfunc(f.encode('utf-8')) & mask)
+                weights.append(1)
+            else:
+                assert isinstance(f, Iterable)
+                hashes.append(self.hashfunc(f[0].encode('utf-8')) & mask)
+                weights.append(f[1])
+        self.fingerprint = accumulate_fingerprint(
+            np.array(hashes, dtype=np.uint64), np.array(weights), self.hashbits)
+
+    def build_by_hashes(self, hashes, weights):
+        """
+        Args:
+            hashes: the hash values of the tokens, e.g. from Participle.get_text_hashes
+            weights: the weight of every hash
+        """
+        if self.backend == 'numpy':
+            mask = np.uint64((1 << self.hashbits) - 1)
+            self.fingerprint = accumulate_fingerprint(
+                np.asarray(hashes, dtype=np.uint64) & mask, np.asarray(weights), self.hashbits)
+            return
+
+        v = [0] * self.hashbits
+        masks = [1 << i for i in range(self.hashbits)]
+        for h, w in zip(hashes, weights):
+            h = int(h)
+            for i in range(self.hashbits):
+                v[i] += w if h & masks[i] else -w
+        _fingerprint = 0
+        for i in range(self.hashbits):
+            if v[i] > 0:
+                _fingerprint |= masks[i]
+        self.fingerprint = _fingerprint
+
     def build_by_text(self, content):
-        features = Participle().get_text_feature(content)
+        participle = Participle(max_features=self.max_features, strip_html=self.strip_html)
+        if self.hash_scheme == 'rolling':
+            return self.build_by_hashes(*participle.get_text_hashes(content))
+        features = participle.get_text_feature(content)
         # features = {k: sum(1 for _ in g) for k, g in groupby(sorted(features))}
         return self.build_by_features(features)
 
+    @classmethod
+    def build_many(cls, objs, hashbits=64, hashfunc=None, chunksize=1000, processes=None,
+                   hash_scheme='md5', cache=True, max_features=None, strip_html=False):
+        """Generate fingerprints of many documents in one batch
+        All token hashes of a chunk of documents are accumulated together
+        with numpy instead of creating a Simhash object per document.
+        Args:
+            objs: an iterable of (obj_id, value), value is a text or a
+                token -> weight dict
+            hashbits: the dimensions of fingerprint, at most 64
+            hashfunc: the same with the one for Simhash, must be picklable
+                when `processes` is given
+            chunksize: how many documents are accumulated at once
+            processes: fan the chunks out to a process pool of this size
+            hash_scheme: the same with the one for Simhash
+            cache: the same with the one for Simhash
+            max_features: the same with the one for Simhash
+            strip_html: the same with the one for Simhash
+        Returns:
+            (obj_ids, fingerprints), a list of obj_id and a uint64 numpy
+            array of their fingerprints in the same order
+        """
+        if np is None or hashbits > 64:
+            raise ValueError('build_many needs numpy installed and hashbits <= 64')
+        if hashfunc is None and not cache:
+            hashfunc = get_hash_scheme(hash_scheme).func
+
+        objs = iter(objs)
+        chunks = iter(lambda: list(islice(objs, chunksize)), [])
+        args = ((chunk, hashbits, hashfunc, hash_scheme, max_features, strip_html) for chunk in chunks)
+        if processes:
+            pool = Pool(processes)
+            try:
+                results = pool.map(_build_chunk, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_build_chunk(arg) for arg in args]
+
+        obj_ids = [obj_id for ids, _ in results for obj_id in ids]
+        if results:
+            fingerprints = np.concatenate([fps for _, fps in results])
+        else:
+            fingerprints = np.zeros(0, dtype=np.uint64)
+        return obj_ids, fingerprints
+
     def _hashfunc(self, x):
         # Generate hash value with hashlib.md5
-        return int(hashlib.md5(x).hexdigest(), 16)
+        return md5_hash(x)
 
     def _hashfunc_builtin(self, x):
         # Generate hash value with builtin function hash
@@ -112,8 +257,88 @@ class Simhash(object):
         return hashcode
 
 
+def _build_chunk(args):
+    """Fingerprint one chunk of `Simhash.build_many`, runs in the pool workers"""
+    objs, hashbits, hashfunc, hash_scheme, max_features, strip_html = args
+    if hashfunc is None:
+        # the cache of the worker process
+        hashfunc = get_cached_hashfunc(hash_scheme)
+    participle = Participle(max_features=max_features, strip_html=strip_html)
+    mask = (1 << hashbits) - 1
+    obj_ids = []
+    hashes = []
+    weights = []
+    doc_index = []
+    for i, (obj_id, value) in enumerate(objs):
+        obj_ids.append(obj_id)
+        if isinstance(value, basestring) and hash_scheme == 'rolling':
+            value = participle.get_text_hashes(unicode(value))
+        elif isinstance(value, basestring):
+            value = participle.get_text_feature(unicode(value))
+        if isinstance(value, ShingleHashes):
+            hashes.extend(int(h) & mask for h in value.hashes)
+            weights.extend(value.counts)
+            doc_index.extend([i] * len(value.counts))
+            continue
+        for token, weight in value.items():
+            hashes.append(hashfunc(token.encode('utf-8')) & mask)
+            weights.append(weight)
+            doc_index.append(i)
+    fingerprints = accumulate_fingerprints(
+        np.array(hashes, dtype=np.uint64), np.array(weights, dtype=np.float64),
+        np.array(doc_index, dtype=np.intp), len(obj_ids), hashbits)
+    return obj_ids, fingerprints
+
+
+def accumulate_fingerprints(hashes, weights, doc_index, count, hashbits=64):
+    """Simhash accumulation of many documents over numpy arrays
+    Args:
+        hashes: uint64 array of the token hashes of all documents
+        weights: float array of token weights, the same length as `hashes`
+        doc_index: int array, which document every token belongs to
+        count: the number of documents
+        hashbits: the dimensions of fingerprint, at most 64
+    Returns:
+        uint64 array of `count` fingerprints
+    """
+    fingerprints = np.zeros(count, dtype=np.uint64)
+    one = np.uint64(1)
+    for i in range(hashbits):
+        bit = (hashes >> np.uint64(i)) & one
+        # bincount adds the tokens of every document in order, the same as
+        # `v[i] += w if h & masks[i] else -w` in build_by_features
+        v = np.bincount(doc_index, weights=np.where(bit, weights, -weights), minlength=count)
+        fingerprints |= (v > 0).astype(np.uint64) << np.uint64(i)
+    return fingerprints
 
 
+def accumulate_fingerprint(hashes, weights, hashbits=64):
+    """Simhash accumulation over numpy arrays
+    Args:
+        hashes: uint64 array of token hashes, only the low `hashbits` bits are used
+        weights: array of token weights, the same length as `hashes`
+        hashbits: the dimensions of fingerprint, at most 64
+    Returns:
+        the fingerprint as a python int
+    """
+    if not len(hashes):
+        return 0
+    # little-endian bytes -> bits so that column i is bit i of the hash
+    octets = hashes.astype('<u8').view(np.uint8).reshape(-1, 8)
+    bits = np.unpackbits(octets, axis=1, bitorder='little')[:, :hashbits]
+    if weights.dtype.kind in 'biu':
+        # integer weights are summed exactly
+        weights = weights.astype(np.int64)
+        positive = weights.dot(bits.astype(np.int64))
+        v = 2 * positive - weights.sum()
+    else:
+        # float weights are summed row by row, in the same order as the
+        # python loop, so the rounding is the same as well
+        weights = weights.astype(np.float64)[:, None]
+        v = np.where(bits, weights, -weights).sum(axis=0)
+    packed = np.packbits(v > 0, bitorder='little')
+    return int.from_bytes(packed.tobytes(), 'little')
+
 
 if __name__ == '__main__':
     str1 = {'hello': 3, 'world': 4, 'fine': 5, 'new': 2, 'text': 3}
@@ -122,4 +347,17 @@ if __name__ == '__main__':
     print(bin(int(Simhash(str2).fingerprint)))
     print(isinstance(Simhash(str2), Simhash))
     import os
-    print(os.path.dirname(os.path.abspath(__file__)))
\ No newline at end of file
+    print(os.path.dirname(os.path.abspath(__file__)))
+
+    import time
+    text = ' '.join(str(i) + ' natural language processing' for i in range(2000))
+    for backend in ('python', 'numpy'):
+        s1 = time.time()
+        for _ in range(10):
+            fingerprint = Simhash(text, backend=backend).fingerprint
+        s2 = time.time()
+        print('{} backend: {:x} {:.4f}s/article'.format(backend, fingerprint, (s2 - s1) / 10))
+    s1 = time.time()
+    _, fingerprints = Simhash.build_many((i, text) for i in range(10))
+    s2 = time.time()
+    print('build_many: {:x} {:.4f}s/article'.format(int(fingerprints[-1]), (s2 - s1) / 10))
\ No newline at end of file
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/31 15:40
+@File    : bulk_load.py
+@Desc    : read (obj_id, fingerprint) arrays in bulk to build an index
+"""
+
+import logging
+import time
+
+import numpy as np
+
+
+def parse_members(members):
+    """Parse `'{:x},{}'.format(fingerprint, obj_id)` members, the format of the
+    redis members and of SimhashInvertedIndex.simhash_value_obj_id
+    Returns:
+        (a list of obj_id, uint64 array of fingerprints)
+    """
+    obj_ids = []
+    fingerprints = []
+    for member in members:
+        if isinstance(member, bytes):
+            member = member.decode()
+        try:
+            sim, obj_id = member.split(',', 1)
+            fingerprints.append(int(sim, 16))
+        except ValueError:
+            logging.warning('Not a member %s', member)
+            continue
+        obj_ids.append(obj_id)
+    return obj_ids, np.array(fingerprints, dtype=np.uint64)
+
+
+def _concatenate(chunks):
+    obj_ids = []
+    fingerprints = []
+    for chunk_obj_ids, chunk_fingerprints in chunks:
+        obj_ids.extend(chunk_obj_ids)
+        fingerprints.append(chunk_fingerprints)
+    if not fingerprints:
+        return obj_ids, np.empty(0, dtype=np.uint64)
+    return obj_ids, np.concatenate(fingerprints)
+
+
+def load_members_file(filepath, chunksize=10 ** 6):
+    """Read a file of one member per line
+    Returns:
+        (a list of obj_id, uint64 array of fingerprints)
+    """
+    def chunks():
+        with open(filepath, 'r', encoding='utf-8') as f:
+            lines = []
+            for line in f:
+                line = line.strip()
+                if line:
+                    lines.append(line)
+                if len(lines) >= chunksize:
+                    yield parse_members(lines)
+                    lines = []
+            if lines:
+                yield parse_members(lines)
+
+    return _concatenate(chunks())
+
+
+def load_members_mongo(simhashinvertedindex, hash_version=0, batch_size=10000, chunksize=10 ** 6):
+    """Read the fingerprints of a hash scheme stored in mongodb
+    Every fingerprint is stored once per block, only the documents of the
+    first block are read so that each of them comes once.
+    Args:
+        simhashinvertedindex: the SimhashInvertedIndex document class
+        hash_version: version of the hash scheme
+    Returns:
+        (a list of obj_id, uint64 array of fingerprints)
+    """
+    suffix = ':0' if not hash_version else ':0:v{}'.format(hash_version)
+    # the raw pymongo cursor, no Document object for every row
+    cursor = simhashinvertedindex._get_collection().find(
+        {'key': {'$regex': '^[0-9a-f]+{}$'.format(suffix)}},
+        {'simhash_value_obj_id': 1, '_id': 0},
+        batch_size=batch_size)
+
+    def chunks():
+        members = []
+        for record in cursor:
+            members.append(record['simhash_value_obj_id'])
+            if len(members) >= chunksize:
+                yield parse_members(members)
+                members = []
+        if members:
+            yield parse_members(members)
+
+    return _concatenate(chunks())
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import tempfile
+    from fingerprints_storage.simhash_index import SimhashIndex
+    from fingerprints_storage.simhash_index_array import SimhashArrayIndex
+    from fingerprints_storage.obj_id_table import ObjIdTable
+
+    count = 10 ** 6
+    filepath = os.path.join(tempfile.mkdtemp(), 'members')
+    with open(filepath, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            f.write('{:x},{}\n'.format(random.getrandbits(64), 1500000000000000 + i))
+
+    s1 = time.time()
+    obj_ids, fingerprints = load_members_file(filepath)
+    s2 = time.time()
+    array_index = SimhashArrayIndex.from_arrays(fingerprints, obj_ids, obj_id_table=ObjIdTable())
+    s3 = time.time()
+    dict_index = SimhashIndex.from_arrays(obj_ids, fingerprints)
+    s4 = time.time()
+    print('读取{}条耗时{:.3f}s 排序建立数组索引耗时{:.3f}s 排序建立字典索引耗时{:.3f}s'.format(
+        count, s2 - s1, s3 - s2, s4 - s3))
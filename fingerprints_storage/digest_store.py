@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/4 11:05
+@File    : digest_store.py
+@Desc    : exact duplicates found by a digest of the normalized text
+"""
+
+import hashlib
+from collections import OrderedDict
+
+from setting import SAVE_DAYS, DIGEST_CACHE_SIZE
+from extract_features.clean_html import normalize_text
+
+
+def text_digest(text):
+    """Digest of the text Participle cuts into shingles
+    Two articles with the same digest have the same shingles, so the same
+    fingerprint. None for a text without any word.
+    """
+    text = normalize_text(text)
+    if not text:
+        return None
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class DigestStore(object):
+
+    def __init__(self, redis=None, cache_size=DIGEST_CACHE_SIZE, name='digest', save_days=SAVE_DAYS):
+        """digest -> obj_id of the first article with that digest
+        Args:
+            redis: an instance of SimhashRedis to share the digests between
+                processes, None keeps them in this process only
+            cache_size: entries of the local LRU cache
+            name: prefix of the redis keys, `name:<digest>`
+            save_days: the redis keys expire after that, like the fingerprints
+        """
+        self.redis = redis
+        self.cache_size = cache_size
+        self.name = name
+        self.expire = save_days * 3600 * 24
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _format_key(self, digest):
+        return '{}:{}'.format(self.name, digest)
+
+    def _cache(self, digest, obj_id):
+        self.cache[digest] = obj_id
+        self.cache.move_to_end(digest)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get(self, digest):
+        """The obj_id stored for the digest, None if there is none"""
+        try:
+            obj_id = self.cache[digest]
+            self.cache.move_to_end(digest)
+            return obj_id
+        except KeyError:
+            pass
+        if self.redis is None:
+            return None
+        obj_id = self.redis.get(self._format_key(digest))
+        if obj_id is None:
+            return None
+        obj_id = obj_id.decode() if isinstance(obj_id, bytes) else obj_id
+        self._cache(digest, obj_id)
+        return obj_id
+
+    def check(self, digest, obj_id):
+        """The obj_id of an earlier article with the digest, or store obj_id
+        for it and return None
+        """
+        if digest is None:
+            return None
+        first = self.get(digest)
+        if first is None and self.redis is not None:
+            # another process may have stored the digest meanwhile
+            if not self.redis.set(self._format_key(digest), obj_id, ex=self.expire, nx=True):
+                first = self.get(digest)
+        if first is None:
+            self._cache(digest, obj_id)
+            self.misses += 1
+        else:
+            self.hits += 1
+        return first
+
+    def clear(self):
+        """Drop the local cache, must be called after the redis db is flushed"""
+        self.cache.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self.cache)
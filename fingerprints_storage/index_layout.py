@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/28 10:15
+@File    : index_layout.py
+@Desc    : choose the blocks and tables of a simhash index for a distance
+"""
+
+import math
+from itertools import combinations
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# a layout is only considered if it has at most this many tables
+MAX_TABLES = 64
+# rough bytes of one entry of one table, `'{:x},{}'` member of a redis sorted set
+BYTES_PER_ENTRY = 80
+
+
+class IndexLayout(object):
+
+    def __init__(self, hashbits=64, distance=3, blocks=4, key_blocks=1):
+        """Where fingerprints are put and looked up for a distance
+        The fingerprint is cut into `blocks` blocks, every table is keyed by
+        `key_blocks` of them. If two fingerprints are within `distance`, the
+        errors spread at most evenly over the blocks, so in some table the keys
+        differ in no more than `radius` bits. A query probes every key of every
+        table within `radius` of its own, which guarantees full recall:
+            blocks > distance, key_blocks = blocks - distance, radius 0: Manku et al.
+            key_blocks 1, radius distance // blocks: multi-index hashing
+        Args:
+            hashbits: the same with the one for Simhash
+            distance: the largest distance which must be found
+            blocks: number of blocks
+            key_blocks: number of blocks in the key of a table
+        """
+        assert 1 <= key_blocks <= blocks <= hashbits
+        self.hashbits = hashbits
+        self.distance = distance
+        self.blocks = blocks
+        self.key_blocks = key_blocks
+        # the same offsets as the original k + 1 blocks for blocks = k + 1
+        self.offsets = [hashbits // blocks * i for i in range(blocks)]
+        self.widths = [b - a for a, b in zip(self.offsets, self.offsets[1:] + [hashbits])]
+        self.tables = list(combinations(range(blocks), key_blocks))
+        self.radius = self.required_radius(distance, blocks, key_blocks)
+
+    @staticmethod
+    def required_radius(distance, blocks, key_blocks):
+        """The most errors the best table can have, when `distance` errors are
+        spread evenly over `blocks` blocks"""
+        q, rem = divmod(distance, blocks)
+        return key_blocks * q + max(0, key_blocks - (blocks - rem))
+
+    def key_bits(self, table):
+        return sum(self.widths[b] for b in self.tables[table])
+
+    def block(self, fingerprint, b):
+        return fingerprint >> self.offsets[b] & ((1 << self.widths[b]) - 1)
+
+    def keys(self, fingerprint):
+        """(table number, key) of the fingerprint in every table
+        With one block per table the key is the block itself, so that the keys
+        of the 4 blocks layout are the same as the ones stored before.
+        """
+        for i, table in enumerate(self.tables):
+            c = 0
+            for b in table:
+                c = c << self.widths[b] | self.block(fingerprint, b)
+            yield i, c
+
+    def table_keys(self, fingerprints, table):
+        """The keys of `table` for an uint64 array of fingerprints, see keys"""
+        c = None
+        for b in self.tables[table]:
+            block = fingerprints >> np.uint64(self.offsets[b]) & np.uint64((1 << self.widths[b]) - 1)
+            c = block if c is None else c << np.uint64(self.widths[b]) | block
+        return c
+
+    def probe_masks(self, table):
+        """The bits to flip in a key of `table`, every flip within the radius, none first"""
+        bits = self.key_bits(table)
+        for r in range(min(self.radius, bits) + 1):
+            for positions in combinations(range(bits), r):
+                m = 0
+                for p in positions:
+                    m |= 1 << p
+                yield m
+
+    def probe_keys(self, fingerprint):
+        """(table number, key) to look up for the fingerprint"""
+        for i, c in self.keys(fingerprint):
+            for m in self.probe_masks(i):
+                yield i, c ^ m
+
+    def sub_keys(self, fingerprint, table):
+        """(sub-block number, value) to split a hot bucket of `table` on
+        The bits outside the key of the table are cut into distance + 1
+        sub-blocks. The rest of two fingerprints within distance differ in
+        no more than distance bits, so they share at least one sub-block.
+        """
+        rest = bits = 0
+        for b in range(self.blocks):
+            if b not in self.tables[table]:
+                rest = rest << self.widths[b] | self.block(fingerprint, b)
+                bits += self.widths[b]
+        parts = min(self.distance + 1, bits)
+        offsets = [bits // parts * j for j in range(parts)] + [bits] if parts else []
+        for j in range(parts):
+            yield j, rest >> offsets[j] & ((1 << (offsets[j + 1] - offsets[j])) - 1)
+
+    def probes_per_table(self, table=0):
+        bits = self.key_bits(table)
+        return sum(_comb(bits, r) for r in range(min(self.radius, bits) + 1))
+
+    def cost(self, n, bytes_per_entry=BYTES_PER_ENTRY):
+        """Expected cost of a query against `n` uniformly spread fingerprints
+        Returns:
+            a dict of tables, probes (keys looked up), candidates (fingerprints
+            compared) and nbytes (memory of all the tables)
+        """
+        probes = 0
+        candidates = 0.0
+        for i in range(len(self.tables)):
+            p = self.probes_per_table(i)
+            probes += p
+            candidates += p * n / 2.0 ** self.key_bits(i)
+        return {'tables': len(self.tables),
+                'probes': probes,
+                'candidates': candidates,
+                'nbytes': len(self.tables) * n * bytes_per_entry}
+
+    def __repr__(self):
+        return 'IndexLayout(hashbits={}, distance={}, blocks={}, key_blocks={}, radius={}, tables={})'.format(
+            self.hashbits, self.distance, self.blocks, self.key_blocks, self.radius, len(self.tables))
+
+
+def _comb(n, r):
+    return math.factorial(n) // math.factorial(r) // math.factorial(n - r)
+
+
+def plan_layout(hashbits=64, distance=3, n=10 ** 6, blocks=None, key_blocks=None, max_tables=MAX_TABLES,
+                max_bytes=None, probe_cost=1.0, candidate_cost=0.05, bytes_per_entry=BYTES_PER_ENTRY,
+                max_radius=None):
+    """The cheapest layout with full recall at `distance`
+    Args:
+        hashbits: the same with the one for Simhash
+        distance: the largest distance which must be found
+        n: expected number of fingerprints in the index
+        blocks: keep the number of blocks, e.g. k + 1 to reuse the stored keys
+        key_blocks: keep the number of blocks of a key
+        max_tables: the most tables allowed
+        max_bytes: the most memory allowed, None for no limit
+        probe_cost: cost of looking a key up
+        candidate_cost: cost of comparing a fingerprint
+        bytes_per_entry: memory of one entry of one table
+        max_radius: the largest radius allowed, 0 for the layouts which only
+            look keys up exactly, e.g. for self_join
+    Returns:
+        an instance of IndexLayout, its `cost(n)` tells the probes, candidates and memory
+    """
+    best = None
+    best_cost = None
+    for m in ([blocks] if blocks else range(1, min(hashbits, 2 * distance + 2) + 1)):
+        for t in ([key_blocks] if key_blocks else range(1, m + 1)):
+            if t > m or _comb(m, t) > max_tables:
+                continue
+            layout = IndexLayout(hashbits, distance, m, t)
+            if max_radius is not None and layout.radius > max_radius:
+                continue
+            # probing more than a few thousand keys is never worth it
+            if layout.probes_per_table() * len(layout.tables) > 4096:
+                continue
+            cost = layout.cost(n, bytes_per_entry)
+            if max_bytes is not None and cost['nbytes'] > max_bytes:
+                continue
+            c = cost['probes'] * probe_cost + cost['candidates'] * candidate_cost
+            if best_cost is None or c < best_cost:
+                best, best_cost = layout, c
+    if best is None:
+        raise ValueError('No layout for distance {} within {} tables and {} bytes'.format(distance, max_tables, max_bytes))
+    return best
+
+
+if __name__ == '__main__':
+    for d in range(1, 8):
+        legacy = plan_layout(64, d, blocks=4, key_blocks=1)
+        layout = plan_layout(64, d, n=10 ** 7)
+        for name, l in (('4 blocks', legacy), ('planned', layout)):
+            cost = l.cost(10 ** 7)
+            print('distance:{} {:8} {} probes:{} candidates:{:.1f} memory:{:.1f}GB'.format(
+                d, name, l, cost['probes'], cost['candidates'], cost['nbytes'] / 2.0 ** 30))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/8 15:30
+@File    : migrate_members.py
+@Desc    : convert the members stored in redis to the compact encoding, and back
+"""
+
+import logging
+import time
+
+from redis.exceptions import WatchError
+
+from fingerprints_storage.member_codec import compact_member, text_member, decode_member
+from fingerprints_storage.obj_id_table import RedisObjIdTable
+
+
+def migrate_members(redis, obj_id_table=None, pattern='*', compact=True, logger=None):
+    """Rewrite the members of every sorted set matching pattern
+    Each key is rewritten in one MULTI/EXEC, a reader sees it either before or
+    after, never both forms of a member at once. The key is WATCHed from the
+    read on, if another process writes it meanwhile it is read and rewritten
+    again, so a member removed in between is not brought back. The obj_ids of
+    the members written before interning are interned on the way.
+    Args:
+        redis: an instance of SimhashRedis
+        obj_id_table: an instance of RedisObjIdTable, the one of the index
+        pattern: the keys to convert, e.g. 's*' for the time segments
+        compact: False converts back to the text members
+    Returns:
+        a dict of keys, members, converted, member_bytes_before/after (the
+        length of the members) and memory_before/after (MEMORY USAGE of the
+        converted keys, None if the server does not tell)
+    """
+    log = logger if logger is not None else logging.getLogger("simhash")
+    if obj_id_table is None:
+        obj_id_table = RedisObjIdTable(redis)
+    encode = compact_member if compact else text_member
+    report = dict(keys=0, members=0, converted=0, member_bytes_before=0, member_bytes_after=0,
+                  memory_before=0, memory_after=0)
+    converted_keys = []
+    # the times of the interned obj_ids are a sorted set of ints, not of members
+    seen = getattr(obj_id_table, 'seen', None)
+    skipped = (seen, seen.encode()) if seen else ()
+    for name in redis.redis.scan_iter(match=pattern, count=1000):
+        # the obj_id tables and the digests are not sorted sets
+        if redis.redis.type(name) not in (b'zset', 'zset') or name in skipped:
+            continue
+        while True:
+            try:
+                key_report = _migrate_key(redis, name, obj_id_table, encode, log)
+                break
+            except WatchError:
+                # written meanwhile, read it again
+                log.debug('Key {} changed during the migration, retrying'.format(name))
+        report['keys'] += 1
+        for field in ('members', 'converted', 'member_bytes_before', 'member_bytes_after'):
+            report[field] += key_report[field]
+        if not key_report['converted']:
+            continue
+        if key_report['memory_before'] is None or key_report['memory_after'] is None:
+            report['memory_before'] = report['memory_after'] = None
+        elif report['memory_before'] is not None:
+            report['memory_before'] += key_report['memory_before']
+            report['memory_after'] += key_report['memory_after']
+        converted_keys.append(name)
+        if len(converted_keys) % 10000 == 0:
+            log.info('Migrated {} keys'.format(len(converted_keys)))
+    return report
+
+
+def _migrate_key(redis, name, obj_id_table, encode, log):
+    """Rewrite the members of one sorted set, WATCHed from the read to the EXEC
+    Raises:
+        WatchError: the key was written in between, nothing was changed
+    """
+    key_report = dict(members=0, converted=0, member_bytes_before=0, member_bytes_after=0,
+                      memory_before=None, memory_after=None)
+    pipe = redis.redis.pipeline(transaction=True)
+    try:
+        pipe.watch(name)
+        members = []
+        for v, score in pipe.zrange(name, 0, -1, withscores=True):
+            key_report['members'] += 1
+            try:
+                decoded = decode_member(v)
+            except (ValueError, UnicodeDecodeError) as e:
+                log.warning('Not a member {!r} of {} {}'.format(v, name, e))
+                continue
+            if decoded is None:
+                # the split marker
+                continue
+            members.append((v, score) + decoded)
+        # the members written before interning, their obj_ids interned at once
+        legacy = [(obj_id, score) for _, score, _, obj_id in members if not isinstance(obj_id, int)]
+        ns = iter(obj_id_table.intern_many([obj_id for obj_id, _ in legacy], [score for _, score in legacy]))
+        added = []
+        removed = []
+        for v, score, fingerprint, obj_id in members:
+            n = obj_id if isinstance(obj_id, int) else next(ns)
+            new = encode(fingerprint, n)
+            new_bytes = new if isinstance(new, bytes) else new.encode()
+            key_report['member_bytes_before'] += len(v)
+            key_report['member_bytes_after'] += len(new_bytes)
+            if new_bytes != v:
+                added.append((new, score))
+                removed.append(v)
+        if not removed:
+            return key_report
+        key_report['memory_before'] = redis.memory_usage([name])[0]
+        pipe.multi()
+        for v in removed:
+            pipe.zrem(name, v)
+        for v, score in added:
+            pipe.execute_command('ZADD', name, score, v)
+        pipe.execute()
+    finally:
+        pipe.reset()
+    key_report['memory_after'] = redis.memory_usage([name])[0]
+    key_report['converted'] = len(removed)
+    return key_report
+
+
+def format_report(report):
+    lines = ['有序集合{keys}个 成员{members}个 转换{converted}个'.format(**report)]
+    if report['members']:
+        lines.append('成员字节数 转换前:{} 转换后:{} 平均每个成员 {:.1f} -> {:.1f}'.format(
+            report['member_bytes_before'], report['member_bytes_after'],
+            report['member_bytes_before'] / report['members'], report['member_bytes_after'] / report['members']))
+    if report['memory_before'] is None:
+        lines.append('服务端不支持 MEMORY USAGE')
+    else:
+        lines.append('MEMORY USAGE 转换前:{:.1f}MB 转换后:{:.1f}MB'.format(
+            report['memory_before'] / 2.0 ** 20, report['memory_after'] / 2.0 ** 20))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+    from db.simhash_redis import SimhashRedis
+
+    pattern = sys.argv[1] if len(sys.argv) > 1 else '*'
+    s1 = time.time()
+    report = migrate_members(SimhashRedis(), pattern=pattern)
+    print(format_report(report))
+    print('耗时{:.1f}s'.format(time.time() - s1))
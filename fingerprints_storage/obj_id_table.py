@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/29 11:02
+@File    : obj_id_table.py
+@Desc    : map external obj_ids to dense ints
+"""
+
+import time
+
+# an interned obj_id in a redis member, '{:x},#{:x}'.format(fingerprint, n)
+INTERNED_PREFIX = '#'
+
+
+class ObjIdTable(object):
+
+    def __init__(self):
+        """obj_id -> int starting from 0, the index keeps the ints and gives
+        the obj_ids back only for the results
+        """
+        self.ids = []
+        self.index = {}
+
+    def intern(self, obj_id):
+        try:
+            return self.index[obj_id]
+        except KeyError:
+            n = len(self.ids)
+            self.ids.append(obj_id)
+            self.index[obj_id] = n
+            return n
+
+    def intern_many(self, obj_ids, add_times=None):
+        """The ints of a list of obj_ids, in a list
+        The add times are not kept, the obj_ids live as long as the table.
+        """
+        index = self.index
+        ids = self.ids
+        ns = []
+        for obj_id in obj_ids:
+            n = index.get(obj_id)
+            if n is None:
+                n = len(ids)
+                ids.append(obj_id)
+                index[obj_id] = n
+            ns.append(n)
+        return ns
+
+    def get(self, obj_id):
+        """The int of an obj_id, None if it has never been interned"""
+        return self.index.get(obj_id)
+
+    def lookup(self, n):
+        return self.ids[n]
+
+    def lookup_many(self, ns):
+        return [self.ids[n] for n in ns]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class RedisObjIdTable(object):
+
+    def __init__(self, redis, name='obj_id', cache_size=2 ** 17):
+        """An ObjIdTable shared by every process through two redis hashes
+        Args:
+            redis: an instance of SimhashRedis
+            name: prefix of the redis keys, `name:fwd` maps obj_id -> int,
+                `name:rev` int -> obj_id, `name:next` counts the ints and
+                `name:seen` scores every int by the last time it was written,
+                see expire
+            cache_size: entries of each local cache, they are dropped when full
+        """
+        self.redis = redis
+        self.fwd = name + ':fwd'
+        self.rev = name + ':rev'
+        self.next = name + ':next'
+        self.seen = name + ':seen'
+        self.names = [self.fwd, self.rev, self.next, self.seen]
+        self.cache_size = cache_size
+        self._ids = {}
+        self._index = {}
+
+    def clear(self):
+        """Drop the local caches, must be called after the redis db is flushed"""
+        self._index.clear()
+        self._ids.clear()
+
+    def _cache(self, obj_id, n):
+        if len(self._index) >= self.cache_size:
+            self.clear()
+        self._index[obj_id] = n
+        self._ids[n] = obj_id
+
+    def intern(self, obj_id, add_time=None):
+        return self.intern_many([obj_id], None if add_time is None else [add_time])[0]
+
+    def intern_many(self, obj_ids, add_times=None):
+        """The ints of a list of obj_ids in one atomic round trip
+        Every int is marked as written at its add time, now by default, so
+        that expire keeps it as long as its members. The cached obj_ids are
+        sent as well, their time has to move on.
+        """
+        if not obj_ids:
+            return []
+        if add_times is None:
+            add_times = [int(time.time())] * len(obj_ids)
+        ns = [int(n) for n in self.redis.intern_many(self.names, obj_ids, add_times)]
+        for obj_id, n in zip(obj_ids, ns):
+            self._cache(obj_id, n)
+        return ns
+
+    def expire(self, timeline, batch_size=1000):
+        """Forget the obj_ids last written at or before timeline, their
+        members are expired as well, batch_size of them in a call
+        Returns:
+            the number of obj_ids removed
+        """
+        removed = 0
+        while True:
+            count = self.redis.expire_ids(self.names, timeline, batch_size)
+            removed += count
+            if count < batch_size:
+                break
+        if removed:
+            self.clear()
+        return removed
+
+    def get(self, obj_id):
+        try:
+            return self._index[obj_id]
+        except KeyError:
+            n = self.redis.hget(self.fwd, obj_id)
+            if n is None:
+                return None
+            n = int(n)
+            self._cache(obj_id, n)
+            return n
+
+    def lookup(self, n):
+        return self.lookup_many([n])[0]
+
+    def lookup_many(self, ns):
+        """The obj_ids of the ints, the missing ones are fetched in one round trip"""
+        found = dict((n, self._ids[n]) for n in ns if n in self._ids)
+        missing = [n for n in ns if n not in found]
+        if missing:
+            for n, obj_id in zip(missing, self.redis.hmget(self.rev, missing)):
+                if obj_id is not None:
+                    obj_id = obj_id.decode() if isinstance(obj_id, bytes) else obj_id
+                    found[n] = obj_id
+                    self._cache(obj_id, n)
+        return [found.get(n) for n in ns]
+
+    def __len__(self):
+        return self.redis.hlen(self.fwd)
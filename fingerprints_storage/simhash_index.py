@@ -10,26 +10,53 @@
 import logging
 import time
 import collections
+import numpy as np
 from fingerprints_calculation.simhash import Simhash
-from similarity_calculation.hamming_distance import HammingDistance
+from setting import BUCKET_SPLIT_THRESHOLD
+from fingerprints_storage.index_layout import IndexLayout
+from fingerprints_storage.obj_id_table import ObjIdTable
+from fingerprints_storage.simhash_index_array import SimhashArrayIndex
+from similarity_calculation.hamming_distance import within_distance, collect_matches, sorted_matches
+
+
+# an int bucket key is block value << 16 | table number << 8 | hash version
+VERSION_MASK = 0xff
+TABLE_SHIFT = 8
+VALUE_SHIFT = 16
 
 
 class SimhashIndex(object):
 
-    def __init__(self, objs, hashbits=64, k=3):
+    def __init__(self, objs, hashbits=64, k=3, layout=None, split_threshold=BUCKET_SPLIT_THRESHOLD,
+                 obj_id_table=None):
         """
         Args:
             objs: a list of (obj_id, simhash)
                 obj_id is a string, simhash is an instance of Simhash or fingerprint of news
             hashbits: the same with the one for Simhash
             k: the tolerance
+            layout: an instance of IndexLayout, see plan_layout,
+                the default is k + 1 blocks looked up exactly
+            split_threshold: a bucket growing past it is split into sub-buckets
+                on the rest of the bits, None never splits
+            obj_id_table: an instance of ObjIdTable, the buckets keep its ints
         """
         self.k = k
         self.hashbits = hashbits
+        if layout is None:
+            layout = IndexLayout(hashbits, k, blocks=k + 1)
+        assert layout.hashbits == hashbits and layout.distance >= k
+        self.layout = layout
+        self.split_threshold = split_threshold
+        self.obj_id_table = obj_id_table if obj_id_table is not None else ObjIdTable()
         count = len(objs)
         logging.info('Initializing %s data.', count)
-        # Put the fingerprint in memory
-        self.bucket = collections.defaultdict(set)
+        # Put the fingerprint in memory, int key -> {interned obj_id: fingerprint}
+        self.bucket = collections.defaultdict(dict)
+        # sub-buckets of the split keys, (key, sub-block number, sub-block value) -> the same
+        self.sub_bucket = collections.defaultdict(dict)
+        # keys whose fingerprints have been moved to sub-buckets
+        self.split = set()
 
         for i, q in enumerate(objs):
             if i % 10000 == 0 or i == count - 1:
@@ -37,6 +64,36 @@ class SimhashIndex(object):
 
             self.add(*q)
 
+    @classmethod
+    def from_arrays(cls, obj_ids, fingerprints, hashbits=64, k=3, hash_version=0, **kwargs):
+        """Build the buckets with one sort per table instead of adding the objects one by one
+        Args:
+            obj_ids: a list of obj_id
+            fingerprints: uint64 array (or a list of int) in the same order
+            hash_version: version of the hash scheme of all the fingerprints
+            kwargs: the other arguments of SimhashIndex
+        """
+        index = cls([], hashbits=hashbits, k=k, **kwargs)
+        layout = index.layout
+        fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+        ns = np.array(index.obj_id_table.intern_many(obj_ids), dtype=np.int64)
+        logging.info('Building %s data.', len(fingerprints))
+        for i in range(len(layout.tables)):
+            c = layout.table_keys(fingerprints, i)
+            order = np.argsort(c, kind='mergesort')
+            c = c[order]
+            starts = np.flatnonzero(np.concatenate([[True], c[1:] != c[:-1]]))
+            ends = np.append(starts[1:], len(c))
+            sorted_ns = ns[order].tolist()
+            sorted_fingerprints = fingerprints[order].tolist()
+            for value, start, end in zip(c[starts].tolist(), starts.tolist(), ends.tolist()):
+                key = value << VALUE_SHIFT | i << TABLE_SHIFT | hash_version
+                index.bucket[key] = dict(zip(sorted_ns[start:end], sorted_fingerprints[start:end]))
+                if index.split_threshold and end - start > index.split_threshold:
+                    index._split(key, i)
+            logging.info('Table %s/%s built.', i + 1, len(layout.tables))
+        return index
+
     def add(self, obj_id, simhash):
         """Building an inverted index
         Args:
@@ -45,69 +102,142 @@ class SimhashIndex(object):
         """
         assert simhash.hashbits == self.hashbits
 
-        for key in self.get_keys(simhash):
-            v = '{:x},{}'.format(simhash.fingerprint, obj_id)
-            self.bucket.setdefault(key, set())
-            self.bucket[key].add(v)
+        n = self.obj_id_table.intern(obj_id)
+        for i, key in self._keys(simhash):
+            if key in self.split:
+                for sub_key in self.get_sub_keys(key, i, simhash.fingerprint):
+                    self.sub_bucket[sub_key][n] = simhash.fingerprint
+                continue
+            bucket = self.bucket[key]
+            bucket[n] = simhash.fingerprint
+            if self.split_threshold and len(bucket) > self.split_threshold:
+                self._split(key, i)
 
     def delete(self, obj_id, simhash):
         assert simhash.hashbits == self.hashbits
 
-        for key in self.get_keys(simhash):
-            v = '{:x},{}'.format(simhash.fingerprint, obj_id)
+        n = self.obj_id_table.get(obj_id)
+        if n is None:
+            return
+        for i, key in self._keys(simhash):
+            if key in self.split:
+                buckets = [self.sub_bucket.get(sub_key, {}) for sub_key in self.get_sub_keys(key, i, simhash.fingerprint)]
+            else:
+                buckets = [self.bucket.get(key, {})]
+            for bucket in buckets:
+                if bucket.get(n) == simhash.fingerprint:
+                    del bucket[n]
+
+    def _split(self, key, i):
+        """Move the fingerprints of a hot bucket of table i into its sub-buckets"""
+        if not list(self.layout.sub_keys(0, i)):
+            # the key is the whole fingerprint, nothing to split on
+            return
+        dups = self.bucket.pop(key)
+        logging.info('Split big bucket. key:%x, len:%s', key, len(dups))
+        self.split.add(key)
+        for n, fingerprint in dups.items():
+            for sub_key in self.get_sub_keys(key, i, fingerprint):
+                self.sub_bucket[sub_key][n] = fingerprint
 
-            if v in self.bucket.get(key, set()):
-                self.bucket[key].remove(v)
+    def get_sub_keys(self, key, i, fingerprint):
+        """The sub-buckets of a split key of table i holding the fingerprint"""
+        return [(key, j, c) for j, c in self.layout.sub_keys(fingerprint, i)]
 
     @property
     def offsets(self):
         """
         You may optimize this method according to <http://www.wwwconference.org/www2007/papers/paper215.pdf>
         """
-        return [self.hashbits // (self.k + 1) * i for i in range(self.k + 1)]
+        return self.layout.offsets
+
+    @staticmethod
+    def _bucket_key(c, i, simhash):
+        # fingerprints of other hash schemes go to their own buckets
+        return c << VALUE_SHIFT | i << TABLE_SHIFT | simhash.hash_version
+
+    def _keys(self, simhash):
+        for i, c in self.layout.keys(simhash.fingerprint):
+            yield i, self._bucket_key(c, i, simhash)
 
     def get_keys(self, simhash):
         """Block the hash value and build the key for the inverted index
         """
-        for i, offset in enumerate(self.offsets):
-            if i == len(self.offsets) - 1:
-                m = 2 ** (self.hashbits - offset) - 1
-            else:
-                m = 2 ** (self.offsets[i + 1] - offset) - 1
-            c = simhash.fingerprint >> offset & m
-            yield '{:x}:{:x}'.format(c, i)
+        for _, key in self._keys(simhash):
+            yield key
+
+    def get_probe_keys(self, simhash):
+        """The keys to look up, every key within the radius of the layout"""
+        for i, c in self.layout.probe_keys(simhash.fingerprint):
+            yield self._bucket_key(c, i, simhash)
 
     @property
     def bucket_size(self):
-        return len(self.bucket)
+        return len(self.bucket) + len(self.sub_bucket)
+
+    def save(self, path, hash_version=0):
+        """Write the fingerprints of a hash scheme as a snapshot
+        Reopen it with SimhashArrayIndex.open, which maps the file instead of
+        adding the objects one by one and answers the same queries for k and the layout.
+        """
+        entries = dict()
+        for key, dups in self.bucket.items():
+            if key & VERSION_MASK == hash_version:
+                entries.update(dups)
+        for (key, _, _), dups in self.sub_bucket.items():
+            if key & VERSION_MASK == hash_version:
+                entries.update(dups)
+        index = SimhashArrayIndex.from_arrays(np.fromiter(entries.values(), dtype=np.uint64, count=len(entries)),
+                                              np.fromiter(entries.keys(), dtype=np.int64, count=len(entries)),
+                                              hashbits=self.hashbits, k=self.k, obj_id_table=self.obj_id_table,
+                                              interned=True, layout=self.layout, hash_version=hash_version)
+        index.save(path)
 
     def get_near_dups(self, simhash):
         """
         Args:
             simhash: an instance of Simhash
         Returns:
-            return a list of obj_id, which is in type of str
+            return a list of obj_id, the nearest first
+        """
+        return [match.obj_id for match in self.find_near_dups(simhash)]
+
+    def find_near_dups(self, simhash):
+        """
+        Args:
+            simhash: an instance of Simhash
+        Returns:
+            a list of Match(obj_id, distance, score), the nearest first
         """
         assert simhash.hashbits == self.hashbits
 
-        ans = set()
+        ans = dict()
 
-        for key in self.get_keys(simhash):
-            dups = self.bucket.get(key, set())
-            logging.debug('key:{}'.format(key))
+        for i, c in self.layout.probe_keys(simhash.fingerprint):
+            key = self._bucket_key(c, i, simhash)
+            if key in self.split:
+                # the bucket is split, only the sub-buckets sharing a sub-block are scanned
+                dups = dict()
+                for sub_key in self.get_sub_keys(key, i, simhash.fingerprint):
+                    dups.update(self.sub_bucket.get(sub_key, {}))
+            else:
+                dups = self.bucket.get(key)
+            if not dups:
+                continue
+            logging.debug('key:%x', key)
             if len(dups) > 200:
-                logging.warning('Big bucket found. key:%s, len:%s', key, len(dups))
+                logging.warning('Big bucket found. key:%x, len:%s', key, len(dups))
 
-            for dup in dups:
-                sim2, obj_id = dup.split(',', 1)
-                sim2 = Simhash(int(sim2, 16), self.hashbits)
+            obj_ids = list(dups)
+            fingerprints = np.fromiter(dups.values(), dtype=np.uint64, count=len(dups))
+            # score the whole bucket at once
+            distances, mask = within_distance(simhash.fingerprint, fingerprints, self.k, self.hashbits)
+            collect_matches(ans, obj_ids, distances, mask, self.hashbits)
 
-                _sim1 = HammingDistance(simhash)
-                d = _sim1.distance(sim2)
-                rate = _sim1.similarity(sim2)
-                if d <= self.k:
-                    ans.add((obj_id, rate))
-        return list(ans)
+        # the external obj_ids are given back only for the results
+        matches = list(ans.values())
+        obj_ids = self.obj_id_table.lookup_many([m.obj_id for m in matches])
+        return sorted_matches(m._replace(obj_id=obj_id) for m, obj_id in zip(matches, obj_ids))
 
 if __name__ == '__main__':
     data = []
@@ -116,23 +246,23 @@ if __name__ == '__main__':
         _str = {'how': 1, 'are': 2, 'you': 3, 'fine': 4, 'blar': i, 'i': 1, 'am': 7, 'ok': 99,'reboot': 4}
         data.append(_str)
 
-    s1 = time.clock()
+    s1 = time.perf_counter()
     objs = [(str(data.index(i)), Simhash(i)) for i in data]
     index = SimhashIndex(objs, k=3)
-    s2 = time.clock()
+    s2 = time.perf_counter()
     print('生成指纹建立索引耗时{}'.format(s2 - s1))
     print(index.bucket_size)
 
-    s3 = time.clock()
+    s3 = time.perf_counter()
     sim1 = Simhash({'thanks': 2, 'are': 2, 'you': 3, 'fine': 4, 'blar': 10, 'ok': 3, 'reboot': 4})
     print(index.get_near_dups(sim1))
     print(len(index.get_near_dups(sim1)))
-    s4 = time.clock()
+    s4 = time.perf_counter()
     print('新内容计算simhash及查询耗时{}'.format(s4 - s3))
 
-    s5 = time.clock()
+    s5 = time.perf_counter()
     index.add('test', sim1)
     print(index.get_near_dups(sim1))
     print(len(index.get_near_dups(sim1)))
-    s6 = time.clock()
+    s6 = time.perf_counter()
     print('重新插入内存及查询耗时{}'.format(s6 - s5))
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/27 14:05
+@File    : simhash_index_array.py
+@Desc    : in-memory simhash index over sorted numpy tables
+"""
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from fingerprints_calculation.simhash import Simhash
+from fingerprints_calculation.hashfunc import blake2b_hash
+from fingerprints_storage.index_layout import IndexLayout
+from fingerprints_storage.obj_id_table import ObjIdTable
+from similarity_calculation.hamming_distance import within_distance, collect_matches, sorted_matches
+
+# snapshot file: header, then (keys, obj_ids) of every table, then if there is
+# an obj_id table the offsets of its obj_ids, their sorted hashes with the ints
+# in the same order, and the utf-8 bytes of the obj_ids
+SNAPSHOT_MAGIC = b'SIMHIDX\x00'
+SNAPSHOT_VERSION = 3
+# magic, version, hashbits, k, tables, entries, obj_ids, bytes of the obj_ids,
+# the distance, blocks and key blocks of the layout, then the hash version
+SNAPSHOT_HEADER = struct.Struct('<8sIIIIQQQIIII')
+SNAPSHOT_HEADER_SIZE = 64
+# an entry of a table, for finding the deleted ones
+ENTRY_DTYPE = np.dtype([('key', np.uint64), ('obj_id', np.int64)])
+
+
+class SimhashArrayIndex(object):
+
+    def __init__(self, objs=(), hashbits=64, k=3, merge_threshold=10000, obj_id_table=None, layout=None,
+                 hash_version=0):
+        """The permuted tables of <http://www.wwwconference.org/www2007/papers/paper215.pdf>
+        The fingerprint is cut into blocks like SimhashIndex. Table i keeps every
+        fingerprint with its blocks reordered so that the key of table i becomes
+        the highest bits, sorted, with the obj_ids in a parallel array. The
+        candidates of a key are then the contiguous range with the same highest
+        bits, found by binary search, for every key within the radius of the layout.
+        Args:
+            objs: a list of (obj_id, simhash)
+                obj_id is an int (or a str of an int), simhash is an instance of Simhash
+            hashbits: the same with the one for Simhash, at most 64
+            k: the tolerance
+            merge_threshold: new fingerprints are buffered and sorted into the
+                tables when the buffer reaches this size
+            obj_id_table: an instance of ObjIdTable to keep obj_ids which are
+                not ints, the tables keep its ints
+            layout: an instance of IndexLayout, see plan_layout,
+                the default is k + 1 blocks looked up exactly
+            hash_version: version of the hash scheme of the fingerprints, the
+                ones of another scheme are neither added nor found
+        """
+        assert hashbits <= 64
+        self.k = k
+        self.hashbits = hashbits
+        self.hash_version = hash_version
+        if layout is None:
+            layout = IndexLayout(hashbits, k, blocks=k + 1)
+        assert layout.hashbits == hashbits and layout.distance >= k
+        self.layout = layout
+        self.merge_threshold = merge_threshold
+        self.obj_id_table = obj_id_table
+        # (offset, width) of the blocks of table i from the highest bits down, the
+        # key first, the others downwards from its first block. With one block a
+        # key this is the rotation bringing the block to the top
+        self.orders = []
+        for table in layout.tables:
+            rest = [(table[0] - j) % layout.blocks for j in range(1, layout.blocks)]
+            order = list(table) + [b for b in rest if b not in table]
+            self.orders.append([(layout.offsets[b], layout.widths[b]) for b in order])
+        # the bits below the key in permuted table i
+        self.shifts = [hashbits - layout.key_bits(i) for i in range(len(layout.tables))]
+        # the keys of table i probed for a query are its own key xor these
+        self.probe_masks = [list(layout.probe_masks(i)) for i in range(len(layout.tables))]
+        # (sorted permuted fingerprints, obj_ids) of every table
+        self.tables = [(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)) for _ in layout.tables]
+        # (fingerprint, obj_id) added but not merged into the tables yet
+        self.buffer = []
+        # (fingerprint, obj_id) deleted from the tables, dropped at the next merge
+        self.deleted = set()
+
+        count = len(objs)
+        logging.info('Initializing %s data.', count)
+        if count:
+            fingerprints = np.empty(count, dtype=np.uint64)
+            obj_ids = np.empty(count, dtype=np.int64)
+            for i, (obj_id, simhash) in enumerate(objs):
+                self._check(simhash)
+                fingerprints[i] = simhash.fingerprint
+                obj_ids[i] = self._intern(obj_id)
+            self._build(fingerprints, obj_ids)
+
+    @property
+    def offsets(self):
+        return self.layout.offsets
+
+    @property
+    def widths(self):
+        return self.layout.widths
+
+    @classmethod
+    def from_arrays(cls, fingerprints, obj_ids, hashbits=64, k=3, merge_threshold=10000, obj_id_table=None,
+                    interned=False, layout=None, hash_version=0):
+        """Build the tables straight from the arrays with one sort per table
+        Args:
+            fingerprints: uint64 array (or a list of int)
+            obj_ids: the obj_ids in the same order, ints if obj_id_table is None
+            interned: the obj_ids are already the ints of obj_id_table
+        """
+        if obj_id_table is not None and not interned:
+            obj_ids = obj_id_table.intern_many(obj_ids)
+        index = cls(hashbits=hashbits, k=k, merge_threshold=merge_threshold, obj_id_table=obj_id_table, layout=layout,
+                    hash_version=hash_version)
+        index._build(np.asarray(fingerprints, dtype=np.uint64), np.asarray(obj_ids, dtype=np.int64))
+        return index
+
+    def _check(self, simhash):
+        assert simhash.hashbits == self.hashbits
+        if simhash.hash_version != self.hash_version:
+            raise ValueError('Hash version {} of the fingerprint is not the one {} of the index'.format(
+                simhash.hash_version, self.hash_version))
+
+    def _intern(self, obj_id):
+        if self.obj_id_table is None:
+            return int(obj_id)
+        return self.obj_id_table.intern(obj_id)
+
+    def _get(self, obj_id):
+        if self.obj_id_table is None:
+            return int(obj_id)
+        return self.obj_id_table.get(obj_id)
+
+    def _permute(self, x, i):
+        """Reorder the blocks of an int or an uint64 array for table i"""
+        if not isinstance(x, np.ndarray):
+            y = 0
+            for offset, width in self.orders[i]:
+                y = y << width | x >> offset & ((1 << width) - 1)
+            return y
+        y = np.zeros_like(x)
+        for offset, width in self.orders[i]:
+            y = y << np.uint64(width) | x >> np.uint64(offset) & np.uint64((1 << width) - 1)
+        return y
+
+    def _unpermute(self, y, i):
+        """The fingerprint of an int or an uint64 array of permuted table i"""
+        array = isinstance(y, np.ndarray)
+        x = np.zeros_like(y) if array else 0
+        shift = 0
+        for offset, width in reversed(self.orders[i]):
+            if array:
+                x |= (y >> np.uint64(shift) & np.uint64((1 << width) - 1)) << np.uint64(offset)
+            else:
+                x |= (y >> shift & ((1 << width) - 1)) << offset
+            shift += width
+        return x
+
+    def _build(self, fingerprints, obj_ids):
+        for i in range(len(self.tables)):
+            keys = self._permute(fingerprints, i)
+            order = np.argsort(keys, kind='mergesort')
+            self.tables[i] = (keys[order], obj_ids[order])
+
+    def _deleted_mask(self, i, keys, obj_ids):
+        """Which entries of table i are deleted, one vectorized lookup"""
+        fingerprints, deleted_ids = zip(*self.deleted)
+        deleted = np.empty(len(deleted_ids), dtype=ENTRY_DTYPE)
+        deleted['key'] = self._permute(np.array(fingerprints, dtype=np.uint64), i)
+        deleted['obj_id'] = deleted_ids
+        entries = np.empty(len(keys), dtype=ENTRY_DTYPE)
+        entries['key'] = keys
+        entries['obj_id'] = obj_ids
+        return np.isin(entries, deleted)
+
+    def merge(self):
+        """Sort the buffered fingerprints into the tables
+        Only the buffer is sorted, every table keeps its order and the buffer
+        is inserted at the positions found by binary search. The deleted
+        entries are dropped on the way.
+        """
+        if not self.buffer and not self.deleted:
+            return
+        if self.buffer:
+            new_fingerprints, new_obj_ids = zip(*self.buffer)
+            new_fingerprints = np.array(new_fingerprints, dtype=np.uint64)
+            new_obj_ids = np.array(new_obj_ids, dtype=np.int64)
+        for i in range(len(self.tables)):
+            keys, obj_ids = self.tables[i]
+            if self.deleted:
+                keep = ~self._deleted_mask(i, keys, obj_ids)
+                keys, obj_ids = keys[keep], obj_ids[keep]
+            if self.buffer:
+                new_keys = self._permute(new_fingerprints, i)
+                order = np.argsort(new_keys, kind='mergesort')
+                new_keys = new_keys[order]
+                # after the equal keys, like a stable sort of the tables and then the buffer
+                at = np.searchsorted(keys, new_keys, side='right')
+                keys = np.insert(keys, at, new_keys)
+                obj_ids = np.insert(obj_ids, at, new_obj_ids[order])
+            self.tables[i] = (keys, obj_ids)
+        self.buffer = []
+        self.deleted = set()
+
+    def add(self, obj_id, simhash):
+        """
+        Args:
+            obj_id: an int
+            simhash: an instance of Simhash
+        """
+        self._check(simhash)
+        entry = (simhash.fingerprint, self._intern(obj_id))
+        if entry in self.deleted:
+            self.deleted.remove(entry)
+            return
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.merge_threshold:
+            self.merge()
+
+    def delete(self, obj_id, simhash):
+        assert simhash.hashbits == self.hashbits
+        n = self._get(obj_id)
+        if n is None or simhash.hash_version != self.hash_version:
+            return
+        entry = (simhash.fingerprint, n)
+        if entry in self.buffer:
+            self.buffer.remove(entry)
+        else:
+            self.deleted.add(entry)
+
+    def _range(self, i, c):
+        """The range of table i whose key is c"""
+        keys, _ = self.tables[i]
+        shift = self.shifts[i]
+        low = c << shift
+        high = low | ((1 << shift) - 1)
+        start = np.searchsorted(keys, np.uint64(low), side='left')
+        end = np.searchsorted(keys, np.uint64(high), side='right')
+        return start, end
+
+    def get_near_dups(self, simhash):
+        """
+        Args:
+            simhash: an instance of Simhash
+        Returns:
+            return a list of obj_id, the nearest first
+        """
+        return [match.obj_id for match in self.find_near_dups(simhash)]
+
+    def find_near_dups(self, simhash):
+        """
+        Args:
+            simhash: an instance of Simhash
+        Returns:
+            a list of Match(obj_id, distance, score), the nearest first,
+            none for a fingerprint of another hash scheme
+        """
+        assert simhash.hashbits == self.hashbits
+        if simhash.hash_version != self.hash_version:
+            return []
+        ans = dict()
+        for i in range(len(self.tables)):
+            keys, obj_ids = self.tables[i]
+            query = self._permute(simhash.fingerprint, i)
+            # the key of the query is the highest bits of the permuted query
+            c = query >> self.shifts[i]
+            for m in self.probe_masks[i]:
+                start, end = self._range(i, c ^ m)
+                if start == end:
+                    continue
+                # the permutation keeps the distance, no need to permute the candidates back
+                distances, mask = within_distance(query, keys[start:end], self.k, self.hashbits)
+                if self.deleted:
+                    for j in np.flatnonzero(mask):
+                        fingerprint = self._unpermute(int(keys[start + j]), i)
+                        if (fingerprint, int(obj_ids[start + j])) in self.deleted:
+                            mask[j] = False
+                collect_matches(ans, obj_ids[start:end].tolist(), distances, mask, self.hashbits)
+
+        if self.buffer:
+            fingerprints, obj_ids = zip(*self.buffer)
+            distances, mask = within_distance(simhash.fingerprint, np.array(fingerprints, dtype=np.uint64),
+                                              self.k, self.hashbits)
+            collect_matches(ans, obj_ids, distances, mask, self.hashbits)
+
+        matches = list(ans.values())
+        if self.obj_id_table is not None:
+            obj_ids = self.obj_id_table.lookup_many([m.obj_id for m in matches])
+            matches = [m._replace(obj_id=obj_id) for m, obj_id in zip(matches, obj_ids)]
+        return sorted_matches(matches)
+
+    def __len__(self):
+        return len(self.tables[0][0]) - len(self.deleted) + len(self.buffer)
+
+    @property
+    def nbytes(self):
+        """Bytes held by the tables"""
+        return sum(keys.nbytes + obj_ids.nbytes for keys, obj_ids in self.tables)
+
+    def save(self, path):
+        """Write a snapshot which `open` maps back without reading it
+        The buffer and the deletions are merged first. The file is written
+        aside and renamed, so a reader never sees half of it.
+        """
+        self.merge()
+        count = len(self.tables[0][0])
+        if self.obj_id_table is not None:
+            encoded = [str(obj_id).encode('utf-8') for obj_id in self.obj_id_table.lookup_many(range(len(self.obj_id_table)))]
+        else:
+            encoded = []
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        # the ints sorted by the hash of their obj_id, SnapshotObjIdTable.get searches them
+        hashes = np.fromiter((blake2b_hash(e) for e in encoded), dtype=np.uint64, count=len(encoded))
+        order = np.argsort(hashes, kind='mergesort')
+        blob = b''.join(encoded)
+
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'wb') as f:
+            layout = self.layout
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.hashbits, self.k, len(self.tables),
+                                          count, len(encoded), len(blob),
+                                          layout.distance, layout.blocks, layout.key_blocks, self.hash_version)
+            f.write(header.ljust(SNAPSHOT_HEADER_SIZE, b'\x00'))
+            for keys, obj_ids in self.tables:
+                f.write(keys.astype(np.uint64).tobytes())
+                f.write(obj_ids.astype(np.int64).tobytes())
+            if encoded:
+                f.write(offsets.tobytes())
+                f.write(hashes[order].tobytes())
+                f.write(order.astype(np.int64).tobytes())
+                f.write(blob)
+        os.replace(tmp, path)
+        logging.info('Saved %s fingerprints to %s', count, path)
+
+    @classmethod
+    def open(cls, path, merge_threshold=10000):
+        """Map a snapshot written by `save`
+        The tables are read-only numpy views of the file, nothing is read until
+        a query touches it, so opening takes the same time for any size. New
+        fingerprints go to the buffer, a merge copies the tables into memory.
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from('<8sI', mm)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a simhash index snapshot'.format(path))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Snapshot version {} of {} is not supported, expected {}'.format(
+                version, path, SNAPSHOT_VERSION))
+        (_, _, hashbits, k, tables, count, ids_count, blob_size,
+         distance, blocks, key_blocks, hash_version) = SNAPSHOT_HEADER.unpack_from(mm)
+
+        layout = IndexLayout(hashbits, distance, blocks=blocks, key_blocks=key_blocks)
+        index = cls(hashbits=hashbits, k=k, merge_threshold=merge_threshold, layout=layout, hash_version=hash_version)
+        assert len(index.tables) == tables
+        offset = SNAPSHOT_HEADER_SIZE
+        for i in range(tables):
+            keys = np.frombuffer(mm, dtype=np.uint64, count=count, offset=offset)
+            offset += keys.nbytes
+            obj_ids = np.frombuffer(mm, dtype=np.int64, count=count, offset=offset)
+            offset += obj_ids.nbytes
+            index.tables[i] = (keys, obj_ids)
+        if ids_count:
+            offsets = np.frombuffer(mm, dtype=np.uint64, count=ids_count + 1, offset=offset)
+            offset += offsets.nbytes
+            hashes = np.frombuffer(mm, dtype=np.uint64, count=ids_count, offset=offset)
+            offset += hashes.nbytes
+            order = np.frombuffer(mm, dtype=np.int64, count=ids_count, offset=offset)
+            offset += order.nbytes
+            index.obj_id_table = SnapshotObjIdTable(offsets, memoryview(mm)[offset:offset + blob_size], hashes, order)
+        logging.info('Opened %s fingerprints from %s', count, path)
+        return index
+
+
+class SnapshotObjIdTable(ObjIdTable):
+
+    def __init__(self, offsets, blob, hashes, order):
+        """The obj_ids of a snapshot, decoded one by one when looked up
+        An obj_id is found by binary search of its hash, only the obj_ids
+        with the same hash are decoded. New obj_ids get the ints after the
+        ones of the snapshot.
+        Args:
+            offsets: where every obj_id starts in blob, and the end
+            blob: the utf-8 bytes of the obj_ids
+            hashes: sorted blake2b hashes of the obj_ids
+            order: the int of every hash
+        """
+        super(SnapshotObjIdTable, self).__init__()
+        self.offsets = offsets
+        self.blob = blob
+        self.hashes = hashes
+        self.order = order
+        self.base = len(offsets) - 1
+
+    def _decode(self, n):
+        return bytes(self.blob[int(self.offsets[n]):int(self.offsets[n + 1])]).decode('utf-8')
+
+    def intern(self, obj_id):
+        n = self.get(obj_id)
+        if n is None:
+            n = self.base + len(self.ids)
+            self.ids.append(obj_id)
+            self.index[obj_id] = n
+        return n
+
+    def intern_many(self, obj_ids, add_times=None):
+        return [self.intern(obj_id) for obj_id in obj_ids]
+
+    def get(self, obj_id):
+        n = self.index.get(obj_id)
+        if n is not None:
+            return n
+        # the snapshot keeps str(obj_id), see SimhashArrayIndex.save
+        key = str(obj_id)
+        h = np.uint64(blake2b_hash(key.encode('utf-8')))
+        i = int(np.searchsorted(self.hashes, h, side='left'))
+        while i < self.base and self.hashes[i] == h:
+            n = int(self.order[i])
+            if self._decode(n) == key:
+                return n
+            i += 1
+        return None
+
+    def lookup(self, n):
+        if n < self.base:
+            return self._decode(n)
+        return self.ids[n - self.base]
+
+    def lookup_many(self, ns):
+        return [self.lookup(n) for n in ns]
+
+    def __len__(self):
+        return self.base + len(self.ids)
+
+
+def dict_index_nbytes(index):
+    """Rough bytes held by the buckets and the obj_id table of a SimhashIndex, for comparison"""
+    total = 0
+    for buckets in (index.bucket, index.sub_bucket):
+        total += sys.getsizeof(buckets)
+        for key, values in buckets.items():
+            total += sys.getsizeof(key) + sys.getsizeof(values)
+            total += sum(sys.getsizeof(n) + sys.getsizeof(fp) for n, fp in values.items())
+    table = index.obj_id_table
+    total += sys.getsizeof(table.ids) + sys.getsizeof(table.index)
+    total += sum(sys.getsizeof(obj_id) for obj_id in table.ids)
+    return total
+
+
+if __name__ == '__main__':
+    import random
+    from fingerprints_storage.simhash_index import SimhashIndex
+
+    random.seed(0)
+    count = 200000
+    objs = [(1500000000000000 + i, Simhash(random.getrandbits(64))) for i in range(count)]
+    query = Simhash(objs[100][1].fingerprint ^ 0b1011)
+
+    s1 = time.time()
+    array_index = SimhashArrayIndex(objs, k=3)
+    s2 = time.time()
+    dict_index = SimhashIndex(objs, k=3)
+    s3 = time.time()
+    print('建立索引耗时 array:{:.3f}s dict:{:.3f}s'.format(s2 - s1, s3 - s2))
+    print('每条指纹内存 array:{:.1f}B dict:{:.1f}B'.format(array_index.nbytes / count, dict_index_nbytes(dict_index) / count))
+
+    s4 = time.time()
+    for _ in range(1000):
+        array_index.get_near_dups(query)
+    s5 = time.time()
+    for _ in range(1000):
+        dict_index.get_near_dups(query)
+    s6 = time.time()
+    print('查询耗时 array:{:.6f}s dict:{:.6f}s'.format((s5 - s4) / 1000, (s6 - s5) / 1000))
+    print(array_index.get_near_dups(query))
+
+    import tempfile
+    snapshot = os.path.join(tempfile.mkdtemp(), 'simhash.idx')
+    s7 = time.time()
+    array_index.save(snapshot)
+    s8 = time.time()
+    mapped_index = SimhashArrayIndex.open(snapshot)
+    s9 = time.time()
+    print('保存快照耗时{:.3f}s 打开快照耗时{:.6f}s'.format(s8 - s7, s9 - s8))
+    print(mapped_index.get_near_dups(query))
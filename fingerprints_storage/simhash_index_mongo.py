@@ -13,7 +13,7 @@ import datetime
 from utils.timer import Timer
 
 from fingerprints_calculation.simhash import Simhash
-from similarity_calculation.hamming_distance import HammingDistance
+from similarity_calculation.hamming_distance import HammingDistance, Match, similarity_score, sorted_matches
 from db.simhash_mongo import SimhashInvertedIndex
 
 class SimhashIndexWithMongo(object):
@@ -94,7 +94,7 @@ class SimhashIndexWithMongo(object):
             raise Exception('value not text or simhash')
         assert simhash.hashbits == self.hashbits
         sim_hash_dict = collections.defaultdict(list)
-        ans = set()
+        ans = dict()
         for key in self.get_keys(simhash):
             with Timer(msg='==query: {}'.format(key)):
                 simhash_invertindex = SimhashInvertedIndex.objects.filter(key=key)
@@ -121,10 +121,10 @@ class SimhashIndexWithMongo(object):
                         # print("d:%d obj_id:%s key:%s " % (d, obj_id, key))
                         sim_hash_dict[obj_id].append(d)
                         if d < k:
-                            ans.add(obj_id)
+                            ans[obj_id] = Match(obj_id, d, similarity_score(d, self.hashbits))
                     except Exception as e:
                         logging.warning('not exists {}'.format(e))
-        return list(ans)
+        return sorted_matches(ans.values())
 
     @staticmethod
     def query_simhash_cache(obj_id):
@@ -169,6 +169,15 @@ class SimhashIndexWithMongo(object):
         Returns:
             return a list of obj_id, which is in type of str
         """
+        return [match.obj_id for match in self._find(simhash, self.k)]
+
+    def find_near_dups(self, simhash):
+        """
+        Args:
+            simhash: an instance of Simhash
+        Returns:
+            a list of Match(obj_id, distance, score), the nearest first
+        """
         return self._find(simhash, self.k)
 
     @property
@@ -183,7 +192,11 @@ class SimhashIndexWithMongo(object):
             else:
                 m = 2 ** (self.offsets[i + 1] - offset) - 1
             c = simhash.fingerprint >> offset & m
-            yield '{:x}:{:x}'.format(c, i)
+            if simhash.hash_version:
+                # fingerprints of other hash schemes go to their own buckets
+                yield '{:x}:{:x}:v{}'.format(c, i, simhash.hash_version)
+            else:
+                yield '{:x}:{:x}'.format(c, i)
 
     def bucket_size(self):
         return SimhashInvertedIndex.objects.count()
\ No newline at end of file
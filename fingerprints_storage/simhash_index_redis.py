@@ -9,16 +9,29 @@
 
 import time
 import logging
+import numpy as np
 
-from setting import SAVE_DAYS
+from pymongo.errors import BulkWriteError
+
+from setting import SAVE_DAYS, BUCKET_SPLIT_THRESHOLD
 from db.simhash_mongo import SimhashInvertedIndex
 from fingerprints_calculation.simhash import Simhash
-from similarity_calculation.hamming_distance import HammingDistance
+from fingerprints_storage.index_layout import IndexLayout
+from fingerprints_storage.obj_id_table import RedisObjIdTable
+from fingerprints_storage.member_codec import compact_member, text_member, decode_member
+from fingerprints_storage.write_behind import WriteBehindBuffer
+from similarity_calculation.hamming_distance import within_distance, collect_matches, sorted_matches
+
+# member left in a split bucket, its score is far in the future so that it never expires
+SPLIT_MARKER = 'split'
+SPLIT_MARKER_SCORE = 2 ** 32 - 1
 
 
 class SimhashIndexWithRedis(object):
 
-    def __init__(self, simhashinvertedindex, redis, objs=(), hashbits=64, k=3, logger=None):
+    def __init__(self, simhashinvertedindex, redis, objs=(), hashbits=64, k=3, logger=None, hash_scheme='md5',
+                 layout=None, split_threshold=BUCKET_SPLIT_THRESHOLD, obj_id_table=None, key_prefix='',
+                 expire_at=None, server_filter=False, write_behind=False, compact=False):
         """
         Args:
             redis: an instance of redis
@@ -28,6 +41,28 @@ class SimhashIndexWithRedis(object):
             hashbits: the same with the one for Simhash
             k: the tolerance
             logger:  an instance of Logger
+            hash_scheme: the token hash of the fingerprints built from text,
+                fingerprints of other schemes are kept under their own keys
+            layout: an instance of IndexLayout, see plan_layout. The default keeps
+                the k + 1 blocks already stored and probes every key within the
+                radius which finds all the fingerprints within self.distance,
+                68 keys a query. A layout for a smaller distance probes fewer
+                keys and misses some of the fingerprints farther away
+            split_threshold: a bucket growing past it is split into sub-buckets
+                on the rest of the bits, None never splits
+            obj_id_table: an instance of RedisObjIdTable, the redis members keep
+                its ints, mongodb keeps the obj_ids
+            key_prefix: prepended to every key, e.g. the time segment of SegmentedSimhashIndex
+            expire_at: unix time when all the keys expire at once, reads then
+                do not skip the expired members one by one
+            server_filter: compute the distances inside redis with a Lua script,
+                only the members within the distance are sent back
+            write_behind: buffer the inserts and write many articles at once,
+                an article is found only after its batch is written, see flush.
+                False writes every insert before add returns
+            compact: write the members as the packed fingerprint and a varint of
+                the interned obj_id, see member_codec. Members of every form
+                are read, migrate_members converts the stored ones
         """
         if logger is None:
             self.log = logging.getLogger("simhash")
@@ -38,9 +73,28 @@ class SimhashIndexWithRedis(object):
         # TODO: 根据实际情况修改两篇相似文章间的距离(默认距离为小于6，认为两篇文章重复)
         self.distance = 7
         self.hashbits = hashbits
+        self.hash_scheme = hash_scheme
+        if layout is None:
+            # self.distance is exclusive
+            layout = IndexLayout(hashbits, self.distance - 1, blocks=k + 1)
+        assert layout.hashbits == hashbits
+        self.layout = layout
+        self.log.info('Index layout {}, {} keys probed a query'.format(layout, layout.cost(0)['probes']))
+        if layout.distance < self.distance - 1:
+            self.log.warning('The layout finds all the fingerprints within {} only, some within {} are missed'.format(
+                layout.distance, self.distance - 1))
+        self.split_threshold = split_threshold
+        # keys known to be split, a bucket never goes back once split
+        self.split = set()
         # self.hash_type = hash_type
         self.redis = redis
         self.simhash_inverted_index = simhashinvertedindex
+        self.obj_id_table = obj_id_table if obj_id_table is not None else RedisObjIdTable(redis)
+        self.key_prefix = key_prefix
+        self.expire_at = expire_at
+        self.server_filter = server_filter
+        self.compact = compact
+        self.write_buffer = WriteBehindBuffer(self._write_many, logger=self.log) if write_behind else None
 
         if objs:
             count = len(objs)
@@ -51,8 +105,19 @@ class SimhashIndexWithRedis(object):
                     self.log.info('{}/{}'.format(i + 1, count))
                 self.add(*q)
 
-    def add(self, obj_id, simhash):
-        return self._insert(obj_id=obj_id, value=simhash)
+    def add(self, obj_id, simhash, add_time=None):
+        return self._insert(obj_id=obj_id, value=simhash, add_time=add_time)
+
+    def flush(self):
+        """Write the buffered inserts now, e.g. before reading them back"""
+        if self.write_buffer is not None:
+            return self.write_buffer.flush()
+        return 0
+
+    def close(self):
+        """Write the buffered inserts and stop buffering"""
+        if self.write_buffer is not None:
+            self.write_buffer.close()
 
     def update(self, obj_id):
         if self.simhash_inverted_index.objects(obj_id=obj_id):
@@ -72,22 +137,33 @@ class SimhashIndexWithRedis(object):
             simhash: an instance of Simhash or str
         """
         if isinstance(simhash, str):
-            simhash = Simhash(value=simhash, hashbits=self.hashbits)
+            simhash = Simhash(value=simhash, hashbits=self.hashbits, hash_scheme=self.hash_scheme)
         elif isinstance(simhash, Simhash):
             simhash = simhash
         else:
             self.log.warning('simhash not str or an instance of Simhash')
             pass
+        # a buffered insert would come back after the delete
+        self.flush()
 
         # delete simhash in mongodb
         try:
             self.simhash_inverted_index.objects(obj_id=obj_id).delete()
         except:
             self.log.warning('Delete obj_id {} wrong'.format(obj_id))
-        # delete simhash in redis
-        for key in self.get_keys(simhash):
-            v = '{:x},{}'.format(simhash.fingerprint, obj_id)
-            self.redis.delete(name=key, value=v)
+        # delete simhash in redis, members written before interning keep the obj_id
+        members = ['{:x},{}'.format(simhash.fingerprint, obj_id)]
+        n = self.obj_id_table.get(obj_id)
+        if n is not None:
+            members.append(text_member(simhash.fingerprint, n))
+            members.append(compact_member(simhash.fingerprint, n))
+        for i, key in self._keys(simhash):
+            names = [key]
+            if self._is_split(key):
+                names.extend(self.get_sub_keys(key, i, simhash.fingerprint))
+            for name in names:
+                for v in members:
+                    self.redis.delete(name=name, value=v)
         return
 
     def get_near_dups(self, simhash):
@@ -97,92 +173,272 @@ class SimhashIndexWithRedis(object):
         Returns:
             return a list of obj_id, which is in type of str
         """
+        return [match.obj_id for match in self._find(simhash, self.distance)]
+
+    def find_near_dups(self, simhash):
+        """
+        Args:
+            simhash: an instance of Simhash or text
+        Returns:
+            a list of Match(obj_id, distance, score), the nearest first
+        """
         return self._find(simhash, self.distance)
 
+    def _format_key(self, c, i, simhash):
+        if simhash.hash_version:
+            # fingerprints of other hash schemes go to their own buckets
+            return '{}{:x}:{:x}:v{}'.format(self.key_prefix, c, i, simhash.hash_version)
+        return '{}{:x}:{:x}'.format(self.key_prefix, c, i)
+
+    def _get_values(self, name, withscores=False):
+        return self.redis.get_values(name=name, withscores=withscores, trim=self.expire_at is None)
+
+    def drop(self):
+        """Delete every key of the index, only for an index with a key_prefix"""
+        assert self.key_prefix
+        self.split.clear()
+        return self.redis.drop(self.key_prefix + '*')
+
+    def _member(self, fingerprint, n):
+        if self.compact:
+            return compact_member(fingerprint, n)
+        return text_member(fingerprint, n)
+
+    def _keys(self, simhash):
+        for i, c in self.layout.keys(simhash.fingerprint):
+            yield i, self._format_key(c, i, simhash)
+
     def get_keys(self, simhash):
-        for i, offset in enumerate(self.offsets):
-            # m = (i == len(self.offsets) - 1 and 2 ** (self.hashbits - offset) - 1 or 2 ** (self.offsets[i + 1] - offset) - 1)
-            if i == len(self.offsets) - 1:
-                m = 2 ** (self.hashbits - offset) - 1
-            else:
-                m = 2 ** (self.offsets[i + 1] - offset) - 1
-            c = simhash.fingerprint >> offset & m
-            yield '{:x}:{:x}'.format(c, i)
+        for _, key in self._keys(simhash):
+            yield key
+
+    def get_sub_keys(self, key, i, fingerprint):
+        """The sub-buckets of a split key of table i holding the fingerprint"""
+        return ['{}/{:x}:{:x}'.format(key, c, j) for j, c in self.layout.sub_keys(fingerprint, i)]
+
+    def _is_split(self, key):
+        if key not in self.split and self.redis.get_score(name=key, value=SPLIT_MARKER) is not None:
+            self.split.add(key)
+        return key in self.split
+
+    def _split(self, key, i):
+        """Move the fingerprints of a hot bucket of table i into its sub-buckets
+        The sub-buckets are filled before the marker is set and the moved members
+        are removed last, so a reader always finds every fingerprint either in
+        the bucket or in the sub-buckets. Members added meanwhile stay in the
+        bucket, which is still scanned after the split. Each of the three steps
+        is one round trip.
+        """
+        if not list(self.layout.sub_keys(0, i)):
+            # the key is the whole fingerprint, nothing to split on
+            return
+        members = [(v, score) for v, score in self._get_values(key, withscores=True)
+                   if v not in (SPLIT_MARKER, SPLIT_MARKER.encode())]
+        self.log.info('Split big bucket. key:{}, len:{}'.format(key, len(members)))
+        items = []
+        for v, score in members:
+            try:
+                fingerprint = decode_member(v)[0]
+            except (ValueError, TypeError) as e:
+                self.log.warning('Not exists {}'.format(e))
+                continue
+            for sub_key in self.get_sub_keys(key, i, fingerprint):
+                items.append((sub_key, score, v))
+        self.redis.add_many(items, expire_at=self.expire_at)
+        self.redis.add_and_remove([(key, SPLIT_MARKER_SCORE, SPLIT_MARKER)], key, [v for v, _ in members],
+                                  expire_at=self.expire_at)
+        self.split.add(key)
 
-    def _insert(self, obj_id=None, value=None):
+    def get_probe_keys(self, simhash):
+        """The keys to look up, every key within the radius of the layout"""
+        for i, c in self.layout.probe_keys(simhash.fingerprint):
+            yield self._format_key(c, i, simhash)
+
+    def _insert(self, obj_id=None, value=None, add_time=None):
         """Insert hash value into mongodb and redis
             data can  be text,{obj_id,text},  {obj_id,simhash}
-        #TODO: The most time-consuming place to store and write databases
+        The writes go to the write behind buffer if there is one
         """
         assert value != None
         if isinstance(value, str):
-            simhash = Simhash(value=value, hashbits=self.hashbits)
+            simhash = Simhash(value=value, hashbits=self.hashbits, hash_scheme=self.hash_scheme)
         elif isinstance(value, Simhash):
             simhash = value
         else:
             raise Exception('Value not text or simhash')
         assert simhash.hashbits == self.hashbits
 
+        if add_time is None:
+            add_time = int(time.time())
         # Cache raw text information
         if obj_id and simhash:
-
-            # Store or update the cache to mongodb,cache invert index into mongodb and redis
-            v = '{:x},{}'.format(simhash.fingerprint, obj_id)  # Convert to hexadecimal for compressed storage, which saves space and converts back when querying
-            for key in self.get_keys(simhash):
+            if self.write_buffer is not None:
+                self.write_buffer.put((obj_id, simhash, add_time))
+            else:
                 try:
-                    invert_index = self.simhash_inverted_index(key=key, simhash_value_obj_id=v)
-                    add_time = int(time.time())
-                    invert_index.add_time = add_time
-                    invert_index.obj_id = obj_id
-                    # invert_index.last_days = (update_time - add_time) // (3600*24)
-                    # invert_index.hash_value = '{:x}'.format(simhash.fingerprint)
-                    invert_index.save()
-
-                    self.redis.add(name=key, timenode=add_time, value=v)
+                    self._write_many([(obj_id, simhash, add_time)])
                 except Exception as e:
-                    # print('%s,%s,%s' % (e, key, v))
-                    self.log.warning('DB has same value{}'.format(e))
-                    pass
+                    self.log.warning('Insert obj_id {} wrong {}'.format(obj_id, e))
 
+    def _write_many(self, articles):
+        """Write (obj_id, simhash, add_time) of many articles, one mongodb
+        insert_many and one redis pipeline for all of them
+        """
+        docs = []
+        entries = []
+        # every obj_id interned in one round trip, marked with its add time
+        ns = self.obj_id_table.intern_many([obj_id for obj_id, _, _ in articles],
+                                           [add_time for _, _, add_time in articles])
+        for (obj_id, simhash, add_time), n in zip(articles, ns):
+            # Convert to hexadecimal for compressed storage, which saves space and converts back when querying
+            # mongodb keeps the obj_id so that redis can be reloaded from it
+            record = '{:x},{}'.format(simhash.fingerprint, obj_id)
+            v = self._member(simhash.fingerprint, n)
+            for i, key in self._keys(simhash):
+                docs.append({'obj_id': obj_id, 'key': key, 'simhash_value_obj_id': record, 'add_time': add_time})
+                entries.append((i, key, simhash.fingerprint, add_time, v))
 
-    def _find(self, value, distance=4):
-        assert value != None
+        failed, stored = self._insert_mongo(docs)
+        items = []
+        # stored already, the member keeps its first add time, and is written
+        # if the write of a batch retried stopped before redis
+        nx_items = []
+        checked = {}
+        for n, (i, key, fingerprint, add_time, v) in enumerate(entries):
+            if n in failed:
+                continue
+            added = nx_items if n in stored else items
+            if key in self.split:
+                for sub_key in self.get_sub_keys(key, i, fingerprint):
+                    added.append((sub_key, add_time, v))
+                continue
+            added.append((key, add_time, v))
+            if n not in stored:
+                checked[key] = i
+        sizes = self.redis.add_many(items, expire_at=self.expire_at, nx_items=nx_items)
+        if self.split_threshold:
+            for key, i in checked.items():
+                if sizes.get(key, 0) > self.split_threshold and key not in self.split:
+                    self._split(key, i)
 
+    def _insert_mongo(self, docs):
+        """insert_many, the documents already stored are skipped
+        Returns:
+            (failed, stored), the positions of the documents not inserted,
+            their redis members are not written either, and of the ones
+            stored already (duplicate key)
+        """
+        if not docs:
+            return set(), set()
+        try:
+            self.simhash_inverted_index._get_collection().insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            stored = set(error['index'] for error in errors if error.get('code') == 11000)
+            failed = set(error['index'] for error in errors) - stored
+            self.log.warning('DB has same value, {} of {} not inserted'.format(len(errors), len(docs)))
+            return failed, stored
+        except Exception as e:
+            self.log.warning('Insert into mongodb wrong {}'.format(e))
+            return set(range(len(docs))), set()
+        return set(), set()
+
+    def _simhash(self, value):
+        assert value != None
         if isinstance(value, str):
-            simhash = Simhash(value=value, hashbits=self.hashbits)
+            simhash = Simhash(value=value, hashbits=self.hashbits, hash_scheme=self.hash_scheme)
         elif isinstance(value, Simhash):
             simhash = value
         else:
             self.log.warning('value not text or simhash')
             raise Exception('value not text or simhash')
-
         assert simhash.hashbits == self.hashbits
-        ans = set()
-        for key in self.get_keys(simhash):
-            try:
-                simhash_list = self.redis.get_values(name=key)
-            except:
-                self.log.warning('Wrong with getting values from redis')
-            else:
-                if len(simhash_list) > 1000:
-                    self.log.warning('Big bucket found. key:{}, len:{}'.format(key, len(simhash_list)))
+        return simhash
+
+    def _probes(self, simhash):
+        """(table number, key) of every bucket to read for the simhash"""
+        return [(i, self._format_key(c, i, simhash)) for i, c in self.layout.probe_keys(simhash.fingerprint)]
 
-                for simhash_cache in simhash_list:
-                    if isinstance(simhash_cache, bytes):
-                        simhash_cache = simhash_cache.decode()
+    def _names(self, simhash, probes):
+        """The keys to read, with the sub-buckets of the keys known to be split"""
+        names = []
+        for i, key in probes:
+            names.append(key)
+            if key in self.split:
+                names.extend(self.get_sub_keys(key, i, simhash.fingerprint))
+        return names
 
-                    try:
-                        sim2, obj_id = simhash_cache.split(',', 1)
-                        _sim2 = Simhash(int(sim2, 16), self.hashbits)
+    def _get_values_many(self, names, simhash, distance):
+        trim = self.expire_at is None
+        if self.server_filter:
+            # self.distance is exclusive
+            return self.redis.filter_values_many(names, simhash.fingerprint, distance - 1, trim=trim)
+        return self.redis.get_values_many(names=names, trim=trim)
 
-                        _sim1 = HammingDistance(simhash)
-                        d = _sim1.distance(_sim2)
+    def _match(self, simhash, probes, values, distance):
+        """Score the members read for the probes
+        Args:
+            values: name -> members, the keys found split here are read again
+                together with their sub-buckets, one more round trip
+        Returns:
+            a list of Match, the nearest first
+        """
+        found_split = [(i, key) for i, key in probes
+                       if key not in self.split and (SPLIT_MARKER in values[key] or SPLIT_MARKER.encode() in values[key])]
+        if found_split:
+            self.split.update(key for _, key in found_split)
+            names = [name for name in self._names(simhash, found_split) if name not in values]
+            values.update(zip(names, self._get_values_many(names, simhash, distance)))
 
-                        if d < distance:
-                            ans.add(obj_id)
-                    except Exception as e:
-                        self.log.warning('Not exists {}'.format(e))
-        return list(ans)
+        fingerprints = []
+        obj_ids = []
+        for i, key in probes:
+            names = [key]
+            if key in self.split:
+                names.extend(self.get_sub_keys(key, i, simhash.fingerprint))
+            simhash_list = [v for name in names for v in values.get(name, ())]
+            if len(simhash_list) > 1000:
+                self.log.warning('Big bucket found. key:{}, len:{}'.format(key, len(simhash_list)))
+            for simhash_cache in simhash_list:
+                if simhash_cache in (SPLIT_MARKER, SPLIT_MARKER.encode()):
+                    continue
+
+                try:
+                    sim2, obj_id = decode_member(simhash_cache)
+                except Exception as e:
+                    self.log.warning('Not exists {}'.format(e))
+                    continue
+                fingerprints.append(sim2)
+                obj_ids.append(obj_id)
+
+        ans = dict()
+        if fingerprints:
+            # score every bucket at once
+            distances, mask = within_distance(simhash.fingerprint, np.array(fingerprints, dtype=np.uint64),
+                                              distance - 1, self.hashbits)
+            collect_matches(ans, obj_ids, distances, mask, self.hashbits)
+
+        # the obj_ids of the interned members are given back only for the results
+        interned = [m for m in ans.values() if isinstance(m.obj_id, int)]
+        matches = [m for m in ans.values() if not isinstance(m.obj_id, int)]
+        for m, obj_id in zip(interned, self.obj_id_table.lookup_many([m.obj_id for m in interned])):
+            if obj_id is None:
+                self.log.warning('Interned obj_id {} not exists'.format(m.obj_id))
+            else:
+                matches.append(m._replace(obj_id=obj_id))
+        return sorted_matches(matches)
+
+    def _find(self, value, distance=4):
+        """Every bucket of the probe is read in one pipelined round trip"""
+        simhash = self._simhash(value)
+        probes = self._probes(simhash)
+        names = self._names(simhash, probes)
+        try:
+            values = dict(zip(names, self._get_values_many(names, simhash, distance)))
+        except Exception as e:
+            self.log.warning('Wrong with getting values from redis {}'.format(e))
+            return []
+        return self._match(simhash, probes, values, distance)
 
     def find_similiar(self, obj_id):
         """Find similar objects by obj_id"""
@@ -191,12 +447,46 @@ class SimhashIndexWithRedis(object):
 
     @property
     def offsets(self):
-        return [self.hashbits // (self.k + 1) * i for i in range(self.k + 1)]
+        return self.layout.offsets
 
     @property
     def bucket_size(self):
         return self.redis.status
 
+
+def find_near_dups_many(indexes, value):
+    """find_near_dups of many indexes, e.g. the time segments, the buckets of
+    all the indexes on the same redis are read in one round trip
+    Returns:
+        a list of the Match lists of every index, in the order of indexes
+    """
+    groups = {}
+    for n, index in enumerate(indexes):
+        groups.setdefault((id(index.redis), index.expire_at is None, index.server_filter, index.hash_scheme),
+                          []).append(n)
+    results = [[] for _ in indexes]
+    for ns in groups.values():
+        probes = []
+        names = []
+        for n in ns:
+            index = indexes[n]
+            simhash = index._simhash(value)
+            probes.append((simhash, index._probes(simhash)))
+            names.append(index._names(simhash, probes[-1][1]))
+        try:
+            first = indexes[ns[0]]
+            values = first._get_values_many([name for index_names in names for name in index_names],
+                                            probes[0][0], first.distance)
+        except Exception as e:
+            first.log.warning('Wrong with getting values from redis {}'.format(e))
+            continue
+        values = iter(values)
+        for n, (simhash, index_probes), index_names in zip(ns, probes, names):
+            index_values = dict((name, next(values)) for name in index_names)
+            results[n] = indexes[n]._match(simhash, index_probes, index_values, indexes[n].distance)
+    return results
+
+
 if __name__ == '__main__':
     from db.simhash_redis import SimhashRedis
     sim = Simhash(int('ab2f0faeeabf5e4a', 16))
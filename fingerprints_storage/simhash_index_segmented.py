@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/30 10:20
+@File    : simhash_index_segmented.py
+@Desc    : simhash index split into time segments which expire as a whole
+"""
+
+import logging
+import time
+from collections import OrderedDict
+
+from setting import SAVE_DAYS, SEGMENT_SECONDS
+from fingerprints_storage.obj_id_table import ObjIdTable, RedisObjIdTable
+from fingerprints_storage.simhash_index import SimhashIndex
+from fingerprints_storage.simhash_index_redis import SimhashIndexWithRedis, find_near_dups_many
+from similarity_calculation.hamming_distance import sorted_matches
+
+
+class SegmentedSimhashIndex(object):
+
+    def __init__(self, create_segment, segment_seconds=SEGMENT_SECONDS, save_days=SAVE_DAYS, shared=False,
+                 logger=None):
+        """Every time segment, a day by default, has an index of its own
+        A fingerprint goes to the segment of its add time, a query asks every
+        live segment, and expiring is dropping the segments older than save_days
+        instead of removing the entries one by one.
+        Args:
+            create_segment: called with (segment number, unix time when the
+                segment expires), returns the empty index of the segment
+            segment_seconds: length of a segment
+            save_days: how long a segment lives after it ends
+            shared: True if the segments are stored outside the process (redis),
+                then every segment of the retention is asked, even the ones this
+                process has not written
+            logger: an instance of Logger
+        """
+        if logger is None:
+            self.log = logging.getLogger("simhash")
+        else:
+            self.log = logger
+        self.create_segment = create_segment
+        self.segment_seconds = segment_seconds
+        self.retention = save_days * 3600 * 24
+        self.shared = shared
+        # segment number -> index, the oldest first
+        self.segments = OrderedDict()
+
+    def segment_of(self, add_time):
+        return int(add_time) // self.segment_seconds
+
+    def expire_time(self, segment):
+        """The segment is dropped once its last entry is older than the retention"""
+        return (segment + 1) * self.segment_seconds + self.retention
+
+    def _segment(self, segment):
+        try:
+            return self.segments[segment]
+        except KeyError:
+            index = self.create_segment(segment, self.expire_time(segment))
+            self.segments[segment] = index
+            # keep the oldest first when an old segment is created late
+            for n in sorted(self.segments):
+                self.segments.move_to_end(n)
+            return index
+
+    def live_segments(self, now=None):
+        """The indexes of the segments not expired, the newest first"""
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        if self.shared:
+            first = self.segment_of(now - self.retention)
+            return [self._segment(n) for n in range(self.segment_of(now), first - 1, -1)]
+        return list(reversed(self.segments.values()))
+
+    def add(self, obj_id, simhash, add_time=None):
+        if add_time is None:
+            add_time = int(time.time())
+        index = self._segment(self.segment_of(add_time))
+        if isinstance(index, SimhashIndexWithRedis):
+            return index.add(obj_id, simhash, add_time=add_time)
+        return index.add(obj_id, simhash)
+
+    def delete(self, obj_id, simhash):
+        for index in self.live_segments():
+            index.delete(obj_id, simhash)
+
+    def find_near_dups(self, simhash):
+        """
+        Args:
+            simhash: an instance of Simhash
+        Returns:
+            a list of Match(obj_id, distance, score) of all the live segments, the nearest first
+        """
+        ans = dict()
+        segments = self.live_segments()
+        # the redis segments are all read in one round trip
+        redis_segments = [index for index in segments if isinstance(index, SimhashIndexWithRedis)]
+        results = find_near_dups_many(redis_segments, simhash)
+        for index in segments:
+            if not isinstance(index, SimhashIndexWithRedis):
+                results.append(index.find_near_dups(simhash))
+        for matches in results:
+            for m in matches:
+                if m.obj_id not in ans or m.distance < ans[m.obj_id].distance:
+                    ans[m.obj_id] = m
+        return sorted_matches(ans.values())
+
+    def get_near_dups(self, simhash):
+        """
+        Args:
+            simhash: an instance of Simhash
+        Returns:
+            return a list of obj_id, the nearest first
+        """
+        return [match.obj_id for match in self.find_near_dups(simhash)]
+
+    def expire(self, now=None):
+        """Drop the segments older than the retention, returns their numbers"""
+        if now is None:
+            now = time.time()
+        dropped = []
+        while self.segments:
+            segment = next(iter(self.segments))
+            if self.expire_time(segment) > now:
+                break
+            index = self.segments.pop(segment)
+            # the keys of shared segments expire by themselves
+            if not self.shared and hasattr(index, 'drop'):
+                index.drop()
+            dropped.append(segment)
+        if dropped:
+            self.log.info('Dropped expired segments {}'.format(dropped))
+        return dropped
+
+    def __len__(self):
+        return len(self.segments)
+
+
+def memory_segments(hashbits=64, k=3, layout=None, **kwargs):
+    """A SegmentedSimhashIndex of SimhashIndex
+    Every segment interns its obj_ids in an ObjIdTable of its own, they are
+    dropped with the segment. An article in two segments is found once.
+    """
+    return SegmentedSimhashIndex(lambda segment, expire_at: SimhashIndex([], hashbits=hashbits, k=k, layout=layout,
+                                                                         obj_id_table=ObjIdTable()),
+                                 **kwargs)
+
+
+def redis_segments(simhashinvertedindex, redis, hashbits=64, k=3, logger=None, hash_scheme='md5', server_filter=False,
+                   layout=None, **kwargs):
+    """A SegmentedSimhashIndex of SimhashIndexWithRedis
+    The keys of a segment are prefixed with `s<segment>/` and get an EXPIREAT,
+    so redis drops a whole segment by itself and reads no longer skip the
+    expired members one by one.
+    """
+    table = RedisObjIdTable(redis)
+
+    def create_segment(segment, expire_at):
+        return SimhashIndexWithRedis(simhashinvertedindex, redis, hashbits=hashbits, k=k, logger=logger,
+                                     hash_scheme=hash_scheme, layout=layout, obj_id_table=table,
+                                     key_prefix='s{:x}/'.format(segment), expire_at=int(expire_at),
+                                     server_filter=server_filter)
+
+    return SegmentedSimhashIndex(create_segment, shared=True, logger=logger, **kwargs)
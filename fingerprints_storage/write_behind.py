@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/7 15:10
+@File    : write_behind.py
+@Desc    : buffer the inserts of many articles and write them in batches
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from setting import WRITE_BEHIND_SIZE, WRITE_BEHIND_SECONDS, WRITE_BEHIND_RETRIES
+
+
+class WriteBehindBuffer(object):
+
+    def __init__(self, write, max_size=WRITE_BEHIND_SIZE, max_seconds=WRITE_BEHIND_SECONDS,
+                 max_retries=WRITE_BEHIND_RETRIES, logger=None):
+        """Items are kept until max_size of them are waiting or max_seconds have
+        passed, then `write` gets them all at once
+        A full buffer is written by the thread which fills it, so that writers
+        slow down instead of the buffer growing without end. A background
+        thread writes what is left every max_seconds. close() writes the rest,
+        it is called at exit as well. The items of a failed write are put
+        back in front of the others and written again with the next batch,
+        the ones which failed more than max_retries times are dropped.
+        Args:
+            write: called with a list of items, must be safe to call again
+                with items it has partly written
+            max_size: items which trigger a write
+            max_seconds: the longest an item waits
+            max_retries: writes of an item retried before it is dropped
+            logger: an instance of Logger
+        """
+        if logger is None:
+            self.log = logging.getLogger("simhash")
+        else:
+            self.log = logger
+        self.write = write
+        self.max_size = max_size
+        self.max_seconds = max_seconds
+        self.items = []
+        # the failed writes of every item
+        self.failures = []
+        self.lock = threading.Lock()
+        # one write at a time, in the order of the items
+        self.write_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.written = 0
+        self.batches = 0
+        self.retried = 0
+        self.dropped = 0
+        self.closed = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, item):
+        if self.closed:
+            raise RuntimeError('Write behind buffer closed')
+        with self.lock:
+            self.items.append(item)
+            self.failures.append(0)
+            full = len(self.items) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write every item waiting, returns how many were written"""
+        with self.write_lock:
+            with self.lock:
+                items, self.items = self.items, []
+                failures, self.failures = self.failures, []
+            if not items:
+                return 0
+            s1 = time.time()
+            try:
+                self.write(items)
+            except Exception as e:
+                self._requeue(items, failures, e)
+                return 0
+            self.written += len(items)
+            self.batches += 1
+            self.log.debug('Write behind {} items...{}s'.format(len(items), time.time() - s1))
+            return len(items)
+
+    def _requeue(self, items, failures, error):
+        """Put the items of a failed write back in front, in their order"""
+        kept = []
+        kept_failures = []
+        for item, n in zip(items, failures):
+            if n < self.max_retries:
+                kept.append(item)
+                kept_failures.append(n + 1)
+        dropped = len(items) - len(kept)
+        if dropped:
+            self.dropped += dropped
+            self.log.warning('Write behind lost {} items after {} retries {}'.format(dropped, self.max_retries, error))
+        if kept:
+            self.retried += len(kept)
+            self.log.warning('Write behind failed, {} items put back {}'.format(len(kept), error))
+            with self.lock:
+                self.items[:0] = kept
+                self.failures[:0] = kept_failures
+
+    def _run(self):
+        while not self._stop.wait(self.max_seconds):
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and write the rest"""
+        if self.closed:
+            return
+        self.closed = True
+        self._stop.set()
+        self._thread.join()
+        # every failure moves the items closer to being dropped
+        while self.items:
+            self.flush()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.items)
@@ -11,31 +11,44 @@
 from queue import Queue
 import json
 from utils.logger import Logger
-from setting import PROJECT_LOG_FILE
+from setting import PROJECT_LOG_FILE, SHINGLE_MAX_FEATURES, SHINGLE_STRIP_HTML, HASH_SCHEME
 
 from manager.similarity_check import InitDB
 from manager.similarity_check import Check
 
 from fingerprints_calculation.simhash import Simhash
-from similarity_calculation.hamming_distance import HammingDistance
+from fingerprints_storage.digest_store import text_digest
+from similarity_calculation.hamming_distance import hamming_distances
+from similarity_calculation.self_join import self_join
+from similarity_calculation.clustering import UnionFind, read_records
 
 logger = Logger('simhash', log2console=False, log2file=True, logfile=PROJECT_LOG_FILE).get_logger()
 
 
 class ArticleDeduplication(object):
 
-    def __init__(self, dedupfile='deduplication', dups_out_file='dups.out', dups_all_file='dups.all', drop_dups_file='dropdups.all'):
+    def __init__(self, dedupfile='deduplication', dups_out_file='dups.out', dups_all_file='dups.all', drop_dups_file='dropdups.all', batch_size=10000, clusters_file='dups.clusters'):
         self.dedupfile = dedupfile
         self.task_queue = Queue()
         self.dups_out_file = dups_out_file
         self.dups_all_file = dups_all_file
         self.drop_dups_file = drop_dups_file
+        self.clusters_file = clusters_file
+        # 每批一次性计算指纹的文章数
+        self.batch_size = batch_size
 
 
-    def get_deduplication(self):
+    def get_deduplication(self, offline=False, distance=6):
+        """
+        :param offline: True 时不经过 redis/mongodb，整个文件一次性两两比对
+        :param distance: 线下比对的最大海明距离，6 与线上 distance=7 (不含) 一致
+        """
         print('>>>>>>>>>>需去重文章文件{}'.format(self.dedupfile))
         self.task_queue = self.get_task()
-        self.__work_with_redis()
+        if offline:
+            self.__work_offline(distance)
+        else:
+            self.__work_with_redis()
         return
 
     def get_task(self):
@@ -50,19 +63,10 @@ class ArticleDeduplication(object):
             for line in lines:
                 dict = json.loads(line.strip('\n'))
                 text_id = dict['article_id']
-                text = self.clean_html(dict['article'])
-                self.task_queue.put((text_id, text))
+                # 原始 html 直接交给分词，清洗与切片在同一遍中完成
+                self.task_queue.put((text_id, dict['article']))
             return self.task_queue
 
-    @staticmethod
-    def clean_html(html):
-        """
-        清洗操作
-        :param html: 文章内容
-        :return: 清洗后string
-        """
-        return html.strip().replace("\n", "").replace("\t", "").replace("\r", "").replace("&amp;", "").replace("&#13;", "").replace("&nbsp;", "")
-
     def __work_with_redis(self):
         """
         进行simhash去重
@@ -71,101 +75,131 @@ class ArticleDeduplication(object):
         :return: 重复文章文件
         """
         init_db = InitDB(logger=logger)
+        siwr = init_db.siwr
+        digest_store = init_db.digest_store
         i = 0
         with open(self.dups_out_file, 'w', encoding='utf-8') as f:
-            while True:
-                i += 1
-                if i % 10000 == 0:
-                    print('已处理{}条数据'.format(i))
-                if self.task_queue.qsize():
-                    item = self.task_queue.get()
-                    text_id, text = item
-                    dups_list, _db = Check(text_id, text, init_db.siwr, logger=logger).check_similarity()
+            while self.task_queue.qsize():
+                # 按批取出任务，先按规范化文本摘要查完全重复，
+                # 只为未命中的文章整批计算指纹，哈希方案与线上 Check 一致
+                batch = [self.task_queue.get() for _ in range(min(self.batch_size, self.task_queue.qsize()))]
+                firsts = [digest_store.check(text_digest(text), text_id) for text_id, text in batch]
+                misses = [task for task, first in zip(batch, firsts) if first is None]
+                _, fingerprints = Simhash.build_many(misses, hashbits=siwr.hashbits, hash_scheme=siwr.hash_scheme,
+                                                     max_features=SHINGLE_MAX_FEATURES,
+                                                     strip_html=SHINGLE_STRIP_HTML)
+                logger.info('Batch of {} exact duplicates {}, digest hits:{} misses:{} hit rate:{:.2%}'.format(
+                    len(batch), len(batch) - len(misses), digest_store.hits, digest_store.misses,
+                    digest_store.hit_rate))
+                fingerprints = iter(fingerprints)
+                for (text_id, text), first in zip(batch, firsts):
+                    i += 1
+                    if i % 10000 == 0:
+                        print('已处理{}条数据'.format(i))
+                    if first is not None:
+                        # 完全重复的文章不计算也不存储指纹
+                        dups_list = [first]
+                    else:
+                        simhash = Simhash(int(next(fingerprints)), hashbits=siwr.hashbits, hash_scheme=siwr.hash_scheme)
+                        # 摘要已查过并存下，Check 不再查一遍，否则会命中文章自己
+                        dups_list, _db = Check(text_id, text, siwr, logger=logger, simhash=simhash).check_similarity()
                     # print({text_id: dups_list})
                     f.write(json.dumps({text_id: dups_list}))
                     f.write('\n')
-                else:
-                    print('队列没任务')
-                    break
+            print('队列没任务')
+        print('>>>>>>>>>>重复文章列表文件{}'.format(self.dups_out_file))
+
+    def __work_offline(self, distance=6):
+        """
+        线下两两比对：整批计算指纹后按块排序自连接，输出格式与 __work_with_redis 相同，
+        每篇文章对应在它之前出现的重复文章列表
+        :param distance: 最大海明距离
+        :return: 重复文章文件
+        """
+        batch = [self.task_queue.get() for _ in range(self.task_queue.qsize())]
+        text_ids, fingerprints = Simhash.build_many(batch, hash_scheme=HASH_SCHEME,
+                                                    max_features=SHINGLE_MAX_FEATURES, strip_html=SHINGLE_STRIP_HTML)
+        print('已计算{}条指纹'.format(len(text_ids)))
+        earlier = [[] for _ in text_ids]
+        for i, j, _ in self_join(fingerprints, distance):
+            for a, b in zip(i.tolist(), j.tolist()):
+                earlier[b].append(a)
+        with open(self.dups_out_file, 'w', encoding='utf-8') as f:
+            for text_id, dups in zip(text_ids, earlier):
+                dups_list = [text_ids[a] for a in sorted(dups)]
+                f.write(json.dumps({text_id: dups_list}))
+                f.write('\n')
         print('>>>>>>>>>>重复文章列表文件{}'.format(self.dups_out_file))
 
     def get_all_dups(self):
         """
-        从重复文件中取出重复列表非空的重复文章列表
+        从重复文件中取出重复列表非空的重复文章列表，逐行读写不整体读入内存
         :param datafile: 重复文章文件
         :param outfile:  重复列表非空重复文章文件
         :return: 重复列表非空重复文章文件
         """
         with open(self.dups_all_file, 'w', encoding='utf-8') as outf:
-            with open(self.dups_out_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    dict = json.loads(line)
-                    for id, v in dict.items():
-                        if len(v):
-                            d = list()
-                            for i in v:
-                                if i != id:
-                                    d.append(i)
-                            if len(d):
-                                outline = json.dumps({id: d})
-                                # print(outline)
-                                outf.write(outline)
-                                outf.write("\n")
+            for record in read_records(self.dups_out_file):
+                for id, v in record.items():
+                    d = [i for i in v if i != id]
+                    if len(d):
+                        outf.write(json.dumps({id: d}))
+                        outf.write("\n")
         print('>>>>>>>>>>需删除的重复id集合的文件{}'.format(self.dups_all_file))
 
+    def get_clusters(self):
+        """
+        一遍读取重复列表非空的重复文章文件，用并查集把传递重复的文章归为一簇
+        :return: UnionFind，每簇保留最先出现的文章
+        """
+        return UnionFind().consume(read_records(self.dups_all_file))
+
     def get_dropid_file(self):
         """
-        从重复列表非空的重复文章文件取出需要删除的文章id
+        从重复列表非空的重复文章文件取出需要删除的文章id，每簇只保留一篇，
+        同时输出每篇重复文章所属的簇及保留的文章
         :param resultfile: 重复列表非空重复文章文件
         :param dropidfile: 需删除的重复id集合的文件
         :return: 需删除的重复id集合的文件
         """
-        id_set = set()
-        dups_set = set()
-        with open(self.dups_all_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in lines:
-                dict = json.loads(line.strip('\n'))
-                for k, v in dict.items():
-                    id_set.add(k)
-                    for i in v:
-                        dups_set.add(i)
-        both = id_set & dups_set
-        # print(len(id_set))
-        # print(len(dups_set))
-        print('>>>>>>>>>>需要删除的重复id长度{}'.format(len(dups_set)))
+        clusters = self.get_clusters()
+        n = 0
         with open(self.drop_dups_file, 'w', encoding='utf-8') as jsonfile:
-            for dup in dups_set:
-                out = json.dumps({"article_id": dup, "dupmark": 0})
-                jsonfile.write(out)
+            for dup in clusters.drop_ids():
+                n += 1
+                jsonfile.write(json.dumps({"article_id": dup, "dupmark": 0}))
                 jsonfile.write('\n')
+        print('>>>>>>>>>>需要删除的重复id长度{}'.format(n))
+        with open(self.clusters_file, 'w', encoding='utf-8') as f:
+            for article_id, cluster, canonical in clusters.clusters():
+                f.write(json.dumps({"article_id": article_id, "cluster": cluster, "canonical": canonical}))
+                f.write('\n')
+        print('>>>>>>>>>>重复文章的簇文件{}'.format(self.clusters_file))
 
     def get_deduplication_article(self, only_dedup='deduplication_only'):
-        all_dups = list()
-        with open(self.dups_all_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in lines:
-                line_json = json.loads(line.strip('\n'))
-                for k, v in line_json.items():
-                    all_dups.append(k)
-                    for i in v:
-                        all_dups.append(i)
-        print('>>>>>>>>>>共有{}重复文章'.format(len(all_dups)))
-        all_article = self.get_article_dict(self.dedupfile)
+        clusters = self.get_clusters()
+        print('>>>>>>>>>>共有{}重复文章'.format(len(clusters)))
+        i = 0
+        # 逐行读取原文件，只写出属于某个簇的文章，每篇一次
         with open(only_dedup, 'w', encoding='utf-8') as de_f:
-            i = 0
-            for k in all_dups:
-                line_dedup = dict()
-                line_dedup["article_id"] = k
-                line_dedup["content"] = all_article[k]
+            for line_json in read_records(self.dedupfile):
+                k = line_json["article_id"]
+                if clusters.cluster(k) is None:
+                    continue
                 i += 1
-                print('>>>>>>>>>已处理{}'.format(i))
-                de_f.write(json.dumps(line_dedup))
+                if i % 10000 == 0:
+                    print('>>>>>>>>>已处理{}'.format(i))
+                de_f.write(json.dumps({"article_id": k, "content": line_json["content"]}))
                 de_f.write('\n')
+        print('>>>>>>>>>已处理{}'.format(i))
 
     def get_distance(self):
         all_dups_article = self.get_article_dict('deduplication_only')
+        # 一次性计算所有重复文章的指纹
+        article_ids, fingerprints = Simhash.build_many(all_dups_article.items(), hash_scheme=HASH_SCHEME,
+                                                       max_features=SHINGLE_MAX_FEATURES,
+                                                       strip_html=SHINGLE_STRIP_HTML)
+        all_dups_fingerprint = dict(zip(article_ids, fingerprints))
         with open("dups.all.distance1", "w", encoding="utf-8") as f:
             with open(self.dups_all_file, "r", encoding="utf-8") as df:
                 lines = df.readlines()
@@ -178,13 +212,9 @@ class ArticleDeduplication(object):
                     line_json = json.loads(line.strip('\n'))
                     for k, v in line_json.items():
                         dups[k] = v
-                        text1 = all_dups_article[k]
-                        distance = list()
-                        for i in v:
-                            text_dups = all_dups_article[i]
-                            d = HammingDistance(Simhash(text1)).distance(Simhash(text_dups))
-                            distance.append(d)
-                        dups["distance"] = distance
+                        candidates = [all_dups_fingerprint[i] for i in v]
+                        distance = hamming_distances(int(all_dups_fingerprint[k]), candidates)
+                        dups["distance"] = distance.tolist()
                         f.write(json.dumps(dups))
                         f.write('\n')
 
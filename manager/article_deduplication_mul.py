@@ -49,8 +49,8 @@ class TaskProduceWorker(Process):
                 line = f.readline().strip('\n')
                 dict = json.loads(line)
                 article_id = dict['article_id']
-                article = self.clean_html(dict['article'])
-                self._article_queue.put((article_id, article))
+                # 原始 html 直接交给分词，清洗与切片在同一遍中完成
+                self._article_queue.put((article_id, dict['article']))
                 logger.info('任务队列长度 {}'.format(self._article_queue.qsize()))
             except Exception as e:
                 self._article_queue.put(None)  # 用 None 通知结束
@@ -59,15 +59,6 @@ class TaskProduceWorker(Process):
                 break
         f.close()
 
-    @staticmethod
-    def clean_html(html):
-        """
-        清洗操作
-        :param html: 文章内容
-        :return: 清洗后string
-        """
-        return html.strip().replace("\n", "").replace("\t", "").replace("\r", "").replace("&amp;", "").replace("&#13;", "").replace("&nbsp;", "")
-
 
 # 消费
 class TaskConsumeWorker(Process):
@@ -92,7 +83,8 @@ class TaskConsumeWorker(Process):
                 if item and self.article_queue.empty:
                     logger.info('待处理的任务队列长度{}'.format(self.article_queue.qsize()))
                     text_id, text = item
-                    dups_list, _db = Check(text_id, text, init_db.siwr, logger=logger).check_similarity()
+                    dups_list, _db = Check(text_id, text, init_db.siwr, logger=logger,
+                                           digest_store=init_db.digest_store).check_similarity()
                     # logger.info('重复文章的计算结果'.format({text_id: dups_list}))
                     self._result_queue.put({text_id: dups_list})
                     logger.info('已计算{}个结果到队列'.format(self._result_queue.qsize()))
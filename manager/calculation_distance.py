@@ -9,7 +9,8 @@
 
 import json
 from fingerprints_calculation.simhash import Simhash
-from similarity_calculation.hamming_distance import HammingDistance
+from setting import SHINGLE_MAX_FEATURES, SHINGLE_STRIP_HTML, HASH_SCHEME
+from similarity_calculation.hamming_distance import hamming_distances
 
 
 def get_distance(filepath, outfile):
@@ -21,22 +22,24 @@ def get_distance(filepath, outfile):
             article = article_json['content']
             print(article_id)
             lines = f.readlines()
-            i = 0
+            articles = [(article_id, article)]
             for line in lines[:10000]:
                 dict = json.loads(line)
-                text_id = dict['article_id']
-                text = dict['content']
-                distance = HammingDistance(Simhash(article)).distance(Simhash(text))
-                out = json.dumps({text_id: distance})
+                articles.append((dict['article_id'], dict['content']))
+            # 整批计算指纹
+            text_ids, fingerprints = Simhash.build_many(articles, hash_scheme=HASH_SCHEME,
+                                                        max_features=SHINGLE_MAX_FEATURES,
+                                                        strip_html=SHINGLE_STRIP_HTML)
+            distances = hamming_distances(int(fingerprints[0]), fingerprints[1:])
+            i = 0
+            for text_id, distance in zip(text_ids[1:], distances):
+                out = json.dumps({text_id: int(distance)})
                 outf.write(out)
                 outf.write('\n')
                 i += 1
                 if i / 1000 == 1:
                     print('>>>>>>>>>>>>已计算{}'.format(i))
 
-def clean_html(html):
-    return html.strip().replace("\n", "").replace("\t", "").replace("\r", "").replace("&amp;", "").replace("&#13;", "").replace("&nbsp;", "")
-
 filepath = 'deduplication'
 outfile = 'test_distance1'
 get_distance(filepath, outfile)
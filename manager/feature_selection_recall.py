@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2018/12/25 11:20
+@File    : feature_selection_recall.py
+@Desc    : 对比 bottom-k 特征选择与全量切片的召回率
+"""
+
+import json
+import time
+
+from fingerprints_calculation.simhash import Simhash
+from similarity_calculation.hamming_distance import hamming_distances
+
+
+def load_labeled_pairs(filepath):
+    """
+    读取已标注的文章对，每行 {"text_a": ..., "text_b": ..., "label": 1 或 0}，1 表示重复
+    :param filepath: 标注文件
+    :return: [(text_a, text_b, label)]
+    """
+    pairs = list()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip('\n')
+            if line:
+                d = json.loads(line)
+                pairs.append((d['text_a'], d['text_b'], int(d['label'])))
+    return pairs
+
+
+def compare_recall(pairs, max_features_list=(None, 256, 512, 1024), distance=3, hash_scheme='md5'):
+    """
+    对每个 max_features 计算指纹，统计重复对的召回率、非重复对的误判率及每篇耗时
+    :param pairs: [(text_a, text_b, label)]
+    :param max_features_list: 需对比的 max_features，None 为全量切片
+    :param distance: 海明距离小于等于该值认为重复
+    :return: {max_features: (recall, false_positive_rate, seconds per article)}
+    """
+    texts = list()
+    for text_a, text_b, _ in pairs:
+        texts.append(text_a)
+        texts.append(text_b)
+    positive = sum(1 for _, _, label in pairs if label)
+    negative = len(pairs) - positive
+
+    result = dict()
+    for max_features in max_features_list:
+        s1 = time.time()
+        _, fingerprints = Simhash.build_many(enumerate(texts), hash_scheme=hash_scheme, max_features=max_features)
+        s2 = time.time()
+        # fingerprints[0::2] ^ fingerprints[1::2], one distance per pair
+        distances = hamming_distances(fingerprints[0::2], fingerprints[1::2])
+        hit = false_hit = 0
+        for d, (_, _, label) in zip(distances, pairs):
+            if d <= distance:
+                if label:
+                    hit += 1
+                else:
+                    false_hit += 1
+        recall = hit / positive if positive else 0.0
+        false_positive_rate = false_hit / negative if negative else 0.0
+        result[max_features] = (recall, false_positive_rate, (s2 - s1) / max(len(texts), 1))
+    return result
+
+
+if __name__ == '__main__':
+    labeled_file = '../../data/labeled_pairs'
+    pairs = load_labeled_pairs(labeled_file)
+    print('>>>>>>>>>>已读入标注文章对{}条'.format(len(pairs)))
+    for max_features, (recall, fpr, secs) in sorted(compare_recall(pairs).items(), key=lambda x: x[0] or float('inf')):
+        print('max_features:{} 召回率:{:.4f} 误判率:{:.4f} 每篇耗时:{:.6f}s'.format(max_features or '全量', recall, fpr, secs))
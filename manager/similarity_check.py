@@ -17,11 +17,16 @@ import time
 
 from db.simhash_mongo import SimhashInvertedIndex, get_all_simhash
 from db.simhash_redis import SimhashRedis
+from db.expiry_sweeper import ExpirySweeper
 from extract_features.extract_features_participle import Participle
-from extract_features.extract_features_tfidf import get_keywords_tfidf
+from extract_features.extract_features_tfidf import get_default_extractor, save_default_extractor
 from fingerprints_calculation.simhash import Simhash
+from fingerprints_calculation.hashfunc import cache_info
+from fingerprints_storage.index_layout import IndexLayout
 from fingerprints_storage.simhash_index_redis import SimhashIndexWithRedis
-from setting import PROJECT_LOG_FILE
+from fingerprints_storage.digest_store import DigestStore, text_digest
+from setting import PROJECT_LOG_FILE, SHINGLE_MAX_FEATURES, SHINGLE_STRIP_HTML, TFIDF_DF_PATH, REDIS_SERVER_FILTER, WRITE_BEHIND, \
+    REDIS_COMPACT_MEMBERS, EXPIRY_SWEEPER, HASH_SCHEME, INDEX_BLOCKS, INDEX_KEY_BLOCKS, INDEX_RECALL_DISTANCE
 from utils.logger import Logger
 import logging
 
@@ -47,15 +52,26 @@ class InitDB(object):
                 self.log.info('Initializing Redis and write data to MongoDB...')
                 self.redis.flushdb()
             else:
-                s4 = time.clock()
+                s4 = time.perf_counter()
                 if load_data_from_mongo_to_redis:
                     self.redis.flushdb()
                     for i in self.get_inverted_index_from_mongodb(self.mongo):
                         self.redis.add(i[2], i[1], i[3])
-                    s5 = time.clock()
+                    s5 = time.perf_counter()
                     self.log.info('Initializing Redis and Loading data from MongoDB to Redis...{}s'.format(s5-s4))
                 self.log.info('Do not load data from MongoDB, calculate new data to load into Redis, and synchronize to MongoDB')
-        self.siwr = SimhashIndexWithRedis(self.mongo, self.redis, logger=self.log)
+        # the html of the articles is stripped before shingling, see SHINGLE_STRIP_HTML
+        self.log.info('Shingling with strip_html={}, the index must hold fingerprints of the same'.format(
+            SHINGLE_STRIP_HTML))
+        layout = IndexLayout(64, INDEX_RECALL_DISTANCE, blocks=INDEX_BLOCKS, key_blocks=INDEX_KEY_BLOCKS)
+        self.siwr = SimhashIndexWithRedis(self.mongo, self.redis, logger=self.log, hash_scheme=HASH_SCHEME,
+                                          layout=layout, server_filter=REDIS_SERVER_FILTER,
+                                          write_behind=WRITE_BEHIND, compact=REDIS_COMPACT_MEMBERS)
+        self.digest_store = DigestStore(self.redis)
+        # reads skip the expired members, the sweeper removes them
+        self.sweeper = ExpirySweeper(self.redis, obj_id_tables=[self.siwr.obj_id_table], logger=self.log)
+        if EXPIRY_SWEEPER:
+            self.sweeper.start()
 
     @staticmethod
     def get_inverted_index_from_mongodb(db):
@@ -65,10 +81,15 @@ class InitDB(object):
 
 class Check(object):
     """main function"""
-    def __init__(self, text_id, text, siwr, logger=None):
+    def __init__(self, text_id, text, siwr, logger=None, simhash=None, digest_store=None):
         self.text_id = text_id
         self.text = text
         self.siwr = siwr
+        # fingerprint computed beforehand, e.g. by Simhash.build_many
+        self.simhash = simhash
+        # exact duplicates are answered by the digest of the text alone
+        self.digest_store = digest_store
+        self.hash_scheme = getattr(siwr, 'hash_scheme', 'md5')
 
         if logger is None:
             self.log = logging.getLogger("simhash")
@@ -77,27 +98,54 @@ class Check(object):
 
     def _extract_features(self, func='participle'):
 
-        if func == 'participle':
-            keywords = Participle().get_text_feature(self.text)
+        if func == 'participle' and self.hash_scheme == 'rolling':
+            # shingle hashes straight from the rolling shingler
+            keywords = Participle(max_features=SHINGLE_MAX_FEATURES,
+                                  strip_html=SHINGLE_STRIP_HTML).get_text_hashes(self.text)
+        elif func == 'participle':
+            keywords = Participle(max_features=SHINGLE_MAX_FEATURES,
+                                  strip_html=SHINGLE_STRIP_HTML).get_text_feature(self.text)
         elif func == 'tfidf':
-            keywords = get_keywords_tfidf(self.text)
+            keywords = get_default_extractor(TFIDF_DF_PATH).get_keywords(self.text)
         else:
             raise Exception('Please provide a custom function ')
 
         return keywords
 
+    def _check_digest(self):
+        """The obj_id of an earlier article with the same normalized text, or None"""
+        s0 = time.perf_counter()
+        first = self.digest_store.check(text_digest(self.text), self.text_id)
+        s1 = time.perf_counter()
+        store = self.digest_store
+        self.log.info('Text_id:{} Exact duplicate check time...{}s, digest hits:{} misses:{} hit rate:{:.2%}'.format(
+            self.text_id, (s1 - s0), store.hits, store.misses, store.hit_rate))
+        return first
+
     def check_similarity(self):
 
-        s1 = time.clock()
-        keywords = self._extract_features()
-        s2 = time.clock()
-        self.log.info('Text_id:{} Word segmentation time...{}s'.format(self.text_id, (s2 - s1)))
-        simhash = Simhash(keywords)
-        s3 = time.clock()
-        self.log.info('Text_id:{} Calculate fingerprint time...{}s'.format(self.text_id, (s3 - s2)))
-        s6 = time.clock()
+        if self.digest_store is not None:
+            first = self._check_digest()
+            if first is not None:
+                # same shingles, same fingerprint: neither computed nor stored again
+                self.log.info('Text_id:{} Exact duplicate of {}'.format(self.text_id, first))
+                return [first], self.siwr
+
+        if self.simhash is None:
+            s1 = time.perf_counter()
+            keywords = self._extract_features()
+            s2 = time.perf_counter()
+            self.log.info('Text_id:{} Word segmentation time...{}s'.format(self.text_id, (s2 - s1)))
+            simhash = Simhash(keywords, hash_scheme=self.hash_scheme)
+            s3 = time.perf_counter()
+            info = cache_info(simhash.hash_scheme)
+            self.log.info('Text_id:{} Calculate fingerprint time...{}s, shingle hash cache hits:{} misses:{} size:{}'.format(
+                self.text_id, (s3 - s2), info.hits, info.misses, info.currsize))
+        else:
+            simhash = self.simhash
+        s6 = time.perf_counter()
         dups_list = self.siwr.get_near_dups(simhash)
-        s7 = time.clock()
+        s7 = time.perf_counter()
         self.log.info('Text_id:{} Find time...{}s'.format(self.text_id, (s7-s6)))
         self.siwr.add(obj_id=self.text_id, simhash=simhash)
         self.log.info('Text_id:{} Add to db...'.format(self.text_id))
@@ -129,14 +177,21 @@ class UpdateDB(object):
 
         self.log.info('Redis has {} keys'.format(self.redis.status))
 
+        # the buffered inserts go to mongodb before redis is reloaded from it
+        self.db.siwr.flush()
+        if save_default_extractor(TFIDF_DF_PATH):
+            self.log.info('Saved the tfidf document frequency to {}'.format(TFIDF_DF_PATH))
         self.redis.flushdb()
+        # the interned obj_ids are flushed as well
+        self.db.siwr.obj_id_table.clear()
+        self.db.siwr.split.clear()
+        self.db.digest_store.clear()
         self.log.info('Now redis have been cleaned {} keys'.format(self.redis.status))
         timeline = self.now - keep_days * 3600 * 24
         # timeline = self.now - 400
         _e2 = time.time()
-        for i in self.mongo.objects(add_time__lte=timeline):
-            i.delete()
-            i.save()
+        # one delete_many instead of a round trip per document
+        self.mongo.objects(add_time__lte=timeline).delete()
         _e3 = time.time()
         self.log.info('Delete timeout data takes...{}s'.format(_e3 - _e2))
         f_mongo_update = self.db.get_inverted_index_from_mongodb(self.mongo)
@@ -171,7 +226,7 @@ if __name__ == '__main__':
                 i += 1
                 item = task_queue.get()
                 text_id, text = item
-                dups_list, _db = Check(text_id, text, init_db.siwr).check_similarity()
+                dups_list, _db = Check(text_id, text, init_db.siwr, digest_store=init_db.digest_store).check_similarity()
                 result_queue.put({text_id: dups_list})
                 print({text_id: dups_list})
                 # init_db.siwr = _db
@@ -192,7 +247,8 @@ if __name__ == '__main__':
             if task_queue.qsize():
                 item = task_queue.get()
                 text_id, text = item
-                dups_list, _db = Check(text_id, text, init_db.siwr, logger=logger).check_similarity()
+                dups_list, _db = Check(text_id, text, init_db.siwr, logger=logger,
+                                       digest_store=init_db.digest_store).check_similarity()
                 print({text_id: dups_list})
                 result_queue.put({text_id: dups_list})
             else:
@@ -30,8 +30,58 @@ SIMHASH_MONGODB_CONFIG = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 SAVE_DAYS = 30
+# the members older than SAVE_DAYS are removed by a background ExpirySweeper,
+# at most SWEEP_KEYS_PER_SECOND keys, SWEEP_BATCH_SIZE of them in a pipeline,
+# a pass over all the keys every SWEEP_INTERVAL seconds
+EXPIRY_SWEEPER = True
+SWEEP_BATCH_SIZE = 100
+SWEEP_KEYS_PER_SECOND = 5000
+SWEEP_INTERVAL = 3600
+# length of a time segment of SegmentedSimhashIndex, SAVE_DAYS of them are kept
+SEGMENT_SECONDS = 3600 * 24
+# a bucket holding more fingerprints than this is split on the rest of the bits
+BUCKET_SPLIT_THRESHOLD = 1000
+# compute the distances inside redis with a Lua script, only the matches are sent back
+REDIS_SERVER_FILTER = False
+# buffer the inserts and write them in batches, a new article is then found
+# only after its batch is written
+WRITE_BEHIND = False
+# a batch is written once this many articles are waiting or after this many seconds
+WRITE_BEHIND_SIZE = 1000
+WRITE_BEHIND_SECONDS = 1.0
+# a failed batch is put back in front and written again with the next ones,
+# its articles are dropped after this many failed retries
+WRITE_BEHIND_RETRIES = 3
+# members as 8 packed bytes and a varint obj_id, run fingerprints_storage/migrate_members.py
+# on the existing keys after switching it on
+REDIS_COMPACT_MEMBERS = False
+# layout of the redis index, see fingerprints_storage.index_layout: the fingerprint
+# is cut into INDEX_BLOCKS blocks, a key is INDEX_KEY_BLOCKS of them, and a query
+# probes every key needed to find all the fingerprints within INDEX_RECALL_DISTANCE.
+# 4 blocks of 1 at distance 6 probe 4 x 17 = 68 keys a query (radius 1), at
+# distance 3 only the 4 keys of the article as before, missing some of the matches
+# at 4 to 6. The keys depend on the blocks, reload redis after changing them
+INDEX_BLOCKS = 4
+INDEX_KEY_BLOCKS = 1
+INDEX_RECALL_DISTANCE = 6
 # REDIS_URL = None
 
+# Simhash setting
+# shingle -> hash LRU cache entries per hash scheme in every process
+SHINGLE_HASH_CACHE_SIZE = 2 ** 17
+# keep at most this many shingles of an article (bottom-k), None keeps all of them
+SHINGLE_MAX_FEATURES = None
+# drop the html tags and entities of an article before shingling. This changes the
+# fingerprint of every html article, the ones stored with the other value no longer
+# match their own re-crawled copies: rebuild the index (flush redis and mongodb and
+# fingerprint the articles again) when changing it
+SHINGLE_STRIP_HTML = True
+# token hash of the fingerprints, see fingerprints_calculation.hashfunc, the
+# fingerprints of another scheme are kept apart under their own version
+HASH_SCHEME = 'md5'
+# digest -> obj_id LRU cache entries of the exact duplicate check in every process
+DIGEST_CACHE_SIZE = 2 ** 17
+
 # project root path setting
 PROJECT_ROOT = dirname(dirname(dirname(os.path.abspath(__file__)))).replace('\\', '/')
 
@@ -43,6 +93,8 @@ PROJECT_LOG_FILE = LOG_PATH + 'simhash_test.log'
 
 # data path setting
 DATA_PATH = PROJECT_ROOT + '/data/'
+# document frequency table of the tfidf features
+TFIDF_DF_PATH = DATA_PATH + 'tfidf_df/'
 
 
 if __name__ == '__main__':
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/3 14:20
+@File    : clustering.py
+@Desc    : cluster the duplicate pairs with a union-find, one article kept per cluster
+"""
+
+import json
+from array import array
+
+from fingerprints_storage.obj_id_table import ObjIdTable
+
+
+class UnionFind(object):
+
+    def __init__(self, obj_id_table=None):
+        """Clusters of duplicate articles
+        The obj_ids are interned as dense ints in the order they are first
+        seen, the forest lives in flat int arrays: the memory grows with the
+        number of distinct articles, never with the number of records.
+        The canonical article of a cluster is the one seen first.
+        Args:
+            obj_id_table: an instance of ObjIdTable
+        """
+        self.table = obj_id_table if obj_id_table is not None else ObjIdTable()
+        self.parent = array('l')
+        self.size = array('l')
+        # the smallest int of the cluster, only kept up to date on the roots
+        self.first = array('l')
+
+    def _add(self, obj_id):
+        n = self.table.intern(obj_id)
+        while len(self.parent) <= n:
+            m = len(self.parent)
+            self.parent.append(m)
+            self.size.append(1)
+            self.first.append(m)
+        return n
+
+    def find(self, n):
+        """The root of the int n, every node on the way is hung on the root"""
+        parent = self.parent
+        root = n
+        while parent[root] != root:
+            root = parent[root]
+        while parent[n] != root:
+            parent[n], n = root, parent[n]
+        return root
+
+    def union(self, a, b):
+        """Put the obj_ids a and b in the same cluster"""
+        ra = self.find(self._add(a))
+        rb = self.find(self._add(b))
+        if ra == rb:
+            return
+        # the smaller tree goes under the larger one
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        self.first[ra] = min(self.first[ra], self.first[rb])
+
+    def add_dups(self, obj_id, dups):
+        """One record of the dups file, an article and its duplicates
+        The duplicates came before the article, they are interned first.
+        """
+        for dup in dups:
+            self._add(dup)
+        self._add(obj_id)
+        for dup in dups:
+            if dup != obj_id:
+                self.union(obj_id, dup)
+
+    def consume(self, records):
+        """Records are (a, b) pairs or {obj_id: dups_list} dicts, in one pass
+        Returns:
+            self
+        """
+        for record in records:
+            if isinstance(record, dict):
+                for obj_id, dups in record.items():
+                    self.add_dups(obj_id, dups)
+            else:
+                self.union(record[0], record[1])
+        return self
+
+    def cluster(self, obj_id):
+        """The cluster id of an obj_id, None if it has never been seen"""
+        n = self.table.get(obj_id)
+        if n is None or n >= len(self.parent):
+            return None
+        return self.first[self.find(n)]
+
+    def canonical(self, obj_id):
+        """The obj_id kept for the cluster of obj_id"""
+        c = self.cluster(obj_id)
+        return None if c is None else self.table.lookup(c)
+
+    def clusters(self):
+        """(obj_id, cluster id, canonical obj_id) of every article in a cluster
+        of more than one, in the order they are first seen
+        """
+        for n in range(len(self.parent)):
+            root = self.find(n)
+            if self.size[root] > 1:
+                c = self.first[root]
+                yield self.table.lookup(n), c, self.table.lookup(c)
+
+    def drop_ids(self):
+        """The obj_ids to drop, every article of a cluster but the canonical one"""
+        for n in range(len(self.parent)):
+            if self.first[self.find(n)] != n:
+                yield self.table.lookup(n)
+
+    def __len__(self):
+        return len(self.parent)
+
+
+def read_records(filepath):
+    """The records of a dups file one by one, without reading the whole file"""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip('\n')
+            if line:
+                yield json.loads(line)
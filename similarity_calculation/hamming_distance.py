@@ -6,8 +6,83 @@
 @File    : hamming_distance.py
 @Desc    : hamming distance
 """
+from collections import namedtuple
+
 from fingerprints_calculation.simhash import Simhash
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if np is not None:
+    # number of set bits of every byte value
+    POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# a near duplicate found by an index, score = 1 - distance / hashbits
+Match = namedtuple('Match', ['obj_id', 'distance', 'score'])
+
+
+def popcount(x):
+    """Number of set bits of a non-negative int"""
+    try:
+        return x.bit_count()
+    except AttributeError:
+        # int.bit_count is only in Python 3.10+
+        return bin(x).count('1')
+
+
+def hamming_distances(fingerprint, candidates, hashbits=64):
+    """Hamming distance between one fingerprint and an array of fingerprints
+    Args:
+        fingerprint: an int
+        candidates: uint64 numpy array (or a list of int) of fingerprints
+        hashbits: the dimensions of fingerprint, at most 64
+    Returns:
+        an int array of distances, the same length as `candidates`
+    """
+    x = np.asarray(candidates, dtype=np.uint64) ^ np.uint64(fingerprint & ((1 << 64) - 1))
+    if hashbits < 64:
+        x &= np.uint64((1 << hashbits) - 1)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int64)
+    # XOR, then look the bit count of each of the 8 bytes up and add them
+    octets = np.ascontiguousarray(x).view(np.uint8).reshape(-1, 8)
+    return POPCOUNT_TABLE[octets].sum(axis=1, dtype=np.int64)
+
+
+def within_distance(fingerprint, candidates, distance, hashbits=64):
+    """Score a whole bucket at once
+    Returns:
+        (distances, mask), mask is True for the candidates whose distance <= `distance`
+    """
+    d = hamming_distances(fingerprint, candidates, hashbits)
+    return d, d <= distance
+
+
+def similarity_score(distance, hashbits=64):
+    """1 - d / hashbits, 1.0 for the same fingerprint and 0.0 for the complement"""
+    return 1.0 - float(distance) / hashbits
+
+
+def collect_matches(matches, obj_ids, distances, mask, hashbits=64):
+    """Add the masked candidates of a bucket to `matches`, a dict of obj_id -> Match
+    An obj_id met in several buckets has the same distance in all of them,
+    so it is kept once.
+    """
+    for i in np.flatnonzero(mask):
+        obj_id = obj_ids[i]
+        if obj_id not in matches:
+            d = int(distances[i])
+            matches[obj_id] = Match(obj_id, d, similarity_score(d, hashbits))
+    return matches
+
+
+def sorted_matches(matches):
+    """The matches nearest first, ties broken by obj_id"""
+    return sorted(matches, key=lambda m: (m.distance, m.obj_id))
+
+
 class HammingDistance(object):
 
     def __init__(self, simhash, hashbits=64):
@@ -27,15 +102,12 @@ class HammingDistance(object):
     def distance(self, another_fingerprint):
         assert self.hashbits == another_fingerprint.hashbits
         x = (self.simhash.fingerprint ^ another_fingerprint.fingerprint) & ((1 << self.hashbits) - 1)
-        tot = 0
-        while x:
-            tot += 1
-            x &= x - 1
-        return tot
+        return popcount(x)
+
+    def distances(self, candidates):
+        """Distances to an uint64 array of fingerprints, see hamming_distances"""
+        return hamming_distances(self.simhash.fingerprint, candidates, self.hashbits)
 
     def similarity(self, another_fingerprint):
-        a = float(self.simhash.fingerprint)
-        b = float(another_fingerprint.fingerprint)
-        if a > b:
-            return '{}%'.format(b / a * 100, '0.02f')
-        return '{}%'.format(a / b * 100, '0.02f')
\ No newline at end of file
+        """1 - d / hashbits, see similarity_score"""
+        return similarity_score(self.distance(another_fingerprint), self.hashbits)
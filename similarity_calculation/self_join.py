@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/2 10:30
+@File    : self_join.py
+@Desc    : all the pairs of near duplicates of a corpus, without any database
+"""
+
+import logging
+import time
+
+import numpy as np
+
+from fingerprints_storage.index_layout import plan_layout
+from similarity_calculation.hamming_distance import hamming_distances
+
+
+def self_join(fingerprints, distance=3, hashbits=64, layout=None):
+    """Every pair of fingerprints within `distance`
+    For each table of the layout the fingerprints are sorted by the key of the
+    table, only the fingerprints of a run of equal keys are compared: each one
+    with the next in the run, then with the one after, and so on, a whole step
+    at a time. A pair sharing the keys of several tables is emitted by the
+    first of them only.
+    Args:
+        fingerprints: uint64 array (or a list of int)
+        distance: the largest distance of a pair
+        hashbits: the same with the one for Simhash
+        layout: an instance of IndexLayout with radius 0, planned for the size of the corpus by default
+    Returns:
+        a generator of (i, j, d) int arrays, i < j are positions in `fingerprints`
+    """
+    fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+    n = len(fingerprints)
+    if layout is None:
+        layout = plan_layout(hashbits, distance, n=max(n, 1), max_radius=0)
+    assert layout.radius == 0 and layout.distance >= distance
+    logging.info('Self join of %s fingerprints with %s', n, layout)
+
+    positions = np.arange(n)
+    for t in range(len(layout.tables)):
+        keys = layout.table_keys(fingerprints, t)
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        sorted_fingerprints = fingerprints[order]
+        # the end of the run of every position
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        ends = np.append(starts[1:], n)
+        run_end = np.repeat(ends, ends - starts)
+
+        step = 1
+        p = positions[run_end - positions > step]
+        while p.size:
+            q = p + step
+            d = hamming_distances(0, sorted_fingerprints[p] ^ sorted_fingerprints[q], hashbits)
+            hit = d <= distance
+            if hit.any():
+                a = order[p[hit]]
+                b = order[q[hit]]
+                d = d[hit]
+                # skip the pairs an earlier table has already emitted
+                first = np.ones(len(a), dtype=bool)
+                for earlier in range(t):
+                    first &= layout.table_keys(fingerprints[a], earlier) != layout.table_keys(fingerprints[b], earlier)
+                if first.any():
+                    a, b, d = a[first], b[first], d[first]
+                    yield np.minimum(a, b), np.maximum(a, b), d
+            step += 1
+            p = p[run_end[p] - p > step]
+
+
+def iter_pairs(fingerprints, distance=3, hashbits=64, layout=None):
+    """The pairs of self_join one by one, (i, j, d)"""
+    for i, j, d in self_join(fingerprints, distance, hashbits, layout):
+        for pair in zip(i.tolist(), j.tolist(), d.tolist()):
+            yield pair
+
+
+if __name__ == '__main__':
+    import random
+
+    count = 10 ** 6
+    random.seed(0)
+    base = [random.getrandbits(64) for _ in range(count // 2)]
+    # half of them have a near duplicate
+    near = [fp ^ (1 << random.randrange(64)) ^ (1 << random.randrange(64)) for fp in base]
+    fingerprints = np.array(base + near, dtype=np.uint64)
+    for distance in (3, 6):
+        s1 = time.time()
+        pairs = sum(len(i) for i, _, _ in self_join(fingerprints, distance))
+        s2 = time.time()
+        print('{}条指纹 距离{} 找到{}对 耗时{:.3f}s'.format(count, distance, pairs, s2 - s1))
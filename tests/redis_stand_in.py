@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/5 10:40
+@File    : redis_stand_in.py
+@Desc    : a local redis-server stand-in with a network delay, for tests and benchmarks
+"""
+
+import fnmatch
+import hashlib
+import select
+import socket
+import socketserver
+import threading
+import time
+
+from db.simhash_redis import HAMMING_FILTER_SCRIPT, INTERN_SCRIPT, EXPIRE_IDS_SCRIPT
+
+
+class RedisStandIn(object):
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        """The commands of SimhashRedis over the redis protocol, in memory
+        Every batch of commands read from the socket waits `latency` seconds
+        before its replies are sent, like one round trip on the network: a
+        pipeline pays it once, a command at a time pays it every time.
+        Args:
+            port: 0 picks a free port, see self.port
+            latency: seconds of a round trip
+        """
+        self.latency = latency
+        self.data = {}
+        self.expires = {}
+        # key -> how many times it was written, see WATCH
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.bytes_sent = 0
+        # sha1 -> the python twin of a loaded script, see SCRIPTS
+        self.scripts = {}
+        stand_in = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                stand_in._serve(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _serve(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = b''
+        # RESP2 until the client says HELLO 3
+        protocol = 2
+        # the commands between MULTI and EXEC, None outside a transaction
+        queued = None
+        # WATCHed key -> its version when it was watched
+        watched = {}
+        while True:
+            try:
+                data = sock.recv(1 << 16)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            # what the client has already sent goes in the same round trip
+            while select.select([sock], [], [], 0.0001)[0]:
+                data = sock.recv(1 << 16)
+                if not data:
+                    break
+                buf += data
+            replies = []
+            pos = 0
+            while True:
+                parsed = _parse(buf, pos)
+                if parsed is None:
+                    break
+                args, pos = parsed
+                if args[0].upper() == b'HELLO':
+                    protocol = int(args[1]) if len(args) > 1 else protocol
+                    replies.append(_encode({'server': 'redis', 'version': '6.0.0', 'proto': protocol}, protocol))
+                    continue
+                command = args[0].upper()
+                if command == b'MULTI':
+                    queued = []
+                    replies.append(_encode('OK'))
+                    continue
+                if command == b'DISCARD':
+                    queued = None
+                    watched.clear()
+                    replies.append(_encode('OK'))
+                    continue
+                if command in (b'WATCH', b'UNWATCH') and queued is None:
+                    with self.lock:
+                        if command == b'WATCH':
+                            watched.update((name, self.versions.get(name, 0)) for name in args[1:])
+                        else:
+                            watched.clear()
+                    replies.append(_encode('OK'))
+                    continue
+                if queued is not None and command != b'EXEC':
+                    queued.append(args)
+                    replies.append(_encode('QUEUED'))
+                    continue
+                with self.lock:
+                    if command == b'EXEC':
+                        if queued is None:
+                            reply = ValueError('ERR EXEC without MULTI')
+                        elif any(self.versions.get(name, 0) != version for name, version in watched.items()):
+                            # a watched key was written, nothing is run
+                            reply = None
+                            queued = None
+                        else:
+                            reply = []
+                            for queued_args in queued:
+                                try:
+                                    reply.append(self.execute(*queued_args))
+                                except Exception as e:
+                                    reply.append(e)
+                            queued = None
+                        watched.clear()
+                    else:
+                        try:
+                            reply = self.execute(*args)
+                        except Exception as e:
+                            reply = e
+                replies.append(_encode(reply, protocol))
+            buf = buf[pos:]
+            if replies:
+                payload = b''.join(replies)
+                self.round_trips += 1
+                self.bytes_sent += len(payload)
+                if self.latency:
+                    time.sleep(self.latency)
+                sock.sendall(payload)
+
+    def _value(self, name, kind):
+        when = self.expires.get(name)
+        if when is not None and when <= time.time():
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        value = self.data.get(name)
+        if value is None:
+            return None
+        if value[0] != kind:
+            raise ValueError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value[1]
+
+    def _create(self, name, kind, empty):
+        value = self._value(name, kind)
+        if value is None:
+            value = empty
+            self.data[name] = (kind, value)
+        return value
+
+    def _sorted(self, name):
+        zset = self._value(name, 'zset') or {}
+        return sorted(zset.items(), key=lambda item: (item[1], item[0]))
+
+    def execute(self, command, *args):
+        command = command.decode().upper()
+        method = getattr(self, 'cmd_' + command.lower(), None)
+        if method is None:
+            raise ValueError("ERR unknown command '{}'".format(command))
+        if command in WRITE_COMMANDS:
+            self._touch(args[:1])
+        elif command == 'DEL':
+            self._touch(args)
+        elif command in ('EVAL', 'EVALSHA'):
+            self._touch(args[2:2 + int(args[1])])
+        elif command == 'FLUSHDB':
+            self._touch(list(self.data))
+        return method(*args)
+
+    def _touch(self, names):
+        """A new version of every name, the transactions watching it fail"""
+        for name in names:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    def cmd_ping(self, *args):
+        return 'PONG'
+
+    def cmd_zadd(self, name, *args):
+        zset = self._create(name, 'zset', {})
+        nx = args[:1] == (b'NX',)
+        if nx:
+            args = args[1:]
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            if nx and member in zset:
+                continue
+            added += member not in zset
+            zset[member] = float(score)
+        return added
+
+    def cmd_zrange(self, name, start, stop, *options):
+        items = self._sorted(name)
+        start, stop = int(start), int(stop)
+        stop = len(items) + stop if stop < 0 else stop
+        return _range_reply(items[start:stop + 1], options)
+
+    def cmd_zrangebyscore(self, name, low, high, *options):
+        low, high = _score(low), _score(high)
+        return _range_reply([(m, s) for m, s in self._sorted(name) if low(s, 1) and high(s, -1)], options)
+
+    def cmd_zremrangebyscore(self, name, low, high):
+        low, high = _score(low), _score(high)
+        zset = self._value(name, 'zset') or {}
+        removed = [m for m, s in zset.items() if low(s, 1) and high(s, -1)]
+        for m in removed:
+            del zset[m]
+        return len(removed)
+
+    def cmd_zcard(self, name):
+        return len(self._value(name, 'zset') or {})
+
+    def cmd_zrem(self, name, *members):
+        zset = self._value(name, 'zset') or {}
+        return sum(zset.pop(m, None) is not None for m in members)
+
+    def cmd_zscore(self, name, member):
+        score = (self._value(name, 'zset') or {}).get(member)
+        return score
+
+    def cmd_expireat(self, name, when):
+        if name not in self.data:
+            return 0
+        self.expires[name] = int(when)
+        return 1
+
+    def cmd_del(self, *names):
+        return sum(self.data.pop(name, None) is not None for name in names)
+
+    def cmd_type(self, name):
+        value = self.data.get(name)
+        return 'none' if value is None else value[0]
+
+    def cmd_keys(self, pattern):
+        return [name for name in list(self.data) if fnmatch.fnmatchcase(name.decode(), pattern.decode())]
+
+    def cmd_scan(self, cursor, *options):
+        # the cursor is a position in the sorted keys
+        pattern = b'*'
+        count = 10
+        for option, value in zip(options[::2], options[1::2]):
+            if option.upper() == b'MATCH':
+                pattern = value
+            elif option.upper() == b'COUNT':
+                count = int(value)
+        names = sorted(self.cmd_keys(pattern))
+        start = int(cursor)
+        stop = start + count
+        return [str(stop if stop < len(names) else 0).encode(), names[start:stop]]
+
+    def cmd_flushdb(self, *args):
+        self.data.clear()
+        self.expires.clear()
+        return 'OK'
+
+    def cmd_dbsize(self):
+        return len(self.data)
+
+    def cmd_get(self, name):
+        return self._value(name, 'string')
+
+    def cmd_set(self, name, value, *options):
+        options = [o.upper() for o in options]
+        if b'NX' in options and self._value(name, 'string') is not None:
+            return None
+        self.data[name] = ('string', value)
+        self.expires.pop(name, None)
+        if b'EX' in options:
+            self.expires[name] = time.time() + int(options[options.index(b'EX') + 1])
+        return 'OK'
+
+    def cmd_incrby(self, name, amount):
+        value = int(self._value(name, 'string') or 0) + int(amount)
+        self.data[name] = ('string', str(value).encode())
+        return value
+
+    def cmd_incr(self, name):
+        return self.cmd_incrby(name, 1)
+
+    def cmd_hget(self, name, key):
+        return (self._value(name, 'hash') or {}).get(key)
+
+    def cmd_hmget(self, name, *keys):
+        h = self._value(name, 'hash') or {}
+        return [h.get(key) for key in keys]
+
+    def cmd_hset(self, name, key, value):
+        h = self._create(name, 'hash', {})
+        new = key not in h
+        h[key] = value
+        return int(new)
+
+    def cmd_hsetnx(self, name, key, value):
+        h = self._create(name, 'hash', {})
+        if key in h:
+            return 0
+        h[key] = value
+        return 1
+
+    def cmd_hdel(self, name, *keys):
+        h = self._value(name, 'hash') or {}
+        return sum(h.pop(key, None) is not None for key in keys)
+
+    def cmd_hgetall(self, name):
+        return dict(self._value(name, 'hash') or {})
+
+    def cmd_hlen(self, name):
+        return len(self._value(name, 'hash') or {})
+
+    def cmd_script(self, subcommand, *args):
+        subcommand = subcommand.upper()
+        if subcommand == b'LOAD':
+            source = args[0].decode()
+            if source not in SCRIPTS:
+                raise ValueError('ERR no python twin for the script')
+            sha = hashlib.sha1(args[0]).hexdigest()
+            self.scripts[sha] = SCRIPTS[source]
+            return sha.encode()
+        if subcommand == b'EXISTS':
+            return [int(sha.decode() in self.scripts) for sha in args]
+        if subcommand == b'FLUSH':
+            self.scripts.clear()
+            return 'OK'
+        raise ValueError("ERR unknown subcommand '{}'".format(subcommand.decode()))
+
+    def cmd_evalsha(self, sha, numkeys, *args):
+        func = self.scripts.get(sha.decode())
+        if func is None:
+            raise ValueError('NOSCRIPT No matching script. Please use EVAL.')
+        numkeys = int(numkeys)
+        return func(self, list(args[:numkeys]), list(args[numkeys:]))
+
+    def cmd_eval(self, source, numkeys, *args):
+        sha = self.cmd_script(b'LOAD', source)
+        return self.cmd_evalsha(sha, numkeys, *args)
+
+
+def _hamming_filter(server, keys, args):
+    """HAMMING_FILTER_SCRIPT in python, the fingerprint cut in the same two halves"""
+    hi, lo, max_distance = int(args[0]), int(args[1]), int(args[2])
+    timeline = args[3]
+    result = []
+    for key in keys:
+        if timeline:
+            members = server.cmd_zrangebyscore(key, b'(' + timeline, b'+inf')
+        else:
+            members = server.cmd_zrange(key, b'0', b'-1')
+        found = []
+        for member in members:
+            if member[:1] == b'\x00' and len(member) >= 10:
+                fingerprint = int.from_bytes(member[1:9], 'big')
+                if bin(fingerprint ^ (hi << 32 | lo)).count('1') <= max_distance:
+                    found.append(member)
+                continue
+            if b',' not in member:
+                found.append(member)
+                continue
+            hexfp = member.split(b',', 1)[0]
+            try:
+                h = int(hexfp[:-8], 16) if len(hexfp) > 8 else 0
+                l = int(hexfp[-8:], 16)
+            except ValueError:
+                continue
+            if bin((h ^ hi) & 0xffffffff).count('1') + bin((l ^ lo) & 0xffffffff).count('1') <= max_distance:
+                found.append(member)
+        result.append(found)
+    return result
+
+
+def _intern(server, keys, args):
+    """INTERN_SCRIPT in python"""
+    fwd, rev, counter, seen = keys
+    result = []
+    for obj_id, t in zip(args[::2], args[1::2]):
+        n = server.cmd_hget(fwd, obj_id)
+        if n is None:
+            n = str(server.cmd_incr(counter)).encode()
+            server.cmd_hset(fwd, obj_id, n)
+        server.cmd_hset(rev, n, obj_id)
+        score = server.cmd_zscore(seen, n)
+        if score is None or score < float(t):
+            server.cmd_zadd(seen, t, n)
+        result.append(int(n))
+    return result
+
+
+def _expire_ids(server, keys, args):
+    """EXPIRE_IDS_SCRIPT in python"""
+    fwd, rev, _, seen = keys
+    ns = server.cmd_zrangebyscore(seen, b'-inf', args[0])[:int(args[1])]
+    for n in ns:
+        obj_id = server.cmd_hget(rev, n)
+        if obj_id is not None:
+            server.cmd_hdel(rev, n)
+            if server.cmd_hget(fwd, obj_id) == n:
+                server.cmd_hdel(fwd, obj_id)
+        server.cmd_zrem(seen, n)
+    return len(ns)
+
+
+# the commands which change their first key, see WATCH
+WRITE_COMMANDS = {'ZADD', 'ZREM', 'ZREMRANGEBYSCORE', 'EXPIREAT', 'SET', 'INCR', 'INCRBY', 'HSET', 'HSETNX', 'HDEL'}
+
+# source of a script -> the python function which stands in for it
+SCRIPTS = {HAMMING_FILTER_SCRIPT: _hamming_filter, INTERN_SCRIPT: _intern, EXPIRE_IDS_SCRIPT: _expire_ids}
+
+
+def _score(bound):
+    """A bound of ZRANGEBYSCORE, as a test of a score, side 1 for min and -1 for max"""
+    bound = bound.decode()
+    exclusive = bound.startswith('(')
+    value = float(bound.lstrip('('))
+
+    def test(score, side):
+        if side > 0:
+            return score > value if exclusive else score >= value
+        return score < value if exclusive else score <= value
+    return test
+
+
+class _Pairs(list):
+    """(member, score) pairs, flat in RESP2 and nested in RESP3"""
+
+
+def _range_reply(items, options):
+    if any(o.upper() == b'WITHSCORES' for o in options):
+        return _Pairs(items)
+    return [m for m, _ in items]
+
+
+def _parse(buf, pos=0):
+    """One command of the redis protocol from buf at pos, (args, next pos) or None if incomplete"""
+    end = buf.find(b'\r\n', pos)
+    if end < 0:
+        return None
+    if buf[pos:pos + 1] != b'*':
+        # an inline command
+        return buf[pos:end].split(), end + 2
+    n = int(buf[pos + 1:end])
+    pos = end + 2
+    args = []
+    for _ in range(n):
+        end = buf.find(b'\r\n', pos)
+        if end < 0:
+            return None
+        size = int(buf[pos + 1:end])
+        pos = end + 2
+        if len(buf) < pos + size + 2:
+            return None
+        args.append(buf[pos:pos + size])
+        pos += size + 2
+    return args, pos
+
+
+def _encode(reply, protocol=2):
+    if reply is None:
+        return b'_\r\n' if protocol == 3 else b'$-1\r\n'
+    if isinstance(reply, Exception):
+        message = str(reply)
+        if not message.split(' ', 1)[0].isupper():
+            message = 'ERR ' + message
+        return '-{}\r\n'.format(message).encode()
+    if isinstance(reply, bool) or isinstance(reply, int):
+        return ':{}\r\n'.format(int(reply)).encode()
+    if isinstance(reply, float):
+        score = '{:.17g}'.format(reply)
+        return ',{}\r\n'.format(score).encode() if protocol == 3 else _encode(score.encode())
+    if isinstance(reply, str):
+        return '+{}\r\n'.format(reply).encode()
+    if isinstance(reply, bytes):
+        return b'$' + str(len(reply)).encode() + b'\r\n' + reply + b'\r\n'
+    if isinstance(reply, dict):
+        items = [x for item in reply.items() for x in item]
+        if protocol == 3:
+            return b'%' + str(len(reply)).encode() + b'\r\n' + b''.join(_encode(r, protocol) for r in items)
+        reply = items
+    elif isinstance(reply, _Pairs):
+        reply = [list(pair) for pair in reply] if protocol == 3 else [x for pair in reply for x in pair]
+    return b'*' + str(len(reply)).encode() + b'\r\n' + b''.join(_encode(r, protocol) for r in reply)
+
+
+if __name__ == '__main__':
+    import random
+    from db.simhash_redis import SimhashRedis
+    from fingerprints_calculation.simhash import Simhash
+    from fingerprints_storage.simhash_index_redis import SimhashIndexWithRedis
+    from fingerprints_storage.obj_id_table import ObjIdTable
+
+    count = 100000
+    with RedisStandIn(latency=0.0005) as stand_in:
+        redis = SimhashRedis(redis_host=stand_in.host, redis_port=stand_in.port)
+        table = ObjIdTable()
+        index = SimhashIndexWithRedis(None, redis, obj_id_table=table, split_threshold=None)
+        filtered = SimhashIndexWithRedis(None, redis, obj_id_table=table, split_threshold=None, server_filter=True)
+        now = int(time.time())
+        # a tenth of them share their first block, a hot bucket
+        hot = random.getrandbits(16)
+        fingerprints = [random.getrandbits(64) for _ in range(count)]
+        fingerprints = [fp & ~0xffff | hot if n % 10 == 0 else fp for n, fp in enumerate(fingerprints)]
+        pipe = redis.redis.pipeline(transaction=False)
+        for n, fp in enumerate(fingerprints):
+            for _, key in index._keys(Simhash(fp)):
+                pipe.execute_command('ZADD', key, now, index._member(fp, table.intern(str(n))))
+        pipe.execute()
+
+        def find_one_by_one(simhash):
+            # the reads before the pipeline, two round trips per key
+            for key in index.get_probe_keys(simhash):
+                redis.get_values(key)
+
+        for name, func in (('逐个读取', find_one_by_one), ('流水线读取', index.find_near_dups),
+                           ('服务端过滤', filtered.find_near_dups)):
+            latencies = []
+            before = stand_in.round_trips
+            sent = stand_in.bytes_sent
+            for fp in fingerprints[:500]:
+                s1 = time.time()
+                func(Simhash(fp ^ 0b101))
+                latencies.append(time.time() - s1)
+            latencies.sort()
+            print('{}: 每次查询{:.1f}次往返 {:.0f}字节 p50:{:.2f}ms p99:{:.2f}ms'.format(
+                name, (stand_in.round_trips - before) / 500.0, (stand_in.bytes_sent - sent) / 500.0,
+                latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
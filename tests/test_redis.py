@@ -4,14 +4,45 @@
 @Author  : Joshua
 @Time    : 2018/10/15 19:34
 @File    : test_redis.py
-@Desc    : 
+@Desc    : redis backend test
 """
 
+from unittest import TestCase, skipUnless
+
 import asyncio
+import os
+import random
+import time
+
 import redis
 
+from fingerprints_calculation.simhash import Simhash
+from fingerprints_storage.obj_id_table import ObjIdTable, RedisObjIdTable
+from fingerprints_storage.member_codec import encode_varint, decode_varint, compact_member, text_member, decode_member
+from fingerprints_storage.migrate_members import migrate_members
+from fingerprints_storage.simhash_index_redis import SimhashIndexWithRedis, SPLIT_MARKER, SPLIT_MARKER_SCORE
+from fingerprints_storage.write_behind import WriteBehindBuffer
+from db.simhash_redis import SimhashRedis
+from db.expiry_sweeper import ExpirySweeper
+from setting import REDIS_HOST, REDIS_PORT
+from tests.redis_stand_in import RedisStandIn
+
 now = lambda: time.time()
 
+# the db of the redis-server at REDIS_HOST:REDIS_PORT the Lua scripts are run on,
+# e.g. SIMHASH_TEST_REDIS_DB=15, it is flushed
+TEST_REDIS_DB = os.environ.get('SIMHASH_TEST_REDIS_DB')
+
+
+def redis_server_up():
+    if TEST_REDIS_DB is None:
+        return False
+    try:
+        return redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=int(TEST_REDIS_DB), socket_connect_timeout=1).ping()
+    except redis.exceptions.RedisError:
+        return False
+
+
 def get_redis():
     connection_pool = redis.ConnectionPool(host='127.0.0.1', db=3)
     return redis.Redis(connection_pool=connection_pool)
@@ -46,6 +77,383 @@ def main():
     finally:
         loop.close()
 
+
+class TestSimhashRedis(TestCase):
+
+    def setUp(self):
+        self.stand_in = RedisStandIn().start()
+        self.redis = SimhashRedis(redis_host=self.stand_in.host, redis_port=self.stand_in.port)
+        self.table = ObjIdTable()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        self.stand_in.stop()
+
+    def add_members(self, index, fps):
+        """The members of fps under doc<n>, written with raw ZADDs"""
+        for n, fp in enumerate(fps):
+            for _, key in index._keys(Simhash(fp)):
+                self.redis.redis.execute_command('ZADD', key, self.now,
+                                                 index._member(fp, self.table.intern('doc{}'.format(n))))
+
+    def test_pipelined_probe(self):
+        random.seed(21)
+        index = SimhashIndexWithRedis(None, self.redis, obj_id_table=self.table)
+        fps = [random.getrandbits(64) for _ in range(200)]
+        self.add_members(index, fps)
+        # an expired member is skipped, a legacy member is still read
+        old_key = next(index.get_keys(Simhash(fps[0])))
+        self.redis.redis.execute_command('ZADD', old_key, self.now - 3600 * 24 * 400, '{:x},old'.format(fps[0]))
+        self.redis.redis.execute_command('ZADD', old_key, self.now, '{:x},legacy'.format(fps[0] ^ 0b11))
+
+        before = self.stand_in.round_trips
+        matches = index.find_near_dups(Simhash(fps[0] ^ 0b1))
+        self.assertEqual(self.stand_in.round_trips - before, 1)
+        self.assertEqual([(m.obj_id, m.distance) for m in matches], [('doc0', 1), ('legacy', 1)])
+        # reads leave it to the sweeper
+        self.assertIsNotNone(self.redis.get_score(old_key, '{:x},old'.format(fps[0])))
+
+        # a bucket found split is read again with its sub-buckets
+        for v in self.redis.get_values(old_key):
+            for sub_key in index.get_sub_keys(old_key, 0, int(v.split(b',')[0], 16)):
+                self.redis.redis.execute_command('ZADD', sub_key, self.now, v)
+            self.redis.delete(old_key, v)
+        self.redis.redis.execute_command('ZADD', old_key, SPLIT_MARKER_SCORE, SPLIT_MARKER)
+        self.assertEqual([m.obj_id for m in index.find_near_dups(Simhash(fps[0] ^ 0b1))], ['doc0', 'legacy'])
+        before = self.stand_in.round_trips
+        self.assertEqual([m.obj_id for m in index.find_near_dups(Simhash(fps[0] ^ 0b1))], ['doc0', 'legacy'])
+        self.assertEqual(self.stand_in.round_trips - before, 1)
+
+    def test_split(self):
+        random.seed(24)
+        index = SimhashIndexWithRedis(None, self.redis, obj_id_table=self.table, split_threshold=None,
+                                      key_prefix='s1/', expire_at=self.now + 3600)
+        base = random.getrandbits(64)
+        # one hot bucket of table 0
+        fps = [base ^ (random.getrandbits(48) << 16) for _ in range(300)]
+        self.add_members(index, fps)
+        key = next(index.get_keys(Simhash(base)))
+        expected = [index.get_near_dups(Simhash(fp)) for fp in fps[:20]]
+
+        before = self.stand_in.round_trips
+        index._split(key, 0)
+        # read, fill the sub-buckets, set the marker and remove the members
+        self.assertEqual(self.stand_in.round_trips - before, 3)
+        self.assertEqual(self.redis.get_values(key), [SPLIT_MARKER.encode()])
+        sub_keys = index.get_sub_keys(key, 0, fps[0])
+        self.assertEqual(len(sub_keys), len(list(index.layout.sub_keys(0, 0))))
+        self.assertEqual(self.stand_in.expires.get(sub_keys[0].encode()), self.now + 3600)
+        self.assertEqual(self.stand_in.expires.get(key.encode()), self.now + 3600)
+        self.assertEqual([index.get_near_dups(Simhash(fp)) for fp in fps[:20]], expected)
+
+    def test_server_filter(self):
+        random.seed(22)
+        index = SimhashIndexWithRedis(None, self.redis, obj_id_table=self.table)
+        filtered = SimhashIndexWithRedis(None, self.redis, obj_id_table=self.table, server_filter=True)
+        # a hot first block, near and far fingerprints in the same buckets
+        base = random.getrandbits(64)
+        fps = [base ^ (random.getrandbits(48) << 16) for _ in range(300)]
+        fps += [base ^ (1 << random.randrange(64)) ^ (1 << random.randrange(64)) for _ in range(30)]
+        fps += [fp & 0xffffffff for fp in fps[:10]]
+        self.add_members(index, fps)
+        self.redis.redis.execute_command('ZADD', next(index.get_keys(Simhash(base))), self.now,
+                                         '{:x},legacy'.format(base))
+        for fp in (base, base ^ 0b111, fps[0], fps[-1], fps[-1] ^ (1 << 40)):
+            sent = self.stand_in.bytes_sent
+            expected = index.find_near_dups(Simhash(fp))
+            sent, filtered_sent = self.stand_in.bytes_sent - sent, self.stand_in.bytes_sent
+            self.assertEqual(filtered.find_near_dups(Simhash(fp)), expected)
+            self.assertLessEqual(self.stand_in.bytes_sent - filtered_sent, sent)
+            if fp == fps[0]:
+                # the hot bucket stays in redis
+                self.assertLess(self.stand_in.bytes_sent - filtered_sent, sent / 10)
+
+    def test_write_behind(self):
+        from pymongo.errors import BulkWriteError
+
+        class Collection(object):
+            def __init__(self):
+                self.docs = {}
+                self.calls = 0
+
+            def insert_many(self, docs, ordered=True):
+                self.calls += 1
+                errors = []
+                for n, doc in enumerate(docs):
+                    unique = (doc['key'], doc['simhash_value_obj_id'])
+                    if unique in self.docs:
+                        errors.append({'index': n, 'code': 11000})
+                    else:
+                        self.docs[unique] = doc
+                if errors:
+                    raise BulkWriteError({'writeErrors': errors})
+
+        class InvertedIndex(object):
+            collection = Collection()
+
+            @classmethod
+            def _get_collection(cls):
+                return cls.collection
+
+        fps = [0x0123456789abcdef, 0xfedcba9876543210, 0x0f0f0f0f0f0f0f0f]
+        # read after write
+        index = SimhashIndexWithRedis(InvertedIndex, self.redis, obj_id_table=self.table, split_threshold=None)
+        self.redis.redis.ping()
+        before = self.stand_in.round_trips
+        index.add('a', Simhash(fps[0]), add_time=int(time.time()))
+        self.assertEqual(self.stand_in.round_trips - before, 1)
+        self.assertEqual(index.get_near_dups(Simhash(fps[0] ^ 1)), ['a'])
+        # stored already, the member keeps its first add time
+        key = next(index.get_keys(Simhash(fps[0])))
+        score = self.redis.get_score(key, index._member(fps[0], 0))
+        index.add('a', Simhash(fps[0]), add_time=int(time.time()) + 100)
+        self.assertEqual(self.redis.get_score(key, index._member(fps[0], 0)), score)
+
+        buffered = SimhashIndexWithRedis(InvertedIndex, self.redis, obj_id_table=self.table,
+                                         split_threshold=None, write_behind=True)
+        buffered.write_buffer.max_size = 3
+        calls = InvertedIndex.collection.calls
+        buffered.add('b', Simhash(fps[1]))
+        buffered.add('c', Simhash(fps[2]))
+        self.assertEqual(buffered.get_near_dups(Simhash(fps[1])), [])
+        buffered.add('d', Simhash(fps[2] ^ 1))
+        # the third one fills the batch
+        self.assertEqual(InvertedIndex.collection.calls, calls + 1)
+        self.assertEqual(buffered.get_near_dups(Simhash(fps[2])), ['c', 'd'])
+        buffered.add('e', Simhash(fps[1] ^ 1))
+        buffered.close()
+        self.assertEqual(buffered.get_near_dups(Simhash(fps[1])), ['b', 'e'])
+        self.assertEqual(len(InvertedIndex.collection.docs), 4 * 5)
+        self.assertRaises(RuntimeError, buffered.add, 'f', Simhash(fps[0]))
+
+        # a failed batch is put back, its documents stored before redis failed
+        def fail(*args, **kwargs):
+            raise redis.exceptions.ConnectionError('down')
+
+        self.redis.add_many = fail
+        retried = SimhashIndexWithRedis(InvertedIndex, self.redis, obj_id_table=self.table,
+                                        split_threshold=None, write_behind=True)
+        retried.add('g', Simhash(fps[0] ^ 0b11))
+        self.assertEqual(retried.flush(), 0)
+        self.assertEqual((len(retried.write_buffer), retried.write_buffer.retried), (1, 1))
+        # logged, not raised, without the buffer
+        index.add('h', Simhash(fps[1] ^ 0b11))
+        del self.redis.add_many
+        self.assertEqual(retried.flush(), 1)
+        self.assertEqual(retried.get_near_dups(Simhash(fps[0])), ['a', 'g'])
+        self.assertEqual(index.get_near_dups(Simhash(fps[1])), ['b', 'e'])
+        retried.close()
+
+        # every item put back max_retries times, then dropped
+        buffer = WriteBehindBuffer(fail, max_size=10, max_retries=2)
+        buffer.put(1)
+        self.assertEqual(buffer.flush(), 0)
+        buffer.put(2)
+        buffer.close()
+        self.assertEqual((len(buffer), buffer.dropped, buffer.retried, buffer.written), (0, 2, 4, 0))
+
+    def test_compact_members(self):
+        for n in (0, 1, 127, 128, 300, 2 ** 35):
+            self.assertEqual(decode_varint(b'x' + encode_varint(n), 1), (n, 1 + len(encode_varint(n))))
+        fp = 0xfedcba9876543210
+        self.assertEqual(len(compact_member(fp, 10 ** 6)), 12)
+        self.assertEqual(decode_member(compact_member(fp, 300)), (fp, 300))
+        self.assertEqual(decode_member(compact_member(0, 0)), (0, 0))
+        self.assertEqual(decode_member(text_member(fp, 300)), (fp, 300))
+        self.assertEqual(decode_member('{:x},legacy'.format(fp).encode()), (fp, 'legacy'))
+        self.assertIsNone(decode_member(SPLIT_MARKER))
+        self.assertRaises(ValueError, decode_member, compact_member(fp, 1)[:5])
+
+        text = SimhashIndexWithRedis(None, self.redis, obj_id_table=self.table)
+        compact = SimhashIndexWithRedis(None, self.redis, obj_id_table=self.table, compact=True)
+        filtered = SimhashIndexWithRedis(None, self.redis, obj_id_table=self.table, compact=True, server_filter=True)
+        fps = [0x0123456789abcdef, 0x0123456789abcdef ^ 0b1011, 0xfedcba9876543210]
+        for n, fp in enumerate(fps):
+            for _, key in text._keys(Simhash(fp)):
+                self.redis.redis.execute_command('ZADD', key, self.now + n,
+                                                 text._member(fp, self.table.intern('doc{}'.format(n))))
+        self.redis.redis.execute_command('ZADD', next(text.get_keys(Simhash(fps[2]))), self.now,
+                                         '{:x},legacy'.format(fps[2]))
+        self.redis.set('digest:x', 'doc0')
+        expected = [text.get_near_dups(Simhash(fp)) for fp in fps]
+        self.assertEqual(expected[0], ['doc0', 'doc1'])
+
+        report = migrate_members(self.redis, self.table)
+        self.assertEqual(report['converted'], report['members'])
+        self.assertLess(report['member_bytes_after'], report['member_bytes_before'] * 2 / 3)
+        for index in (compact, filtered, text):
+            self.assertEqual([index.get_near_dups(Simhash(fp)) for fp in fps], expected)
+        key = next(text.get_keys(Simhash(fps[1])))
+        self.assertEqual(self.redis.get_score(key, compact._member(fps[1], self.table.intern('doc1'))), self.now + 1)
+        self.assertEqual(self.redis.get('digest:x'), b'doc0')
+        # and back
+        migrate_members(self.redis, self.table, compact=False)
+        self.assertEqual(self.redis.get_score(key, text._member(fps[1], self.table.intern('doc1'))), self.now + 1)
+        self.assertEqual([text.get_near_dups(Simhash(fp)) for fp in fps], expected)
+
+    def test_migrate_members_watch(self):
+        fps = [0x0123456789abcdef, 0xfedcba9876543210, 0x0f0f0f0f0f0f0f0f]
+        for n, fp in enumerate(fps[:2]):
+            self.redis.redis.execute_command('ZADD', 'k0', self.now, '{:x},doc{}'.format(fp, n))
+        table = RedisObjIdTable(self.redis)
+        intern_many = table.intern_many
+        tries = []
+
+        def intern_and_write(obj_ids, add_times=None):
+            if not tries:
+                # another process between the read and the MULTI
+                self.redis.delete('k0', '{:x},doc1'.format(fps[1]))
+                self.redis.redis.execute_command('ZADD', 'k0', self.now, '{:x},doc2'.format(fps[2]))
+            tries.append(obj_ids)
+            return intern_many(obj_ids, add_times)
+
+        table.intern_many = intern_and_write
+        report = migrate_members(self.redis, table)
+        self.assertEqual(tries, [['doc0', 'doc1'], ['doc0', 'doc2']])
+        self.assertEqual((report['keys'], report['members'], report['converted']), (1, 2, 2))
+        # the member removed is not brought back, the one added is converted too
+        members = [decode_member(v) for v in self.redis.get_values('k0')]
+        self.assertEqual(sorted(members), [(fps[0], table.get('doc0')), (fps[2], table.get('doc2'))])
+
+    def test_expiry_sweeper(self):
+        old = self.now - 3600 * 24 * 40
+        for n in range(25):
+            self.redis.redis.execute_command('ZADD', 'k{}'.format(n), self.now, 'new', old, 'old{}'.format(n))
+        self.redis.redis.execute_command('ZADD', 'k0', SPLIT_MARKER_SCORE, SPLIT_MARKER)
+        self.redis.set('digest:x', 'doc0')
+        self.redis.hset('obj_id:ids', 'doc0', 0)
+        self.assertEqual(self.redis.get_values_many(['k0', 'k1']), [[b'new', SPLIT_MARKER.encode()], [b'new']])
+
+        sweeper = ExpirySweeper(self.redis, save_days=30, batch_size=10, keys_per_second=None)
+        self.assertFalse(sweeper.sweep_batch())
+        self.assertEqual(sweeper.keys_scanned, 10)
+        self.assertAlmostEqual(sweeper.progress, 10 / 27)
+        sweeper.sweep()
+        stats = sweeper.stats()
+        self.assertEqual((stats['passes'], stats['batches'], stats['keys_scanned']), (1, 3, 27))
+        self.assertEqual((stats['keys_trimmed'], stats['members_removed']), (25, 25))
+        self.assertIsNone(stats['progress'])
+        self.assertEqual(self.redis.redis.zrange('k0', 0, -1), [b'new', SPLIT_MARKER.encode()])
+        self.assertEqual(self.redis.get('digest:x'), b'doc0')
+        # the reads only read
+        self.redis.redis.execute_command('ZADD', 'k1', old, 'old1')
+        round_trips = self.stand_in.round_trips
+        self.redis.get_values('k1')
+        self.assertEqual(self.redis.get_score('k1', 'old1'), old)
+
+        # in the background, at the rate limit
+        with ExpirySweeper(self.redis, save_days=30, batch_size=10, keys_per_second=200, interval=60) as sweeper:
+            time.sleep(0.03)
+            self.assertLess(sweeper.keys_scanned, 27)
+            while not sweeper.passes:
+                time.sleep(0.01)
+        self.assertIsNone(self.redis.get_score('k1', 'old1'))
+        self.assertGreater(self.stand_in.round_trips - round_trips, 3)
+
+    def test_redis_obj_id_table(self):
+        table = RedisObjIdTable(self.redis)
+        self.assertEqual(table.intern_many(['a', 'b', 'a']), [1, 2, 1])
+        # in one round trip, the cached ones too, see test_obj_id_table_expiry
+        round_trips = self.stand_in.round_trips
+        self.assertEqual(table.intern_many(['c', 'b']), [3, 2])
+        self.assertEqual(self.stand_in.round_trips - round_trips, 1)
+        self.assertEqual(table.intern('a'), 1)
+        # both hashes are written at once, also by another process
+        other = RedisObjIdTable(self.redis)
+        self.assertEqual(other.intern_many(['d', 'a']), [4, 1])
+        self.assertEqual((self.redis.hlen(table.fwd), self.redis.hlen(table.rev)), (4, 4))
+        self.assertEqual(table.lookup_many([4, 2]), ['d', 'b'])
+
+    def test_obj_id_table_expiry(self):
+        old = self.now - 3600 * 24 * 40
+        table = RedisObjIdTable(self.redis)
+        self.assertEqual(table.intern_many(['a', 'b', 'a'], [old, old, old]), [1, 2, 1])
+        # written again, the latest add time counts
+        self.assertEqual(table.intern_many(['c', 'b'], [old, self.now]), [3, 2])
+        self.assertEqual(table.intern('c', add_time=old - 100), 3)
+        self.assertEqual(self.redis.get_score(table.seen, 3), old)
+        self.redis.redis.execute_command('ZADD', 'k0', old, text_member(1, 1), self.now, text_member(2, 2))
+
+        sweeper = ExpirySweeper(self.redis, save_days=30, keys_per_second=None, obj_id_tables=[table])
+        sweeper.sweep()
+        self.assertEqual((sweeper.members_removed, sweeper.obj_ids_removed), (1, 2))
+        self.assertEqual((table.get('a'), table.get('b'), table.get('c')), (None, 2, None))
+        self.assertEqual(table.lookup_many([1, 2, 3]), [None, 'b', None])
+        self.assertEqual((self.redis.hlen(table.fwd), self.redis.hlen(table.rev)), (1, 1))
+        self.assertEqual(self.redis.redis.zrange(table.seen, 0, -1), [b'2'])
+        # interned again as a new int
+        self.assertEqual(table.intern('a'), 4)
+
+
+@skipUnless(redis_server_up(), 'no redis-server, set SIMHASH_TEST_REDIS_DB to a db which may be flushed')
+class TestLuaScripts(TestCase):
+    """The scripts on a real redis-server, the stand-in only runs their python twins"""
+
+    def setUp(self):
+        self.redis = SimhashRedis(redis_host=REDIS_HOST, redis_port=REDIS_PORT, redis_db=int(TEST_REDIS_DB))
+        self.redis.redis.flushdb()
+        self.stand_in = RedisStandIn().start()
+        self.twin = SimhashRedis(redis_host=self.stand_in.host, redis_port=self.stand_in.port)
+        self.now = int(time.time())
+
+    def tearDown(self):
+        self.redis.redis.flushdb()
+        self.stand_in.stop()
+
+    def zadd(self, name, score, member):
+        for r in (self.redis, self.twin):
+            r.redis.execute_command('ZADD', name, score, member)
+
+    def test_hamming_filter_script(self):
+        random.seed(23)
+        base = random.getrandbits(64) | (1 << 63) | (1 << 31)
+        # the high bits of both halves set, the ones a signed 32 bits xor gets wrong
+        fps = [base ^ (1 << 63), base ^ (1 << 31), base | 0xffffffff, 0xffffffffffffffff, base & 0xffffffff, 0x1f]
+        fps += [base ^ (1 << random.randrange(64)) ^ (1 << random.randrange(64)) for _ in range(50)]
+        fps += [random.getrandbits(64) for _ in range(50)]
+        names = ['k0', 'k1', 'k2']
+        old = self.now - 3600 * 24 * 400
+        for n, fp in enumerate(fps):
+            name = names[n % 3]
+            self.zadd(name, self.now, text_member(fp, n))
+            self.zadd(name, self.now, compact_member(fp, n))
+            self.zadd(name, self.now, '{:x},doc{}'.format(fp, n))
+            self.zadd(name, old, compact_member(fp, n + 1000))
+        self.zadd('k1', SPLIT_MARKER_SCORE, SPLIT_MARKER)
+
+        def distance(member):
+            return bin(decode_member(member)[0] ^ fp).count('1')
+
+        for fp in (base, base ^ 0b111, fps[3], fps[4], fps[5], random.getrandbits(64)):
+            for max_distance in (0, 3, 6):
+                for trim in (True, False):
+                    expected = [[v for v in values if decode_member(v) is None or distance(v) <= max_distance]
+                                for values in self.redis.get_values_many(names, trim=trim)]
+                    self.assertEqual(self.redis.filter_values_many(names, fp, max_distance, trim=trim), expected)
+                    self.assertEqual(self.twin.filter_values_many(names, fp, max_distance, trim=trim), expected)
+        # the compact members were compared too
+        self.assertTrue(any(v[:1] == b'\x00' for v in self.redis.filter_values_many(names, base, 6)[0]))
+
+    def test_obj_id_scripts(self):
+        old = self.now - 3600 * 24 * 40
+        tables = [RedisObjIdTable(self.redis), RedisObjIdTable(self.twin)]
+        steps = [lambda t: t.intern_many(['a', 'b', 'a'], [old, old, old]),
+                 lambda t: t.intern_many(['c', 'b', 'd'], [old, self.now, old + 1]),
+                 lambda t: t.intern('c', add_time=old - 100),
+                 lambda t: t.expire(old, batch_size=1),
+                 lambda t: t.intern_many(['a', 'e']),
+                 lambda t: t.expire(old + 1),
+                 lambda t: (t.lookup_many([1, 2, 3, 4, 5, 6]), t.get('b'), t.get('d'))]
+        for step in steps:
+            self.assertEqual(*[step(t) for t in tables])
+        for name in tables[0].names:
+            self.assertEqual(*[r.redis.type(name) for r in (self.redis, self.twin)])
+        self.assertEqual(*[r.redis.hgetall(tables[0].fwd) for r in (self.redis, self.twin)])
+        self.assertEqual(*[r.redis.hgetall(tables[0].rev) for r in (self.redis, self.twin)])
+        self.assertEqual(*[r.redis.zrange(tables[0].seen, 0, -1, withscores=True) for r in (self.redis, self.twin)])
+        self.assertEqual(tables[0].lookup_many([2, 5, 6]), ['b', 'a', 'e'])
+
+
 if __name__ == '__main__':
     # main()
     import threading
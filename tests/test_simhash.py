@@ -9,8 +9,27 @@
 
 from unittest import main, TestCase
 
+import hashlib
+import os
+import random
+import tempfile
+import time
+
 from fingerprints_calculation.simhash import Simhash
-from similarity_calculation.hamming_distance import HammingDistance
+from fingerprints_calculation import hashfunc
+from fingerprints_calculation.hashfunc import md5_hash, get_hash_scheme
+from extract_features.extract_features_participle import Participle, rolling_hash
+from extract_features.clean_html import clean_html, normalize_text
+from fingerprints_storage.simhash_index import SimhashIndex
+from fingerprints_storage.simhash_index_array import SimhashArrayIndex
+from fingerprints_storage.index_layout import IndexLayout, plan_layout
+from fingerprints_storage.obj_id_table import ObjIdTable
+from fingerprints_storage.simhash_index_segmented import memory_segments
+from fingerprints_storage.bulk_load import parse_members
+from fingerprints_storage.digest_store import DigestStore, text_digest
+from similarity_calculation.hamming_distance import HammingDistance, hamming_distances, within_distance
+from similarity_calculation.self_join import iter_pairs
+from similarity_calculation.clustering import UnionFind
 from fingerprints_storage.simhash_index_redis import SimhashIndexWithRedis
 from sklearn.feature_extraction.text import TfidfVectorizer
 
@@ -35,6 +54,132 @@ class TestSimhash(TestCase):
     def test_value(self):
         self.assertEqual(Simhash(['aaa', 'bbb']).fingerprint, 57087923692560392)
 
+    def test_numpy_backend(self):
+        features = [
+            ['aaa', 'bbb'],
+            {'hello': 3, 'world': 4, 'fine': 5, 'new': 2, 'text': 3},
+            [('how', 0.25), ('are', 0.5), ('you', -0.125), ('fine', 0.75)],
+            'How are you? I AM fine. Thanks. And you?',
+        ]
+        for f in features:
+            self.assertEqual(Simhash(f, backend='numpy').fingerprint,
+                             Simhash(f, backend='python').fingerprint)
+        self.assertEqual(Simhash(['aaa', 'bbb'], hashbits=32, backend='numpy').fingerprint,
+                         Simhash(['aaa', 'bbb'], hashbits=32, backend='python').fingerprint)
+        self.assertEqual(Simhash({}, backend='numpy').fingerprint, 0)
+
+    def test_build_many(self):
+        objs = [
+            ('1', 'How are you? I AM fine. Thanks. And you?'),
+            ('2', {'hello': 3, 'world': 4, 'fine': 5, 'new': 2, 'text': 3}),
+            ('3', {}),
+            ('4', 'How old are you ? :-) i am fine. Thanks. And you?'),
+        ]
+        expected = [Simhash(v).fingerprint for _, v in objs]
+        obj_ids, fingerprints = Simhash.build_many(objs, chunksize=3)
+        self.assertEqual(obj_ids, ['1', '2', '3', '4'])
+        self.assertEqual(fingerprints.dtype.name, 'uint64')
+        self.assertEqual([int(fp) for fp in fingerprints], expected)
+
+        obj_ids, fingerprints = Simhash.build_many(iter(objs), chunksize=1, processes=2)
+        self.assertEqual([int(fp) for fp in fingerprints], expected)
+
+        # the same as the text one by one under another scheme and shingle cap
+        text = objs[3][1]
+        for scheme in ('blake2b', 'rolling'):
+            _, fingerprints = Simhash.build_many([objs[3]], hash_scheme=scheme, max_features=4)
+            self.assertEqual(int(fingerprints[0]), Simhash(text, hash_scheme=scheme, max_features=4).fingerprint)
+
+    def test_hash_scheme(self):
+        self.assertEqual(md5_hash(b'hello'), int(hashlib.md5(b'hello').hexdigest(), 16))
+        self.assertEqual(Simhash(['aaa', 'bbb'], hash_scheme='md5').fingerprint, 57087923692560392)
+        self.assertEqual(Simhash(['aaa', 'bbb']).hash_version, 0)
+
+        sh = Simhash('How are you? I AM fine. Thanks. And you?', hash_scheme='blake2b')
+        self.assertEqual(sh.hash_version, get_hash_scheme('blake2b').version)
+        self.assertEqual(Simhash(sh).hash_version, sh.hash_version)
+        self.assertNotEqual(sh.fingerprint, Simhash('How are you? I AM fine. Thanks. And you?').fingerprint)
+        self.assertRaises(ValueError, Simhash, 'text', hash_scheme='unknown')
+
+        # the same fingerprint with another scheme never lands in the same bucket
+        index = SimhashIndex([])
+        legacy = Simhash(sh.fingerprint)
+        self.assertFalse(set(index.get_keys(sh)) & set(index.get_keys(legacy)))
+        index.add('1', sh)
+        self.assertEqual(index.get_near_dups(legacy), [])
+        self.assertEqual(len(index.get_near_dups(sh)), 1)
+
+    def test_shingle_hash_cache(self):
+        hashfunc.set_cache_size(64)
+        try:
+            text = 'How are you? I AM fine. Thanks. And you?'
+            fingerprint = Simhash(text).fingerprint
+            misses = hashfunc.cache_info().misses
+            self.assertEqual(Simhash(text).fingerprint, fingerprint)
+            self.assertEqual(hashfunc.cache_info().misses, misses)
+            self.assertGreater(hashfunc.cache_info().hits, 0)
+            self.assertEqual(Simhash(text, cache=False).fingerprint, fingerprint)
+            Simhash(' '.join(str(i) for i in range(100)))
+            self.assertEqual(hashfunc.cache_info().currsize, 64)
+        finally:
+            hashfunc.set_cache_size(hashfunc.SHINGLE_HASH_CACHE_SIZE)
+
+    def test_rolling_hash(self):
+        text = 'How are you? I AM fine. Thanks. And you? How are you?'
+        participle = Participle()
+        hashes, counts = participle.get_text_hashes(text)
+        expected = {}
+        for shingle in participle._slice(participle._text_no_punctuation(text)):
+            h = rolling_hash(shingle.encode('utf-8'))
+            expected[h] = expected.get(h, 0) + 1
+        self.assertEqual(dict(zip([int(h) for h in hashes], [int(c) for c in counts])), expected)
+        self.assertEqual(sorted(participle.iter_text_hashes(text)), sorted(
+            h for h, c in expected.items() for _ in range(c)))
+        self.assertEqual(len(participle.get_text_hashes('abc').hashes), 1)
+
+        sh = Simhash(text, hash_scheme='rolling')
+        self.assertEqual(sh.fingerprint, Simhash(text, hash_scheme='rolling', backend='python').fingerprint)
+        self.assertEqual(sh.hash_version, get_hash_scheme('rolling').version)
+        _, fingerprints = Simhash.build_many([('1', text)], hash_scheme='rolling')
+        self.assertEqual(int(fingerprints[0]), sh.fingerprint)
+
+    def test_max_features(self):
+        text = ' '.join('word{}'.format(i) for i in range(500))
+        features = Participle(max_features=64).get_text_feature(text)
+        self.assertEqual(len(features), 64)
+        self.assertEqual(features, Participle(max_features=64).get_text_feature(text))
+        self.assertTrue(set(features) <= set(Participle().get_text_feature(text)))
+        self.assertEqual(Participle(max_features=64).get_text_feature('short text'),
+                         Participle().get_text_feature('short text'))
+
+        hashes, counts = Participle(max_features=64).get_text_hashes(text)
+        self.assertEqual(len(hashes), 64)
+        self.assertEqual(list(hashes), list(Participle().get_text_hashes(text).hashes[:64]))
+
+        self.assertEqual(Simhash(text, max_features=64).fingerprint,
+                         Simhash(Participle(max_features=64).get_text_feature(text)).fingerprint)
+
+    def test_clean_html(self):
+        html = '<p class="a">How are&nbsp;you?</p>\r\n\t<br/>I AM fine &amp; thanks.&#13;\n'
+        self.assertEqual(clean_html(html), 'How are you? I AM fine & thanks.')
+        self.assertEqual(clean_html(' How are\n you? '), 'How are you?')
+        self.assertEqual(normalize_text(html), 'howareyouiamfinethanks')
+        self.assertEqual(normalize_text('x < y & z.<b>w'), 'xyzw')
+        # no entity made of what is left around a tag
+        self.assertEqual(normalize_text('a&<p>b;'), 'ab')
+
+        text = 'How are you? I AM fine. Thanks. And you?'
+        stripped = Participle(strip_html=True)
+        self.assertEqual(stripped.get_text_feature(text), Participle().get_text_feature(text))
+        self.assertEqual(stripped.get_text_feature(html), stripped.get_text_feature(clean_html(html)))
+        # off by default, the fingerprints of an index built before stay the same
+        self.assertNotEqual(stripped.get_text_feature(html), Participle().get_text_feature(html))
+        self.assertEqual(Simhash(html).fingerprint, Simhash(Participle().get_text_feature(html)).fingerprint)
+        self.assertEqual(Simhash(html, strip_html=True).fingerprint,
+                         Simhash(stripped.get_text_feature(html)).fingerprint)
+        self.assertEqual(Simhash.build_many([('a', html)], strip_html=True)[1].tolist(),
+                         [Simhash(html, strip_html=True).fingerprint])
+
     def test_distance(self):
         sh = Simhash('How are you? I AM fine. Thanks. And you?')
         sh2 = Simhash('How old are you ? :-) i am fine. Thanks. And you?')
@@ -45,6 +190,234 @@ class TestSimhash(TestCase):
 
         self.assertNotEqual(HammingDistance("1").distance(Simhash("2")), 0)
 
+    def test_hamming_distances(self):
+        random.seed(9)
+        fp = random.getrandbits(64)
+        candidates = [random.getrandbits(64) for _ in range(100)] + [fp, fp ^ 1, fp ^ (1 << 63)]
+        expected = [HammingDistance(Simhash(fp)).distance(Simhash(c)) for c in candidates]
+        self.assertEqual(hamming_distances(fp, candidates).tolist(), expected)
+        d, mask = within_distance(fp, candidates, 1)
+        self.assertEqual(mask.tolist(), [e <= 1 for e in expected])
+
+    def test_find_near_dups(self):
+        fp = Simhash('How are you? I AM fine. Thanks. And you?').fingerprint
+        objs = [('0', Simhash(fp)), ('1', Simhash(fp ^ 0b101)), ('2', Simhash(fp ^ 1)), ('3', Simhash(~fp & (2 ** 64 - 1)))]
+        matches = SimhashIndex(objs, k=3).find_near_dups(Simhash(fp))
+        self.assertEqual([m.obj_id for m in matches], ['0', '2', '1'])
+        self.assertEqual([m.distance for m in matches], [0, 1, 2])
+        self.assertEqual([m.score for m in matches], [1.0, 1 - 1 / 64.0, 1 - 2 / 64.0])
+        self.assertEqual(HammingDistance(Simhash(fp)).similarity(Simhash(fp ^ 1)), 1 - 1 / 64.0)
+        # get_near_dups gives the obj_ids alone, the same for every index
+        array_index = SimhashArrayIndex.from_arrays([fp, fp ^ 0b101, fp ^ 1], ['0', '1', '2'], k=3,
+                                                    obj_id_table=ObjIdTable())
+        segments = memory_segments(k=3)
+        for obj_id, simhash in objs:
+            segments.add(obj_id, simhash)
+        for index in (SimhashIndex(objs, k=3), array_index, segments):
+            self.assertEqual(index.get_near_dups(Simhash(fp)), ['0', '2', '1'])
+
+    def test_array_index(self):
+        random.seed(11)
+        fps = [random.getrandbits(64) for _ in range(500)]
+        fps += [fps[0] ^ 0b1, fps[0] ^ 0b1101, fps[1] ^ (0b111 << 60), fps[0] ^ 0b11111]
+        objs = [(i, Simhash(fp)) for i, fp in enumerate(fps)]
+        dict_index = SimhashIndex([(str(i), sh) for i, sh in objs], k=3)
+        array_index = SimhashArrayIndex(objs[:300], k=3, merge_threshold=100)
+        for obj_id, sh in objs[300:]:
+            array_index.add(obj_id, sh)
+        self.assertEqual(len(array_index), len(objs))
+        for fp in fps[:3]:
+            expected = [(int(m.obj_id), m.distance) for m in dict_index.find_near_dups(Simhash(fp))]
+            self.assertEqual([(m.obj_id, m.distance) for m in array_index.find_near_dups(Simhash(fp))], expected)
+
+        array_index.delete(500, Simhash(fps[500]))
+        array_index.delete(0, Simhash(fps[0]))
+        self.assertEqual([m.obj_id for m in array_index.find_near_dups(Simhash(fps[0]))], [501])
+        array_index.merge()
+        self.assertEqual([m.obj_id for m in array_index.find_near_dups(Simhash(fps[0]))], [501])
+        self.assertEqual(len(array_index), len(objs) - 2)
+        # the merges give the tables of a build from scratch
+        array_index.delete(3, Simhash(fps[3]))
+        array_index.add(600, Simhash(fps[1] ^ 0b1))
+        array_index.add(601, Simhash(fps[1]))
+        array_index.merge()
+        kept = [(i, fp) for i, fp in enumerate(fps) if i not in (0, 3, 500)] + [(600, fps[1] ^ 0b1), (601, fps[1])]
+        built = SimhashArrayIndex.from_arrays([fp for _, fp in kept], [i for i, _ in kept], k=3)
+        for (keys, obj_ids), (built_keys, built_obj_ids) in zip(array_index.tables, built.tables):
+            self.assertEqual(keys.tolist(), built_keys.tolist())
+            self.assertEqual(sorted(zip(keys.tolist(), obj_ids.tolist())),
+                             sorted(zip(built_keys.tolist(), built_obj_ids.tolist())))
+        self.assertEqual(array_index.get_near_dups(Simhash(fps[1])), built.get_near_dups(Simhash(fps[1])))
+
+    def test_index_layout(self):
+        random.seed(12)
+        layout = IndexLayout(64, 6, blocks=4)
+        self.assertEqual(layout.radius, 1)
+        fp = random.getrandbits(64)
+        # the keys stored by the 4 blocks index are kept
+        self.assertEqual(list(SimhashIndex([], k=3, layout=layout).get_keys(Simhash(fp))),
+                         list(SimhashIndex([], k=3).get_keys(Simhash(fp))))
+        for distance, layout in ((6, layout), (5, plan_layout(64, 5, n=1000)),
+                                 (5, IndexLayout(64, 5, blocks=7, key_blocks=2))):
+            objs = []
+            for i in range(50):
+                flipped = fp
+                for b in random.sample(range(64), distance):
+                    flipped ^= 1 << b
+                objs.append((str(i), Simhash(flipped)))
+            matches = SimhashIndex(objs, k=distance, layout=layout).find_near_dups(Simhash(fp))
+            self.assertEqual(len(matches), 50)
+            # the array index takes the same layouts
+            array_index = SimhashArrayIndex.from_arrays([sh.fingerprint for _, sh in objs], [i for i, _ in objs],
+                                                        k=distance, obj_id_table=ObjIdTable(), layout=layout)
+            self.assertEqual(array_index.find_near_dups(Simhash(fp)), matches)
+            array_index.delete('0', objs[0][1])
+            self.assertEqual(len(array_index.find_near_dups(Simhash(fp))), 49)
+            array_index.merge()
+            self.assertEqual(len(array_index.find_near_dups(Simhash(fp))), 49)
+        # and keep them in the snapshot
+        path = os.path.join(tempfile.mkdtemp(), 'simhash.idx')
+        array_index.save(path)
+        mapped = SimhashArrayIndex.open(path)
+        self.assertEqual((mapped.layout.blocks, mapped.layout.key_blocks, mapped.layout.radius), (7, 2, 0))
+        self.assertEqual(mapped.find_near_dups(Simhash(fp)), array_index.find_near_dups(Simhash(fp)))
+
+    def test_split_bucket(self):
+        random.seed(13)
+        # templated news, every fingerprint has the same lowest block
+        fps = [random.getrandbits(48) << 16 | 0xabcd for _ in range(1000)]
+        index = SimhashIndex([(str(i), Simhash(fp)) for i, fp in enumerate(fps)], k=3, split_threshold=100)
+        key = next(index.get_keys(Simhash(fps[0])))
+        self.assertIn(key, index.split)
+        self.assertNotIn(key, index.bucket)
+        for i in range(20):
+            query = fps[i] ^ 0b111 << 20
+            expected = [str(j) for j, fp in enumerate(fps) if bin(fp ^ query).count('1') <= 3]
+            self.assertEqual(sorted(m.obj_id for m in index.find_near_dups(Simhash(query))), sorted(expected))
+        index.delete('0', Simhash(fps[0]))
+        self.assertNotIn('0', [m.obj_id for m in index.find_near_dups(Simhash(fps[0]))])
+
+    def test_obj_id_table(self):
+        table = ObjIdTable()
+        self.assertEqual([table.intern(obj_id) for obj_id in ('a', 'b', 'a', 'c')], [0, 1, 0, 2])
+        self.assertEqual(table.get('b'), 1)
+        self.assertIsNone(table.get('d'))
+        self.assertEqual(table.lookup_many([2, 0]), ['c', 'a'])
+        index = SimhashIndex([('a', Simhash(1)), ('b', Simhash(3))], k=3, obj_id_table=table)
+        self.assertEqual([m.obj_id for m in index.find_near_dups(Simhash(1))], ['a', 'b'])
+        self.assertEqual(len(table), 3)
+
+    def test_snapshot(self):
+        random.seed(15)
+        fps = [random.getrandbits(64) for _ in range(1000)]
+        index = SimhashIndex([('doc{}'.format(i), Simhash(fp)) for i, fp in enumerate(fps)], k=3)
+        path = os.path.join(tempfile.mkdtemp(), 'simhash.idx')
+        index.save(path)
+        mapped = SimhashArrayIndex.open(path)
+        self.assertEqual(len(mapped), 1000)
+        for fp in fps[:20]:
+            query = Simhash(fp ^ 0b11)
+            self.assertEqual(mapped.find_near_dups(query), index.find_near_dups(query))
+        # recent inserts go to the overlay
+        mapped.add('new', Simhash(fps[0] ^ 1))
+        self.assertEqual([m.obj_id for m in mapped.find_near_dups(Simhash(fps[0]))], ['doc0', 'new'])
+        # the obj_ids are searched by their hash, not decoded all at once
+        table = mapped.obj_id_table
+        self.assertEqual([table.get(obj_id) for obj_id in ('doc7', 'new', 'doc1000')],
+                         [index.obj_id_table.get('doc7'), 1000, None])
+        self.assertEqual(table.intern_many(['doc3', 'newer']), [index.obj_id_table.get('doc3'), 1001])
+        mapped.delete('doc0', Simhash(fps[0]))
+        self.assertEqual([m.obj_id for m in mapped.find_near_dups(Simhash(fps[0]))], ['new'])
+
+        # the hash version is kept, fingerprints of another scheme are not compared
+        blake = Simhash(fps[0], hash_scheme='blake2b')
+        index.add('blake', blake)
+        index.save(path, hash_version=blake.hash_version)
+        mapped = SimhashArrayIndex.open(path)
+        self.assertEqual((len(mapped), mapped.hash_version), (1, blake.hash_version))
+        self.assertEqual(mapped.get_near_dups(blake), ['blake'])
+        self.assertEqual(mapped.get_near_dups(Simhash(fps[0])), [])
+        self.assertRaises(ValueError, mapped.add, 'md5', Simhash(fps[0]))
+        with open(path + '.bad', 'wb') as f:
+            f.write(b'garbage!' * 16)
+        self.assertRaises(ValueError, SimhashArrayIndex.open, path + '.bad')
+
+    def test_segments(self):
+        import time
+        index = memory_segments(k=3, segment_seconds=100, save_days=0)
+        index.retention = 300
+        now = time.time()
+        fp = Simhash('How are you? I AM fine. Thanks. And you?').fingerprint
+        index.add('old', Simhash(fp), add_time=now - 500)
+        index.add('day1', Simhash(fp ^ 1), add_time=now - 250)
+        index.add('day2', Simhash(fp ^ 3), add_time=now)
+        self.assertEqual(len(index), 3)
+        old = index.segments[index.segment_of(now - 500)]
+        # found once from two segments, the nearest
+        index.add('day1', Simhash(fp ^ 7), add_time=now)
+        # the oldest segment is dropped as a whole, its obj_ids with it
+        self.assertEqual([(m.obj_id, m.distance) for m in index.find_near_dups(Simhash(fp))],
+                         [('day1', 1), ('day2', 2)])
+        self.assertEqual(len(index), 2)
+        self.assertNotIn(old, index.segments.values())
+        self.assertEqual([len(segment.obj_id_table) for segment in index.segments.values()], [1, 2])
+        index.delete('day1', Simhash(fp ^ 7))
+        self.assertEqual([m.obj_id for m in index.find_near_dups(Simhash(fp))], ['day1', 'day2'])
+        self.assertEqual(index.expire(now + 1000), [index.segment_of(now - 250), index.segment_of(now)])
+        self.assertEqual(len(index), 0)
+
+    def test_from_arrays(self):
+        random.seed(17)
+        fps = [random.getrandbits(64) for _ in range(2000)]
+        members = ['{:x},doc{}'.format(fp, i) for i, fp in enumerate(fps)]
+        obj_ids, fingerprints = parse_members(members + ['broken'])
+        self.assertEqual(len(obj_ids), 2000)
+        index = SimhashIndex.from_arrays(obj_ids, fingerprints, k=3, split_threshold=100)
+        expected = SimhashIndex([(obj_id, Simhash(fp)) for obj_id, fp in zip(obj_ids, fps)], k=3, split_threshold=100)
+        self.assertEqual(index.bucket, expected.bucket)
+        self.assertEqual(index.find_near_dups(Simhash(fps[3] ^ 0b11)), expected.find_near_dups(Simhash(fps[3] ^ 0b11)))
+        array_index = SimhashArrayIndex.from_arrays(fingerprints, obj_ids, obj_id_table=ObjIdTable())
+        self.assertEqual(array_index.find_near_dups(Simhash(fps[3] ^ 0b11)), expected.find_near_dups(Simhash(fps[3] ^ 0b11)))
+
+    def test_self_join(self):
+        random.seed(18)
+        base = [random.getrandbits(64) for _ in range(300)]
+        near = [fp ^ (1 << random.randrange(64)) ^ (1 << random.randrange(64)) ^ (1 << random.randrange(64))
+                for fp in base[:100]]
+        fps = base + near + base[:10]
+        for distance in (3, 6):
+            expected = sorted((i, j, bin(fps[i] ^ fps[j]).count('1'))
+                              for i in range(len(fps)) for j in range(i + 1, len(fps))
+                              if bin(fps[i] ^ fps[j]).count('1') <= distance)
+            self.assertEqual(sorted(iter_pairs(fps, distance)), expected)
+
+    def test_union_find(self):
+        # c -> b -> a is one cluster though c is never compared with a
+        records = [{'b': ['a']}, {'c': ['b']}, {'d': []}, ('e', 'd'), {'f': ['f']}]
+        clusters = UnionFind().consume(records)
+        self.assertEqual(clusters.canonical('c'), 'a')
+        self.assertEqual(clusters.cluster('c'), clusters.cluster('a'))
+        self.assertNotEqual(clusters.cluster('e'), clusters.cluster('a'))
+        self.assertIsNone(clusters.cluster('g'))
+        self.assertEqual(list(clusters.drop_ids()), ['b', 'c', 'e'])
+        self.assertEqual([(obj_id, canonical) for obj_id, _, canonical in clusters.clusters()],
+                         [('a', 'a'), ('b', 'a'), ('c', 'a'), ('d', 'd'), ('e', 'd')])
+
+    def test_digest_store(self):
+        html = '<p>How are you?&nbsp;I Am fine.</p>'
+        self.assertEqual(text_digest(html), text_digest('how are you i am fine'))
+        self.assertNotEqual(text_digest(html), text_digest('how are you i am fine too'))
+        self.assertIsNone(text_digest('<p> ... </p>'))
+        store = DigestStore(cache_size=2)
+        self.assertIsNone(store.check(text_digest(html), '1'))
+        self.assertEqual(store.check(text_digest('How are you, I am fine!'), '2'), '1')
+        self.assertIsNone(store.check(text_digest('a'), '3'))
+        self.assertIsNone(store.check(text_digest('b'), '4'))
+        # dropped from the LRU cache
+        self.assertIsNone(store.check(text_digest(html), '5'))
+        self.assertEqual((store.hits, store.misses), (1, 4))
+        self.assertEqual(store.hit_rate, 0.2)
+
     def test_long_article(self):
         self.maxDiff = None
 
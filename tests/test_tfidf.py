@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author  : Joshua
+@Time    : 2019/1/10 11:20
+@File    : test_tfidf.py
+@Desc    : tfidf keywords and document frequency test
+"""
+
+from unittest import main, skipUnless, TestCase
+
+import os
+import shutil
+import tempfile
+
+import nltk
+import numpy as np
+
+from extract_features.extract_features_tfidf import DocumentFrequency, TfidfExtractor, get_keywords_tfidf
+
+
+def has_nltk_data():
+    """The stopwords and the tokenizers are downloaded separately from nltk"""
+    try:
+        nltk.corpus.stopwords.words('english')
+        nltk.word_tokenize(nltk.sent_tokenize('How are you? I am fine.')[0])
+    except LookupError:
+        return False
+    return True
+
+
+class TestDocumentFrequency(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_add_document(self):
+        df = DocumentFrequency()
+        df.add_document(['natur', 'languag', 'natur'])
+        df.add_document(['languag', 'comput'])
+        self.assertEqual(df.n_docs, 2)
+        self.assertEqual((df['natur'], df['languag'], df['comput'], df['unknown']), (1, 2, 1, 0))
+        self.assertEqual(len(df), 3)
+
+    def test_save_load(self):
+        df = DocumentFrequency()
+        df.add_document(['natur', 'languag'])
+        df.add_document(['languag'])
+        df.save(self.path)
+
+        loaded = DocumentFrequency.load(self.path, mmap=True)
+        self.assertIsInstance(loaded.counts, np.memmap)
+        self.assertEqual(loaded.n_docs, 2)
+        self.assertEqual((loaded['natur'], loaded['languag']), (1, 2))
+
+        # the delta is merged into the counts, new words appended
+        loaded.add_document(['languag', 'comput'])
+        self.assertEqual((loaded['languag'], loaded['comput']), (3, 1))
+        loaded.save(self.path)
+        # saved twice, counted once
+        loaded.save(self.path)
+        again = DocumentFrequency.load(self.path, mmap=False)
+        self.assertEqual(again.n_docs, 3)
+        self.assertEqual((again['natur'], again['languag'], again['comput']), (1, 3, 1))
+        self.assertEqual(len(again), 3)
+        self.assertEqual(sorted(os.listdir(self.path)), ['counts.npy', 'lock', 'meta.json', 'vocab.txt'])
+
+    def test_save_two_processes(self):
+        first = DocumentFrequency()
+        first.add_document(['natur', 'languag'])
+        first.save(self.path)
+        # two workers load the same table and count documents of their own
+        a = DocumentFrequency.load(self.path)
+        b = DocumentFrequency.load(self.path)
+        a.add_document(['languag', 'comput'])
+        b.add_document(['languag'])
+        b.add_document(['natur', 'machin'])
+        a.save(self.path)
+        b.save(self.path)
+        saved = DocumentFrequency.load(self.path, mmap=False)
+        self.assertEqual(saved.n_docs, 4)
+        self.assertEqual((saved['natur'], saved['languag'], saved['comput'], saved['machin']), (2, 3, 1, 1))
+        # the last to save sees the counts of the other one
+        self.assertEqual((b.n_docs, b['comput']), (4, 1))
+        a.save(self.path)
+        self.assertEqual(DocumentFrequency.load(self.path).n_docs, 4)
+        self.assertEqual((a.n_docs, a['machin']), (4, 1))
+
+    @skipUnless(has_nltk_data(), 'nltk stopwords and punkt are not downloaded')
+    def test_keywords(self):
+        text = ('Natural language processing is a field of computer science. '
+                'Machine translation of natural language is hard, machine translation was slow.')
+        corpus = 'Computers process language. Translation systems were developed in the 1980s.'
+        extractor = TfidfExtractor()
+        extractor.add_document(text)
+        extractor.add_document(corpus)
+        # the document frequency of the two of them, as get_keywords_tfidf counts them
+        self.assertEqual(extractor.get_keywords(text, topk=100, update=False),
+                         get_keywords_tfidf(text, corpus=corpus, topk=100))
+        self.assertEqual(extractor.df.n_docs, 2)
+        extractor.get_keywords(text)
+        self.assertEqual(extractor.df.n_docs, 3)
+
+
+if __name__ == '__main__':
+    main()